@@ -1,50 +1,239 @@
-from openai import OpenAI
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import sqlite3
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 import os
 from dotenv import load_dotenv
-import io
-from contextlib import contextmanager
+import json
+import asyncio
+from typing import Optional
+import logging
+import hashlib
+import time
+from dataclasses import dataclass
+from contextlib import asynccontextmanager
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Local modules read their configuration from the environment at import time
+from db import DB_PATH, ConnectionPool, current_pool, execute_write, fetch_all, get_db_connection, pool, run_db
+from upstream import UpstreamOverloaded, call_openai, check_upstream, create_client, upstream_stats
+from vector_index import VectorIndex, get_embedder, init_vector_store
+from summarizer import MapReduceSummarizer, init_summary_cache
+from search import build_match_query, init_search_index, search_notes
+from llm_cache import ALL_NOTES, ResponseCache, get_note_set_version, init_llm_cache
+from changes import etag_matches, get_changes, get_revision, init_change_log
+from note_store import PREVIEW_CHARS, init_note_store, insert_notes, storage_stats, update_note
+from note_chunks import (CHUNK_IDS_SQL, CHUNK_TEXTS_SQL, NOTE_CHUNK_MIN_BYTES, NOTE_TEXTS_SQL, NoteChunker,
+                         chunk_text, init_note_chunks, note_embedding_text)
+from context_budget import check_tokenizer, count_message_tokens, count_tokens, pack_notes
+from transcription import TranscriptionJob, TranscriptionPipeline, UploadTooLarge, get_transcription_backend
+from jobs import JobQueue, init_jobs
+from note_summaries import COMPACT_NOTES_SQL, FRESH_SUMMARY_SQL, NoteSummaries, init_note_summaries
+from metrics import Gauge, MetricsMiddleware, render_metrics, stage
+from coalesce import SingleFlight
+from tenants import (DEFAULT_TENANT, TENANT_DATA_DIR, TENANT_HEADER, TENANT_POOL_SIZE, TenantMiddleware,
+                     TenantRegistry, admin_token_matches, bearer_token, current_shard, init_tenants,
+                     issue_tenant_key, tenant_db_path, tenant_key_matches)
+from coordination import init_leases, startup_lock, worker_id
+
+# Readiness: a worker is ready once startup and warmup finished; upstream
+# trouble only degrades it unless READY_REQUIRES_UPSTREAM is set
+READY_REQUIRES_UPSTREAM = os.getenv("READY_REQUIRES_UPSTREAM", "").lower() in ("1", "true", "yes")
+startup = {"ready": False, "started_at": None, "seconds": None}
+
+@asynccontextmanager
+async def lifespan(app):
+    # Importing the app does no I/O; each worker process initializes here. When
+    # several boot at once the first migrates the database and syncs the default
+    # tenant's vector indexes while the others wait, then find them up to date.
+    startup["started_at"] = time.time()
+    async with startup_lock(DB_PATH):
+        await run_db(init_db)
+    # Opening the default tenant takes the same lock again around its vector index sync
+    await tenants.acquire(DEFAULT_TENANT)
+    tenants.release(DEFAULT_TENANT)
+    await job_queue.start()
+    await warmup()
+    startup["ready"] = True
+    startup["seconds"] = round(time.time() - startup["started_at"], 3)
+    logger.info("Worker %s ready in %.2fs", worker_id(), startup["seconds"])
+    yield
+    startup["ready"] = False
+    await job_queue.stop()
+    await tenants.close_all()
+
+async def warmup():
+    """Pay one-time costs before taking traffic: tokenizer tables and a pooled database connection"""
+    check_tokenizer()
+    await asyncio.to_thread(count_tokens, "warmup", summarizer.model)
+    await run_db(fetch_all, "SELECT 1")
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse that records serialization time as the json_encode stage"""
+
+    def render(self, content):
+        with stage("json_encode"):
+            return super().render(content)
+
 # Initialize FastAPI application instance
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=TimedJSONResponse)
+app.add_middleware(MetricsMiddleware)
 
-# OpenAI API key for authentication
-# Get API key from environment variable for security
-OPENAI_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_KEY:
-    raise ValueError("OPENAI_API_KEY environment variable is not set")
+@app.exception_handler(UpstreamOverloaded)
+async def upstream_overloaded(request: Request, exc: UpstreamOverloaded):
+    """Shed calls the OpenAI limits cannot take in time with a 503 the client can retry"""
+    return JSONResponse(status_code=503, content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
 
-client = OpenAI(api_key=OPENAI_KEY)
+# OpenAI client, created on first use from OPENAI_API_KEY; the app starts (and
+# serves notes with local backends) without a key, and calls that need one fail
+client = create_client()
+
+logger = logging.getLogger(__name__)
 
 # Database setup
+def init_schema(conn):
+    """Create the notes table and everything derived from it in one tenant database"""
+    init_note_store(conn)
+    init_vector_store(conn)
+    init_leases(conn)
+    init_note_chunks(conn)
+    init_summary_cache(conn)
+    init_search_index(conn)
+    init_llm_cache(conn)
+    init_note_summaries(conn)
+    init_change_log(conn)
+
 def init_db():
-    """Initialize the database and create tables"""
-    with sqlite3.connect('notes.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS notes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                content TEXT NOT NULL
-            )
-        ''')
-        conn.commit()
+    """Initialize the default database: the default tenant's notes plus the shared job and tenant tables"""
+    with pool.connection() as conn:
+        init_schema(conn)
+        init_jobs(conn)
+        init_tenants(conn)
+
+# Vector index files written by earlier versions; their vectors are imported into the database once
+INDEX_PATH = os.path.splitext(DB_PATH)[0] + ".index.npz"
+ASK_TOP_K = int(os.getenv("ASK_TOP_K", "8"))
+# Extra candidates are retrieved so near-duplicates can be skipped without shrinking the context
+ASK_CANDIDATES = ASK_TOP_K * 2
+
+embedder = get_embedder(client)
+
+# Map-reduce summarizer with chunk summaries cached in the database
+summarizer = MapReduceSummarizer.from_env(client, get_db_connection)
+
+# Chunked audio transcription (spool to disk, split, transcribe segments in parallel)
+transcriber = TranscriptionPipeline(get_transcription_backend(client))
+
+# Response cache for /ask and /summarize, invalidated when the notes behind an entry change
+response_cache = ResponseCache.from_env(get_db_connection)
+
+# Background jobs for long-running AI work, persisted so they survive restarts.
+# The queue is shared by all tenants and lives in the default database.
+job_queue = JobQueue(pool.connection)
+
+# Tenant shards: one SQLite database per tenant with its own vector indexes, note chunks and note summaries
+@dataclass
+class TenantShard:
+    tenant_id: str
+    pool: ConnectionPool
+    index: VectorIndex
+    chunks: NoteChunker
+    summaries: NoteSummaries
+
+async def open_tenant_shard(tenant_id):
+    if tenant_id == DEFAULT_TENANT:
+        # The default tenant keeps the original database, so single-tenant installs are unchanged
+        shard_pool, index_path = pool, INDEX_PATH
+    else:
+        os.makedirs(TENANT_DATA_DIR, exist_ok=True)
+        path = tenant_db_path(tenant_id)
+        shard_pool = ConnectionPool(path, size=TENANT_POOL_SIZE)
+        index_path = os.path.splitext(path)[0] + ".index.npz"
+    # Other workers may be opening the same tenant; one creates its schema and syncs, the rest wait
+    async with startup_lock(shard_pool.path):
+        if shard_pool is not pool:
+            def init_tenant_db():
+                with shard_pool.connection() as conn:
+                    init_schema(conn)
+
+            await run_db(init_tenant_db)
+        index = await asyncio.to_thread(VectorIndex, "notes", embedder, shard_pool.connection, index_path)
+        # Bring the vector indexes up to date with notes written while no worker had the shard open
+        await index.sync(texts_sql=NOTE_TEXTS_SQL, prepare=note_embedding_text)
+        chunk_index = await asyncio.to_thread(VectorIndex, "note_chunks", embedder, shard_pool.connection,
+                                              index_path.replace(".index.npz", ".chunks.index.npz"))
+        await chunk_index.sync(ids_sql=CHUNK_IDS_SQL, texts_sql=CHUNK_TEXTS_SQL)
+    # Long notes are split into chunks for retrieval and search, rebuilt in the background after edits
+    # Its leased reconcile pass also compacts deletes out of both vector indexes
+    chunks = NoteChunker(shard_pool.connection, chunk_index, compact_indexes=[index, chunk_index])
+    await chunks.start()
+    # Per-note summaries and keywords, recomputed in the background after writes
+    summaries = NoteSummaries.from_env(client, shard_pool.connection)
+    await summaries.start()
+    return TenantShard(tenant_id, shard_pool, index, chunks, summaries)
+
+async def close_tenant_shard(shard):
+    await shard.summaries.stop()
+    await shard.chunks.stop()
+    if shard.pool is not pool:
+        shard.pool.close()
+
+async def authorize_tenant(tenant_id, key):
+    """Whether key is the registered key of tenant_id (checked in the default database)"""
+    def check():
+        with pool.connection() as conn:
+            return tenant_key_matches(conn, tenant_id, key)
+
+    return await run_db(check)
+
+tenants = TenantRegistry(open_tenant_shard, close_tenant_shard)
+app.add_middleware(TenantMiddleware, registry=tenants, authorize=authorize_tenant,
+                   exempt_paths=("/health", "/ready", "/tenants"))
+
+# Point-in-time gauges, read when /metrics is scraped (summed over open tenant shards)
+Gauge("db_pool_connections", "Pooled SQLite connections by state", ("state",),
+      collect=lambda: {(state,): sum(shard.pool.stats()[state] for shard in tenants.shards())
+                       for state in ("in_use", "idle")})
+Gauge("job_queue_depth", "Queued background jobs per lane", ("lane",),
+      collect=lambda: {(lane,): depth for lane, depth in job_queue.depths().items()})
+Gauge("note_summaries_pending", "Notes waiting for their summary to be recomputed",
+      collect=lambda: {(): sum(shard.summaries.pending() for shard in tenants.shards())})
+Gauge("note_chunks_pending", "Long notes waiting to be (re)chunked",
+      collect=lambda: {(): sum(shard.chunks.pending() for shard in tenants.shards())})
+Gauge("vector_index_size", "Notes in the vector index",
+      collect=lambda: {(): sum(len(shard.index) for shard in tenants.shards())})
+Gauge("chunk_index_size", "Chunks of long notes in the vector index",
+      collect=lambda: {(): sum(len(shard.chunks.index) for shard in tenants.shards())})
+Gauge("tenant_shards_open", "Tenant databases currently open", collect=lambda: {(): len(tenants.shards())})
 
-# Initialize database on startup
-init_db()
+async def on_notes_changed(action, note_ids, contents=None):
+    """Update derived state after committed writes without failing the request.
 
-@contextmanager
-def get_db_connection():
-    """Context manager for database connections"""
-    conn = sqlite3.connect('notes.db')
+    If embedding fails the index is repaired by index.sync() the next
+    time a worker opens the tenant's shard.
+    """
+    shard = current_shard()
     try:
-        yield conn
-    finally:
-        conn.close()
+        await run_db(response_cache.invalidate_notes, note_ids)
+    except sqlite3.Error as e:
+        logger.warning("Response cache invalidation failed for notes %s: %s", note_ids, e)
+    # Deleted notes lose their chunks and summary through the foreign key cascade;
+    # the chunker still prunes their chunk vectors
+    shard.chunks.mark_dirty(note_ids)
+    if action == "upsert":
+        shard.summaries.mark_dirty(note_ids)
+    try:
+        with stage("index_update"):
+            if action == "upsert":
+                await shard.index.upsert_many(note_ids, [note_embedding_text(content) for content in contents])
+            else:
+                for note_id in note_ids:
+                    await run_db(shard.index.remove, note_id)
+    except Exception as e:
+        logger.warning("Vector index update failed for notes %s: %s", note_ids, e)
 
 # API models
 class Note(BaseModel):
@@ -62,43 +251,299 @@ def root():
         "version": "1.0.0",
         "endpoints": {
             "add_note": "POST /add_note",
+            "add_notes_bulk": "POST /add_notes/bulk (JSON array or NDJSON)",
             "edit_note": "PUT /edit_note/{note_id}",
-            "get_notes": "GET /get_notes", 
+            "get_notes": "GET /get_notes?limit=&after_id=&fields=&format=",
             "delete_note": "DELETE /delete_note/{note_id}",
             "summarize": "POST /summarize",
             "ask": "POST /ask",
-            "transcribe_audio": "POST /transcribe_audio"
+            "ask_stream": "POST /ask/stream (server-sent events)",
+            "summarize_stream": "POST /summarize/stream (server-sent events)",
+            "transcribe_audio": "POST /transcribe_audio",
+            "transcribe_audio_job": "POST /transcribe_audio/jobs, GET /transcribe_audio/jobs/{job_id}",
+            "jobs": "POST /jobs, GET /jobs/{job_id}, GET /jobs/{job_id}/result, POST /jobs/{job_id}/cancel",
+            "job_metrics": "GET /jobs/metrics",
+            "search": "GET /search?q=&limit=&offset=&prefix=",
+            "changes": "GET /changes?since=&limit= (inserts, updates and deletes since a revision)",
+            "cache_stats": "GET /cache/stats",
+            "note_summaries": "GET /note_summaries/{note_id}, GET /note_summaries/stats",
+            "note_chunks": "GET /note_chunks/{note_id}, GET /note_chunks/stats",
+            "db_pool": "GET /db/pool",
+            "db_storage": "GET /db/storage",
+            "tenants": "POST /tenants (admin), GET /tenants/stats (send X-Tenant-ID and the tenant's key as a "
+                       "bearer token on any request to use that tenant's notes)",
+            "upstream": "GET /upstream/stats",
+            "health": "GET /health (liveness), GET /ready (database and upstream checks)",
+            "metrics": "GET /metrics (Prometheus text format)"
         },
         "docs": "/docs",
         "status": "running"
     }
 
+@app.get("/metrics")
+def metrics():
+    """Prometheus text-format metrics: request and stage latency histograms, tokens, queue depths.
+
+    Every sample carries a worker label: the values cover only the process that answered.
+    """
+    return PlainTextResponse(render_metrics([("worker", worker_id())]), media_type="text/plain; version=0.0.4")
+
+@app.get("/db/pool")
+def db_pool_stats():
+    """Connection pool size, checkouts and wait times of the caller's tenant database"""
+    return current_pool().stats()
+
+@app.get("/db/storage")
+def db_storage_stats():
+    """Note bytes as written, after deduplication and as stored after compression"""
+    with get_db_connection() as conn:
+        return storage_stats(conn)
+
+class TenantCreate(BaseModel):
+    tenant_id: str = Field(description="Tenant ID: 1-64 letters, digits, '-' or '_'")
+
+@app.post("/tenants", status_code=201)
+async def create_tenant(tenant: TenantCreate, request: Request):
+    """Register a tenant, or rotate its key (admin token required); the key is returned only here"""
+    if not admin_token_matches(bearer_token(request.headers.get("authorization"))):
+        raise HTTPException(status_code=403, detail="Creating tenants requires the TENANT_ADMIN_TOKEN bearer token")
+
+    def issue():
+        with pool.connection() as conn:
+            return issue_tenant_key(conn, tenant.tenant_id)
+
+    try:
+        key = await run_db(issue)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"tenant_id": tenant.tenant_id, "key": key}
+
+@app.get("/tenants/stats")
+def tenant_stats():
+    """Open tenant databases, LRU hits and evictions"""
+    return tenants.stats()
+
+@app.get("/health")
+def health():
+    """Liveness: the worker process is up and serving requests"""
+    return {"status": "ok", "worker": worker_id()}
+
+def check_database():
+    with pool.connection() as conn:
+        conn.execute("SELECT 1 FROM notes LIMIT 1").fetchall()
+
+@app.get("/ready")
+async def ready():
+    """Readiness: 503 until startup finished or while the database is unusable; reports upstream status"""
+    checks = {}
+    try:
+        start = time.perf_counter()
+        await run_db(check_database)
+        checks["database"] = {"ok": True, "latency_ms": round((time.perf_counter() - start) * 1000, 1)}
+    except Exception as e:
+        checks["database"] = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    checks["upstream"] = await check_upstream(client)
+    if not startup["ready"] or not checks["database"]["ok"]:
+        status = "starting" if not startup["ready"] else "unavailable"
+    elif not checks["upstream"]["ok"]:
+        status = "unavailable" if READY_REQUIRES_UPSTREAM else "degraded"
+    else:
+        status = "ok"
+    content = {"status": status, "worker": worker_id(), "startup_seconds": startup["seconds"], "checks": checks}
+    return JSONResponse(status_code=200 if status in ("ok", "degraded") else 503, content=content)
+
+@app.get("/upstream/stats")
+def upstream_limits():
+    """Adaptive OpenAI concurrency limit, queue and remaining rate limit budget"""
+    return upstream_stats()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Response cache hit/miss ratios and estimated dollars saved, counted by the worker that answered"""
+    return {"worker": worker_id(), **await run_db(response_cache.stats)}
+
+@app.get("/note_summaries/stats")
+async def note_summary_stats():
+    """Per-note summary coverage, pending recomputes and token totals"""
+    return await run_db(current_shard().summaries.stats)
+
+@app.get("/note_summaries/{note_id}")
+async def get_note_summary(note_id: int):
+    """Precomputed summary, keywords and token count of one note"""
+    summary = await run_db(current_shard().summaries.get, note_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Summary not found (note missing or not yet summarized)")
+    return summary
+
+@app.get("/note_chunks/stats")
+async def note_chunk_stats():
+    """Long notes chunked so far, pending rechunks and chunk totals"""
+    return await run_db(current_shard().chunks.stats)
+
+@app.get("/note_chunks/{note_id}")
+async def get_note_chunks(note_id: int):
+    """Chunks of one long note in document order"""
+    chunks = await run_db(current_shard().chunks.get, note_id)
+    if chunks is None:
+        raise HTTPException(status_code=404, detail="Chunks not found (note missing, short or not yet chunked)")
+    return {"note_id": note_id, "chunks": chunks}
+
 # Endpoints
 @app.post("/add_note")
-def add_note(note: Note):
+async def add_note(note: Note):
     """Add a new note to the database"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO notes (content) VALUES (?)", (note.content,))
-            conn.commit()
-            return {"message": "Note added successfully", "id": cursor.lastrowid}
+        note_id, _ = await run_db(insert_notes_batch, [note.content])
+        await on_notes_changed("upsert", [note_id], [note.content])
+        return {"message": "Note added successfully", "id": note_id}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error adding note: {str(e)}")
 
+# Bulk ingestion settings
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "500"))
+BULK_MAX_ERRORS = 1000
+
+def insert_notes_batch(contents):
+    """Insert rows in one transaction; returns (first_id, last_id).
+
+    IDs are contiguous because the write lock is held for the whole batch.
+    """
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            insert_notes(conn, contents)
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return last_id - len(contents) + 1, last_id
+
+class BulkIngest:
+    """Accumulates parsed rows and writes them in size-bounded transactions"""
+
+    def __init__(self):
+        self.pending = []
+        self.id_ranges = []
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def fail(self, row, error):
+        self.failed += 1
+        if len(self.errors) < BULK_MAX_ERRORS:
+            self.errors.append({"row": row, "error": error})
+
+    async def add(self, row, item):
+        try:
+            note = Note.model_validate({"content": item} if isinstance(item, str) else item)
+        except ValidationError as e:
+            self.fail(row, e.errors()[0]["msg"])
+            return
+        self.pending.append((row, note.content))
+        if len(self.pending) >= BULK_BATCH_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        try:
+            committed = [(await run_db(insert_notes_batch, [content for _, content in batch]), batch)]
+        except sqlite3.Error:
+            # Isolate the bad rows by retrying the batch one row at a time
+            committed = []
+            for row, content in batch:
+                try:
+                    committed.append((await run_db(insert_notes_batch, [content]), [(row, content)]))
+                except sqlite3.Error as e:
+                    self.fail(row, f"Database error: {str(e)}")
+        for (first_id, last_id), rows in committed:
+            if self.id_ranges and self.id_ranges[-1][1] + 1 == first_id:
+                self.id_ranges[-1][1] = last_id
+            else:
+                self.id_ranges.append([first_id, last_id])
+            self.inserted += len(rows)
+            await on_notes_changed("upsert", list(range(first_id, last_id + 1)), [content for _, content in rows])
+
+    def result(self):
+        return {
+            "message": f"Added {self.inserted} notes ({self.failed} failed)",
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "id_ranges": self.id_ranges,
+            "errors": self.errors,
+        }
+
+@app.post("/add_notes/bulk")
+async def add_notes_bulk(request: Request):
+    """Add many notes at once from a JSON array or a streamed NDJSON body.
+
+    Each item is an object with a "content" field (or a plain string). Rows
+    are inserted with executemany in transactions of BULK_BATCH_SIZE; the
+    response lists the assigned ID ranges and any per-row failures.
+    """
+    ingest = BulkIngest()
+    content_type = request.headers.get("content-type", "")
+    try:
+        if "ndjson" in content_type or "jsonlines" in content_type:
+            # Parse line by line as the body arrives so memory stays bounded
+            row, buffer = 0, b""
+            async for chunk in request.stream():
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        await _ingest_ndjson_line(ingest, row, line)
+                        row += 1
+            if buffer.strip():
+                await _ingest_ndjson_line(ingest, row, buffer)
+        else:
+            try:
+                items = json.loads(await request.body())
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid JSON: {str(e)}")
+            if not isinstance(items, list):
+                raise HTTPException(status_code=400, detail="Body must be a JSON array of notes")
+            for row, item in enumerate(items):
+                await ingest.add(row, item)
+        await ingest.flush()
+        return ingest.result()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error adding notes: {str(e)}")
+
+async def _ingest_ndjson_line(ingest, row, line):
+    try:
+        item = json.loads(line)
+    except ValueError as e:
+        ingest.fail(row, f"Invalid JSON: {str(e)}")
+        return
+    await ingest.add(row, item)
+
+def update_note_row(note_id, content):
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rowcount = update_note(conn, note_id, content)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return rowcount
+
 @app.put("/edit_note/{note_id}")
-def edit_note(note_id: int, note: Note):
+async def edit_note(note_id: int, note: Note):
     """Edit an existing note by ID"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE notes SET content = ? WHERE id = ?", (note.content, note_id))
-            conn.commit()
-            if cursor.rowcount == 0:
-                raise HTTPException(status_code=404, detail="Note not found")
-            return {"message": f"Note {note_id} updated successfully"}
+        rowcount = await run_db(update_note_row, note_id, note.content)
+        if rowcount == 0:
+            raise HTTPException(status_code=404, detail="Note not found")
+        await on_notes_changed("upsert", [note_id], [note.content])
+        return {"message": f"Note {note_id} updated successfully"}
     except HTTPException:
         raise
     except sqlite3.Error as e:
@@ -107,16 +552,14 @@ def edit_note(note_id: int, note: Note):
         raise HTTPException(status_code=500, detail=f"Error updating note: {str(e)}")
 
 @app.delete("/delete_note/{note_id}")
-def delete_note(note_id: int):
+async def delete_note(note_id: int):
     """Delete a note by ID"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM notes WHERE id = ?", (note_id,))
-            conn.commit()
-            if cursor.rowcount == 0:
-                raise HTTPException(status_code=404, detail="Note not found")
-            return {"message": f"Note {note_id} deleted successfully"}
+        _, rowcount = await run_db(execute_write, "DELETE FROM notes WHERE id = ?", (note_id,))
+        if rowcount == 0:
+            raise HTTPException(status_code=404, detail="Note not found")
+        await on_notes_changed("remove", [note_id])
+        return {"message": f"Note {note_id} deleted successfully"}
     except HTTPException:
         raise
     except sqlite3.Error as e:
@@ -124,118 +567,633 @@ def delete_note(note_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting note: {str(e)}")
     
+# Pagination settings for /get_notes
+NOTES_PAGE_SIZE = 100
+NOTES_MAX_PAGE_SIZE = 1000
+NOTES_PREVIEW_CHARS = 200
+STREAM_FETCH_SIZE = 500
+
+def _notes_query(after_id, limit, fields, preview_chars):
+    """Build the keyset-paginated SELECT for /get_notes (newest first)"""
+    if fields == "full":
+        sql, params = "SELECT id, content FROM note_contents", []
+    elif preview_chars <= PREVIEW_CHARS:
+        # Served from the inline preview without touching the note bodies
+        sql, params = "SELECT id, substr(preview, 1, ?) FROM notes", [preview_chars]
+    else:
+        sql, params = "SELECT id, substr(content, 1, ?) FROM note_contents", [preview_chars]
+    if after_id is not None:
+        sql += " WHERE id < ?"
+        params.append(after_id)
+    sql += " ORDER BY id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+def _stream_notes_ndjson(sql, params, value_key):
+    """Yield one JSON line per row straight from the cursor"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(STREAM_FETCH_SIZE)
+            if not rows:
+                break
+            yield "".join(json.dumps({"id": row[0], value_key: row[1]}) + "\n" for row in rows)
+
+# Change feed page size for /changes
+CHANGES_PAGE_SIZE = 500
+
+def current_revision():
+    with get_db_connection() as conn:
+        return get_revision(conn)
+
+def response_etag(tenant_id, revision, path, query_items):
+    """ETag of a notes listing: the tenant, the note revision and the exact request it answers.
+
+    Different endpoints, pages, field sets or formats at the same revision
+    have different bodies, so they must not share a validator.
+    """
+    query = "&".join(f"{name}={value}" for name, value in sorted(query_items))
+    digest = hashlib.sha256(f"{path}?{query}".encode("utf-8")).hexdigest()[:16]
+    return f'"notes-{tenant_id}-{revision}-{digest}"'
+
+async def check_not_modified(request, response):
+    """Set the ETag for the current note revision; return a 304 response if the client already has it.
+
+    The revision is read before the data, so a write racing with the request
+    can only make the ETag older than the body, never newer.
+    """
+    etag = response_etag(current_shard().tenant_id, await run_db(current_revision), request.url.path,
+                         request.query_params.multi_items())
+    # The same URL returns another tenant's notes under a different X-Tenant-ID
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": TENANT_HEADER}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
 @app.get("/get_notes")
-def get_notes():
-    """Get all notes from the database"""
+async def get_notes(request: Request, response: Response, limit: Optional[int] = None, after_id: Optional[int] = None,
+                    fields: str = "full", format: str = "json", preview_chars: int = NOTES_PREVIEW_CHARS):
+    """Get notes newest first, one keyset page at a time.
+
+    Pass the last ID of a page as after_id to fetch the next page. fields=preview
+    returns only IDs and the first preview_chars characters; format=ndjson streams
+    rows as they are read (without a limit it streams every note). Responses carry
+    an ETag; send it back as If-None-Match to get a 304 while nothing changed.
+    """
+    if fields not in ("full", "preview"):
+        raise HTTPException(status_code=400, detail="fields must be 'full' or 'preview'")
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'json' or 'ndjson'")
+    if limit is not None and not 1 <= limit <= NOTES_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {NOTES_MAX_PAGE_SIZE}")
+    if preview_chars < 1:
+        raise HTTPException(status_code=400, detail="preview_chars must be positive")
+    
+    not_modified = await check_not_modified(request, response)
+    if not_modified is not None:
+        return not_modified
+    
+    value_key = "content" if fields == "full" else "preview"
+    if format == "ndjson":
+        sql, params = _notes_query(after_id, limit, fields, preview_chars)
+        return StreamingResponse(_stream_notes_ndjson(sql, params, value_key), media_type="application/x-ndjson",
+                                 headers={name: response.headers[name] for name in ("etag", "cache-control", "vary")})
+    
+    limit = limit or NOTES_PAGE_SIZE
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM notes ORDER BY id DESC")
-            return cursor.fetchall()
+        sql, params = _notes_query(after_id, limit, fields, preview_chars)
+        notes = await run_db(fetch_all, sql, params)
+        if len(notes) == limit:
+            response.headers["X-Next-After-Id"] = str(notes[-1][0])
+        return notes
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving notes: {str(e)}")
 
+@app.get("/search")
+async def search(request: Request, response: Response, q: str, limit: int = 20, offset: int = 0, prefix: bool = False):
+    """Full-text search over notes with BM25 ranking and highlighted snippets"""
+    if not 1 <= limit <= NOTES_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {NOTES_MAX_PAGE_SIZE}")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="offset must not be negative")
+    not_modified = await check_not_modified(request, response)
+    if not_modified is not None:
+        return not_modified
+    match = build_match_query(q, prefix=prefix)
+    if match is None:
+        return {"query": q, "results": [], "next_offset": None}
+    try:
+        def run_search():
+            with get_db_connection() as conn:
+                return search_notes(conn, match, limit, offset)
+        
+        rows = await run_db(run_search)
+        results = [{"id": note_id, "score": -score, "snippet": snippet} for note_id, score, snippet in rows]
+        return {
+            "query": q,
+            "results": results,
+            "next_offset": offset + limit if len(results) == limit else None,
+        }
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+@app.get("/changes")
+async def changes(request: Request, response: Response, since: int = 0, limit: int = CHANGES_PAGE_SIZE):
+    """Notes inserted, updated or deleted after revision `since`, oldest change first.
+
+    Each note appears once with its latest content, or as a tombstone
+    ("deleted": true) if it was removed. Store `next_since` and pass it back;
+    while has_more is true, keep fetching. since=0 returns every note.
+    """
+    if not 1 <= limit <= NOTES_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {NOTES_MAX_PAGE_SIZE}")
+    if since < 0:
+        raise HTTPException(status_code=400, detail="since must not be negative")
+    not_modified = await check_not_modified(request, response)
+    if not_modified is not None:
+        return not_modified
+    try:
+        def read_changes():
+            with get_db_connection() as conn:
+                return get_changes(conn, since, limit)
+        
+        revision, rows, has_more = await run_db(read_changes)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    return {
+        "revision": revision,
+        "changes": [
+            {"rev": rev, "id": note_id, "deleted": bool(deleted), "content": content}
+            for rev, note_id, deleted, content in rows
+        ],
+        "has_more": has_more,
+        "next_since": rows[-1][0] if has_more else revision,
+    }
+
+def current_note_set_version():
+    with get_db_connection() as conn:
+        return get_note_set_version(conn)
+
+# Identical requests in flight for the same tenant and notes share one model call
+summarize_inflight = SingleFlight("summarize")
+ask_inflight = SingleFlight("ask")
+
+async def generate_summary():
+    """Summarize all notes from their precomputed summaries, answering an unchanged note set from the cache"""
+    # An unchanged note set is answered from the cache without reading the notes
+    version = await run_db(current_note_set_version)
+    cached = await run_db(response_cache.lookup, "summarize", summarizer.model, "", version)
+    if cached is not None:
+        return cached
+    # Concurrent requests for the same note set wait for the first one instead of summarizing again
+    return await summarize_inflight.do((current_shard().tenant_id, version), lambda: summarize_notes(version))
+
+async def summarize_notes(version):
+    """Summarize the notes as of `version` and cache the result"""
+    all_notes = await run_db(fetch_all, COMPACT_NOTES_SQL)
+    
+    if not all_notes:
+        return "No notes found to summarize. Please add some notes first."
+    
+    with stage("summarize_map_reduce"):
+        summary, _ = await summarizer.summarize(all_notes)
+    await run_db(response_cache.store, "summarize", summarizer.model, "", version, summary, [ALL_NOTES])
+    return summary
+
 @app.post("/summarize")
-def summarize():
+async def summarize():
     """Generate AI summary of all notes"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM notes")
-            all_notes = cursor.fetchall()
-            
-            if not all_notes:
-                return "No notes found to summarize. Please add some notes first."
-            
-            notes_text = " ".join([note[1] for note in all_notes])
-            
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Concisely summarize the following notes."},
-                    {"role": "user", "content": notes_text}
-                ]
-            )
-            return response.choices[0].message.content
+        return await generate_summary()
+    except UpstreamOverloaded:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating summary: {str(e)}")
 
-@app.post("/ask")
-def ask(query: Query):
-    """Ask a question about the notes using AI"""
-    try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM notes")
-            all_notes = cursor.fetchall()
-            
-            if not all_notes:
-                return "No notes found to answer your question. Please add some notes first."
-            
-            # Prepare context with note IDs for better traceability
-            context_parts = []
-            for note_id, content in all_notes:
-                context_parts.append(f"Note #{note_id}: {content}")
-            
-            context = "\n\n".join(context_parts)
-            
-            # Enhanced prompt for better responses
-            system_prompt = """You are a helpful AI assistant that answers questions based on the user's notes. 
-            Follow these guidelines:
-            1. Only answer based on the provided notes
-            2. If the information isn't in the notes, say so clearly
-            3. Be concise but informative
-            4. If multiple notes are relevant, synthesize the information
-            5. Reference note IDs when possible (e.g., "According to Note #3...")
-            6. If no relevant notes are found, suggest what kind of information might help"""
-            
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Notes:\n{context}\n\nQuestion: {query.query}"}
-                ],
-                max_tokens=500,  # Limit response length
-                temperature=0.3   # Lower temperature for more focused answers
+# Enhanced prompt for better responses
+ASK_SYSTEM_PROMPT = """You are a helpful AI assistant that answers questions based on the user's notes. 
+Follow these guidelines:
+1. Only answer based on the provided notes
+2. If the information isn't in the notes, say so clearly
+3. Be concise but informative
+4. If multiple notes are relevant, synthesize the information
+5. Reference note IDs when possible (e.g., "According to Note #3...")
+6. If no relevant notes are found, suggest what kind of information might help"""
+
+NO_NOTES_TO_ASK = "No notes found to answer your question. Please add some notes first."
+
+@dataclass
+class AskContext:
+    """Prompt for /ask plus what the response cache needs to key and invalidate it"""
+    messages: list
+    note_ids: list
+    notes_version: str
+    query_vector: object
+    usage: dict
+
+def load_ask_candidates(hits, chunk_hits):
+    """Texts for retrieved notes and chunks as (candidates, summaries, missing chunk IDs).
+
+    Candidates are (note_id, text) pairs, best match first. A long note is
+    represented by its retrieved chunks, or when only the note itself
+    matched by its summary, first chunk or preview (whichever is up to
+    date), so its body is never read here.
+    """
+    with get_db_connection() as conn:
+        chunk_ids = [chunk_id for chunk_id, _ in chunk_hits]
+        chunk_rows = {
+            chunk_id: (note_id, chunk_text(heading, content))
+            for chunk_id, note_id, heading, content in conn.execute(
+                f"SELECT id, note_id, heading, content FROM note_chunks WHERE id IN ({','.join('?' * len(chunk_ids))})",
+                chunk_ids,
             )
-            
-            return response.choices[0].message.content
-            
-    except HTTPException:
+        }
+        note_ids = [note_id for note_id, _ in hits]
+        note_rows = conn.execute(
+            f"""
+            SELECT n.id,
+                   CASE WHEN n.size > ?
+                        THEN COALESCE(summary, (SELECT content FROM note_chunks WHERE note_id = n.id AND seq = 0),
+                                      n.preview)
+                        ELSE (SELECT content FROM note_contents WHERE id = n.id) END,
+                   summary
+            FROM (SELECT n.*, {FRESH_SUMMARY_SQL} AS summary
+                  FROM notes n LEFT JOIN note_summaries s ON s.note_id = n.id) n
+            WHERE n.id IN ({','.join('?' * len(note_ids))})
+            """,
+            (NOTE_CHUNK_MIN_BYTES, *note_ids),
+        ).fetchall()
+    notes_by_id = {note_id: content for note_id, content, _ in note_rows}
+    summaries = {note_id: summary for note_id, _, summary in note_rows if summary}
+    chunked = {note_id for note_id, _ in chunk_rows.values()}
+    scored = [(score, note_id, notes_by_id[note_id]) for note_id, score in hits
+              if note_id in notes_by_id and note_id not in chunked]
+    scored += [(score, *chunk_rows[chunk_id]) for chunk_id, score in chunk_hits if chunk_id in chunk_rows]
+    scored.sort(key=lambda entry: -entry[0])
+    missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in chunk_rows]
+    return [(note_id, text) for _, note_id, text in scored], summaries, missing
+
+async def build_ask_context(question):
+    """Retrieve the most relevant notes and chunks and build the chat messages, or None if there are no notes"""
+    # Retrieve only the most relevant notes (and chunks of long notes) instead of the whole table
+    with stage("ask_retrieval"):
+        shard = current_shard()
+        query_vector = await shard.index.embed_query(question)
+        hits = await shard.index.search(question, k=ASK_CANDIDATES, query_vector=query_vector)
+        chunk_hits = await shard.chunks.index.search(question, k=ASK_CANDIDATES, query_vector=query_vector)
+    if not hits and not chunk_hits:
+        return None
+    
+    candidates, summaries, missing = await run_db(load_ask_candidates, hits, chunk_hits)
+    # Chunks replaced by an edit leave their vectors behind until they are hit
+    if missing:
+        await asyncio.to_thread(shard.chunks.index.remove_many, missing)
+    
+    # Prepare context with note IDs for better traceability, most relevant first,
+    # skipping near-duplicates and trimming long notes to fit the token budget
+    with stage("ask_prompt_build"):
+        context_parts, note_ids, usage = await asyncio.to_thread(
+            pack_notes, candidates, question, max_notes=ASK_TOP_K, model=ASK_MODEL, summaries=summaries
+        )
+        
+        context = "\n\n".join(context_parts)
+        messages = [
+            {"role": "system", "content": ASK_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Notes:\n{context}\n\nQuestion: {question}"}
+        ]
+        usage["prompt_tokens"] = count_message_tokens(messages, ASK_MODEL)
+    return AskContext(
+        messages=messages,
+        # Several chunks of one long note count once
+        note_ids=list(dict.fromkeys(note_ids)),
+        # Identifies the exact notes the answer is based on
+        notes_version=hashlib.sha256(context.encode("utf-8")).hexdigest(),
+        query_vector=query_vector,
+        usage=usage,
+    )
+
+def usage_headers(usage):
+    """Expose /ask token accounting as X-* response headers"""
+    names = {
+        "prompt_tokens": "X-Prompt-Tokens",
+        "completion_tokens": "X-Completion-Tokens",
+        "context_tokens": "X-Context-Tokens",
+        "context_budget": "X-Context-Budget",
+        "notes_included": "X-Context-Notes",
+        "notes_deduplicated": "X-Context-Notes-Deduplicated",
+        "notes_truncated": "X-Context-Notes-Truncated",
+        "cached": "X-Cache",
+    }
+    headers = {}
+    for key, header in names.items():
+        if key in usage:
+            value = usage[key]
+            headers[header] = ("hit" if value else "miss") if key == "cached" else str(value)
+    return headers
+
+# Completion settings for /ask
+ASK_MODEL = "gpt-4o-mini"
+ASK_MAX_TOKENS = 500  # Limit response length
+ASK_TEMPERATURE = 0.3  # Lower temperature for more focused answers
+
+async def answer_question(question):
+    """Answer a question from the most relevant notes, using the response cache.
+
+    Returns (answer, usage) where usage reports tokens sent and received.
+    """
+    ctx = await build_ask_context(question)
+    if ctx is None:
+        return NO_NOTES_TO_ASK, {}
+    key = (current_shard().tenant_id, response_cache.make_key("ask", ASK_MODEL, question, ctx.notes_version))
+    return await ask_inflight.do(key, lambda: complete_answer(question, ctx))
+
+async def complete_answer(question, ctx):
+    """Answer from the response cache or with one completion; returns (answer, usage)"""
+    cached = await run_db(response_cache.lookup, "ask", ASK_MODEL, question, ctx.notes_version, ctx.query_vector)
+    if cached is not None:
+        return cached, {**ctx.usage, "cached": True}
+    
+    response = await call_openai(lambda: client.chat.completions.create(
+        model=ASK_MODEL,
+        messages=ctx.messages,
+        max_tokens=ASK_MAX_TOKENS,
+        temperature=ASK_TEMPERATURE
+    ), tokens=ctx.usage["prompt_tokens"] + ASK_MAX_TOKENS, kind="ask")
+    
+    answer = response.choices[0].message.content
+    usage = response.usage
+    await run_db(
+        response_cache.store, "ask", ASK_MODEL, question, ctx.notes_version, answer, ctx.note_ids,
+        embedding=ctx.query_vector,
+        prompt_tokens=usage.prompt_tokens if usage else None,
+        completion_tokens=usage.completion_tokens if usage else None,
+    )
+    report = {**ctx.usage, "cached": False}
+    if usage:
+        report["prompt_tokens"] = usage.prompt_tokens
+        report["completion_tokens"] = usage.completion_tokens
+    else:
+        report["completion_tokens"] = count_tokens(answer, ASK_MODEL)
+    logger.info("ask usage: %s", report)
+    return answer, report
+
+@app.post("/ask")
+async def ask(query: Query, response: Response):
+    """Ask a question about the notes using AI; token usage is reported in X-* headers"""
+    try:
+        answer, usage = await answer_question(query.query)
+        response.headers.update(usage_headers(usage))
+        return answer
+    except UpstreamOverloaded:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
+
+# Server-sent events streaming
+def sse_event(event, data):
+    """Format one server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def sse_token_stream(tokens):
+    """Wrap an async iterator of text pieces as token/done/error server-sent events"""
+    try:
+        async for token in tokens:
+            yield sse_event("token", {"text": token})
+        yield sse_event("done", {})
+    except Exception as e:
+        yield sse_event("error", {"detail": str(e)})
+
+def sse_response(tokens, headers=None):
+    return StreamingResponse(
+        sse_token_stream(tokens),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **(headers or {})},
+    )
+
+async def _single_token(text):
+    yield text
+
+@app.post("/ask/stream")
+async def ask_stream(query: Query):
+    """Ask a question about the notes, streaming the answer as server-sent events.
+
+    Prompt token usage is reported in X-* headers before the first token.
+    """
+    try:
+        ctx = await build_ask_context(query.query)
+        if ctx is None:
+            return sse_response(_single_token(NO_NOTES_TO_ASK))
+        cached = await run_db(response_cache.lookup, "ask", ASK_MODEL, query.query, ctx.notes_version, ctx.query_vector)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
+    if cached is not None:
+        return sse_response(_single_token(cached), usage_headers({**ctx.usage, "cached": True}))
+    
+    # Open the stream before responding so an overloaded upstream is still reported as a 503
+    try:
+        stream = await call_openai(lambda: client.chat.completions.create(
+            model=ASK_MODEL,
+            messages=ctx.messages,
+            max_tokens=ASK_MAX_TOKENS,
+            temperature=ASK_TEMPERATURE,
+            stream=True
+        ), tokens=ctx.usage["prompt_tokens"] + ASK_MAX_TOKENS, kind="ask", stream=True)
+    except UpstreamOverloaded:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
+    
+    async def tokens():
+        parts = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        answer = "".join(parts)
+        # Streamed responses carry no usage block, so tokens are counted locally
+        await run_db(
+            response_cache.store, "ask", ASK_MODEL, query.query, ctx.notes_version, answer, ctx.note_ids,
+            embedding=ctx.query_vector,
+            prompt_tokens=ctx.usage["prompt_tokens"],
+            completion_tokens=count_tokens(answer, ASK_MODEL),
+        )
+    
+    return sse_response(tokens(), usage_headers({**ctx.usage, "cached": False}))
+
+@app.post("/summarize/stream")
+async def summarize_stream():
+    """Generate AI summary of all notes, streaming the final summary as server-sent events"""
+    try:
+        version = await run_db(current_note_set_version)
+        cached = await run_db(response_cache.lookup, "summarize", summarizer.model, "", version)
+        if cached is not None:
+            return sse_response(_single_token(cached))
+        all_notes = await run_db(fetch_all, COMPACT_NOTES_SQL)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating summary: {str(e)}")
+    if not all_notes:
+        return sse_response(_single_token("No notes found to summarize. Please add some notes first."))
+    
+    # Run the lower levels and open the root stream before responding, so overload is still a 503
+    try:
+        root = await summarizer.summarize_stream(all_notes)
+    except UpstreamOverloaded:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating summary: {str(e)}")
+    
+    async def tokens():
+        parts = []
+        async for token in root:
+            parts.append(token)
+            yield token
+        await run_db(response_cache.store, "summarize", summarizer.model, "", version, "".join(parts), [ALL_NOTES])
+    
+    return sse_response(tokens())
+
+async def create_transcription_job(audio_file):
+    """Validate, spool and split an upload into a transcription job"""
+    # Check file type
+    if not audio_file.content_type or not audio_file.content_type.startswith('audio/'):
+        raise HTTPException(status_code=400, detail="File must be an audio file")
+    try:
+        return await transcriber.create_job(audio_file)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/transcribe_audio")
 async def transcribe_audio(audio_file: UploadFile = File(...)):
-    """Transcribe audio file using OpenAI Whisper API"""
+    """Transcribe audio file using OpenAI Whisper API.
+
+    The upload is spooled to disk and split into segments that are transcribed
+    in parallel, so files over 25MB work too. Use /transcribe_audio/jobs for
+    long recordings.
+    """
     try:
-        # Check file type
-        if not audio_file.content_type.startswith('audio/'):
-            raise HTTPException(status_code=400, detail="File must be an audio file")
-        
-        # Check file size (limit to 25MB for Whisper API)
-        if audio_file.size and audio_file.size > 25 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File size must be less than 25MB")
-        
-        # Read the uploaded file
-        audio_content = await audio_file.read()
-        
-        # Create a file-like object from the audio content
-        audio_file_obj = io.BytesIO(audio_content)
-        audio_file_obj.name = audio_file.filename
-        
-        # Use OpenAI Whisper API for transcription
-        response = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file_obj
-        )
-        
-        return {"transcription": response.text}
-        
-    except HTTPException:
+        job = await create_transcription_job(audio_file)
+        try:
+            return await transcriber.run(job)
+        finally:
+            transcriber.discard(job.to_payload())
+    except (HTTPException, UpstreamOverloaded):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error transcribing audio: {str(e)}")
+
+@app.post("/transcribe_audio/jobs", status_code=202)
+async def submit_transcription_job(audio_file: UploadFile = File(...)):
+    """Start transcribing in the background; poll GET /transcribe_audio/jobs/{job_id} for progress"""
+    try:
+        job = await create_transcription_job(audio_file)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error preparing audio: {str(e)}")
+    return await job_queue.submit("transcribe", job.to_payload(), progress=job.progress(),
+                                  tenant=current_shard().tenant_id)
+
+@app.get("/transcribe_audio/jobs/{job_id}")
+async def get_transcription_job(job_id: str):
+    """Job status and segment progress, plus the stitched transcript once completed"""
+    return await get_job(job_id)
+
+@app.post("/transcribe_audio/jobs/{job_id}/resume", status_code=202)
+async def resume_transcription_job(job_id: str):
+    """Retry a failed job; segments that were already transcribed are not sent again"""
+    job = await job_queue.retry(job_id, tenant=current_shard().tenant_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != "queued":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}, only failed jobs can be resumed")
+    return job
+
+# Background jobs
+# Handlers that read notes run against the shard of the tenant that submitted the job
+async def run_summarize_job(payload, ctx):
+    async with tenants.use(ctx.tenant):
+        return {"summary": await generate_summary()}
+
+async def run_ask_job(payload, ctx):
+    async with tenants.use(ctx.tenant):
+        answer, usage = await answer_question(payload["query"])
+    return {"answer": answer, "usage": usage}
+
+async def run_transcribe_job(payload, ctx):
+    job = TranscriptionJob.from_payload(payload, ctx.checkpoint)
+    lock = asyncio.Lock()
+
+    async def on_segment(job):
+        # Checkpoint transcripts as they arrive so a restart only redoes missing segments
+        async with lock:
+            await ctx.report(job.progress(), checkpoint=dict(job.texts))
+
+    return await transcriber.run(job, on_segment=on_segment)
+
+# Questions are short and someone is usually waiting, so they get their own lane
+job_queue.register("ask", run_ask_job, lane="interactive")
+job_queue.register("summarize", run_summarize_job, lane="batch")
+job_queue.register("transcribe", run_transcribe_job, lane="batch", cleanup=transcriber.discard)
+
+# Job kinds that can be submitted through POST /jobs, with their payload models
+SUBMITTABLE_JOBS = {"ask": Query, "summarize": None}
+
+class JobRequest(BaseModel):
+    kind: str = Field(description="Job kind: ask or summarize")
+    payload: dict = Field(default_factory=dict, description="Job input, e.g. {\"query\": ...} for ask")
+    priority: int = Field(default=0, description="Higher priorities run first within a lane")
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: JobRequest):
+    """Queue an AI operation; poll GET /jobs/{job_id} and fetch GET /jobs/{job_id}/result"""
+    if request.kind not in SUBMITTABLE_JOBS:
+        raise HTTPException(status_code=400, detail=f"Unknown job kind: {request.kind}")
+    payload = {}
+    model = SUBMITTABLE_JOBS[request.kind]
+    if model is not None:
+        try:
+            payload = model.model_validate(request.payload).model_dump()
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    return await job_queue.submit(request.kind, payload, priority=request.priority, tenant=current_shard().tenant_id)
+
+@app.get("/jobs/metrics")
+async def job_metrics():
+    """Queue depth and running jobs per lane, plus per-kind outcomes and queue wait"""
+    return await job_queue.metrics()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Job status and progress, plus the result once completed"""
+    job = await job_queue.get(job_id, include_result=True, tenant=current_shard().tenant_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, response: Response):
+    """The job's result; 202 while it is still queued or running, 409 if it failed or was cancelled"""
+    job = await job_queue.get(job_id, include_result=True, tenant=current_shard().tenant_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] in ("queued", "running"):
+        response.status_code = 202
+        return job
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Job {job['status']}: {job['error'] or 'no result'}")
+    return job["result"]
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job; finished jobs are returned unchanged"""
+    job = await job_queue.cancel(job_id, tenant=current_shard().tenant_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
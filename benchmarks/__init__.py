@@ -0,0 +1 @@
+"""Load-testing tools for the notes API (run against a local fake OpenAI server)."""
@@ -0,0 +1,164 @@
+"""Local stand-in for the OpenAI API with configurable latency.
+
+Run it and point the notes API at it:
+
+    python -m benchmarks.fake_openai --port 9000 --latency-ms 800
+    OPENAI_BASE_URL=http://localhost:9000/v1 OPENAI_API_KEY=fake uvicorn app:app
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY_MS = float(os.getenv("FAKE_OPENAI_LATENCY_MS", "500"))
+JITTER_MS = float(os.getenv("FAKE_OPENAI_JITTER_MS", "50"))
+# Delay between streamed tokens (stream=True); LATENCY_MS is the time to first token
+TOKEN_MS = float(os.getenv("FAKE_OPENAI_TOKEN_MS", "20"))
+# Requests served at once before answering 429 like a saturated account (0 = unlimited)
+MAX_CONCURRENCY = int(os.getenv("FAKE_OPENAI_MAX_CONCURRENCY", "0"))
+# Longest embedding input accepted; like the real API, one longer input fails the whole request with a 400
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+
+app = FastAPI(title="Fake OpenAI")
+_in_flight = 0
+
+@app.middleware("http")
+async def concurrency_ceiling(request: Request, call_next):
+    global _in_flight
+    if MAX_CONCURRENCY and _in_flight >= MAX_CONCURRENCY:
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+            headers={"retry-after": "1"},
+        )
+    _in_flight += 1
+    try:
+        return await call_next(request)
+    finally:
+        _in_flight -= 1
+
+async def _simulate_latency():
+    await asyncio.sleep(max(0.0, LATENCY_MS + random.uniform(-JITTER_MS, JITTER_MS)) / 1000)
+
+def _count_tokens(text):
+    return len(text) // 4 + 1
+
+def _fake_embedding(text, dim):
+    # Deterministic pseudo-random unit-ish vector seeded by the text
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    rng = random.Random(seed)
+    return [rng.uniform(-1, 1) for _ in range(dim)]
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await _simulate_latency()
+    prompt = " ".join(str(message.get("content", "")) for message in body.get("messages", []))
+    content = f"Fake answer based on {len(prompt)} characters of prompt."
+    if body.get("stream"):
+        return StreamingResponse(_stream_chunks(body.get("model", "gpt-4o-mini"), content), media_type="text/event-stream")
+    prompt_tokens = _count_tokens(prompt)
+    completion_tokens = _count_tokens(content)
+    return {
+        "id": f"chatcmpl-fake-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+async def _stream_chunks(model, content):
+    chunk_id = f"chatcmpl-fake-{time.time_ns()}"
+    words = content.split(" ")
+    for i, word in enumerate(words):
+        piece = word if i == 0 else " " + word
+        chunk = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+        await asyncio.sleep(TOKEN_MS / 1000)
+    final = {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+    }
+    yield f"data: {json.dumps(final)}\n\n"
+    yield "data: [DONE]\n\n"
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    await _simulate_latency()
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    if any(_count_tokens(text) > EMBEDDING_MAX_INPUT_TOKENS for text in inputs):
+        return JSONResponse(
+            status_code=400,
+            content={"error": {"message": f"Input exceeds the maximum of {EMBEDDING_MAX_INPUT_TOKENS} tokens",
+                               "type": "invalid_request_error", "code": None}},
+        )
+    dim = body.get("dimensions") or 1536
+    return {
+        "object": "list",
+        "model": body.get("model", "text-embedding-3-small"),
+        "data": [
+            {"object": "embedding", "index": i, "embedding": _fake_embedding(text, dim)}
+            for i, text in enumerate(inputs)
+        ],
+        "usage": {"prompt_tokens": sum(map(_count_tokens, inputs)), "total_tokens": sum(map(_count_tokens, inputs))},
+    }
+
+@app.get("/v1/models")
+async def models():
+    return {
+        "object": "list",
+        "data": [{"id": model, "object": "model", "created": 0, "owned_by": "fake"}
+                 for model in ("gpt-4o-mini", "text-embedding-3-small", "whisper-1")],
+    }
+
+@app.post("/v1/audio/transcriptions")
+async def transcriptions(request: Request):
+    form = await request.form()
+    upload = form.get("file")
+    size = len(await upload.read()) if upload is not None else 0
+    await _simulate_latency()
+    return {"text": f"Fake transcription of {size} bytes."}
+
+def main():
+    global LATENCY_MS, JITTER_MS, TOKEN_MS, MAX_CONCURRENCY
+    parser = argparse.ArgumentParser(description="Run a local fake OpenAI server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=LATENCY_MS)
+    parser.add_argument("--jitter-ms", type=float, default=JITTER_MS)
+    parser.add_argument("--token-ms", type=float, default=TOKEN_MS)
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY)
+    args = parser.parse_args()
+    LATENCY_MS, JITTER_MS, TOKEN_MS = args.latency_ms, args.jitter_ms, args.token_ms
+    MAX_CONCURRENCY = args.max_concurrency
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
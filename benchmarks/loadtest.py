@@ -0,0 +1,255 @@
+"""Concurrent load generator for the notes API.
+
+Drives a weighted mix of endpoints with N concurrent clients for a fixed
+duration and prints throughput and latency per endpoint, plus the server's
+peak RSS (read from /metrics):
+
+    python -m benchmarks.loadtest --base-url http://localhost:8000 \
+        --concurrency 50 --duration 30 --mix ask=1,add_note=2,get_notes=4
+
+Use --save to write the report as JSON and --baseline to compare a run
+against an earlier one; regressions beyond --tolerance exit non-zero.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import random
+import re
+import statistics
+import struct
+import subprocess
+import time
+import wave
+
+import httpx
+
+WORDS = "project meeting budget groceries travel idea deadline report design review".split()
+
+def _random_text(words=30):
+    return " ".join(random.choice(WORDS) for _ in range(words))
+
+def make_wav(seconds=2.0, rate=16000):
+    """A short 16-bit mono tone, enough to exercise the transcription pipeline"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(b"".join(
+            struct.pack("<h", int(8000 * math.sin(2 * math.pi * 440 * i / rate))) for i in range(int(seconds * rate))
+        ))
+    return buffer.getvalue()
+
+class Target:
+    """What the request functions need to know about the server under test"""
+
+    def __init__(self, max_note_id=1):
+        self.max_note_id = max(1, max_note_id)
+        self.audio = make_wav()
+
+    def note_id(self):
+        return random.randint(1, self.max_note_id)
+
+async def _read_stream(c, path, body):
+    async with c.stream("POST", path, json=body) as response:
+        await response.aread()
+        return response
+
+def _bulk_body():
+    return "\n".join(json.dumps({"content": _random_text()}) for _ in range(50))
+
+# One request per endpoint name; each returns an awaitable httpx response
+REQUESTS = {
+    "add_note": lambda c, t: c.post("/add_note", json={"content": _random_text()}),
+    "add_notes_bulk": lambda c, t: c.post(
+        "/add_notes/bulk", content=_bulk_body(), headers={"Content-Type": "application/x-ndjson"}
+    ),
+    "edit_note": lambda c, t: c.put(f"/edit_note/{t.note_id()}", json={"content": _random_text()}),
+    "delete_note": lambda c, t: c.delete(f"/delete_note/{t.note_id()}"),
+    "get_notes": lambda c, t: c.get("/get_notes", params={"limit": 50}),
+    "get_notes_page": lambda c, t: c.get(
+        "/get_notes", params={"limit": 50, "after_id": t.note_id(), "fields": "preview"}
+    ),
+    "search": lambda c, t: c.get("/search", params={"q": random.choice(WORDS)}),
+    "ask": lambda c, t: c.post("/ask", json={"query": f"What did I write about {random.choice(WORDS)}?"}),
+    "ask_stream": lambda c, t: _read_stream(
+        c, "/ask/stream", {"query": f"What did I write about {random.choice(WORDS)}?"}
+    ),
+    "summarize": lambda c, t: c.post("/summarize"),
+    "summarize_stream": lambda c, t: _read_stream(c, "/summarize/stream", None),
+    "transcribe_audio": lambda c, t: c.post(
+        "/transcribe_audio", files={"audio_file": ("bench.wav", t.audio, "audio/wav")}
+    ),
+}
+
+# Random IDs may already be deleted, so a 404 is an expected outcome for these
+NOT_FOUND_OK = {"edit_note", "delete_note"}
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in REQUESTS:
+            raise SystemExit(f"Unknown endpoint in mix: {name} (choose from {', '.join(REQUESTS)})")
+        weights[name] = float(weight or 1)
+    return weights
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+async def _worker(client, target, weights, deadline, results):
+    names, probabilities = list(weights), list(weights.values())
+    while time.perf_counter() < deadline:
+        name = random.choices(names, probabilities)[0]
+        start = time.perf_counter()
+        try:
+            response = await REQUESTS[name](client, target)
+            ok = response.status_code < 400 or (response.status_code == 404 and name in NOT_FOUND_OK)
+        except httpx.HTTPError:
+            ok = False
+        results.setdefault(name, []).append((time.perf_counter() - start, ok))
+
+async def _newest_note_id(client):
+    response = await client.get("/get_notes", params={"limit": 1, "fields": "preview"})
+    notes = response.json() if response.status_code == 200 else []
+    # Rows are [id, text] pairs, newest first
+    return notes[0][0] if notes else 1
+
+async def scrape_server_metrics(client):
+    """Process memory gauges from the server's /metrics endpoint (None if unavailable)"""
+    try:
+        text = (await client.get("/metrics")).text
+    except httpx.HTTPError:
+        return {}
+    values = {}
+    for name in ("process_resident_memory_bytes", "process_peak_rss_bytes"):
+        match = re.search(rf"^{name}(?:{{[^}}]*}})? (\S+)$", text, re.MULTILINE)
+        if match:
+            values[name] = float(match.group(1))
+    return values
+
+async def run(base_url, concurrency, duration, weights, timeout=120.0):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        target = Target(await _newest_note_id(client))
+        results = {}
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*(_worker(client, target, weights, deadline, results) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        server = await scrape_server_metrics(client)
+    report = summarize_results(results, elapsed)
+    if "process_peak_rss_bytes" in server:
+        report["server_peak_rss_mb"] = round(server["process_peak_rss_bytes"] / 2 ** 20, 1)
+    if "process_resident_memory_bytes" in server:
+        report["server_rss_mb"] = round(server["process_resident_memory_bytes"] / 2 ** 20, 1)
+    report["config"] = {"concurrency": concurrency, "duration_s": duration, "mix": weights}
+    return report
+
+def summarize_results(results, elapsed):
+    report = {"elapsed_s": round(elapsed, 3), "endpoints": {}}
+    total = 0
+    for name, samples in sorted(results.items()):
+        latencies = [latency * 1000 for latency, _ in samples]
+        errors = sum(1 for _, ok in samples if not ok)
+        total += len(samples)
+        report["endpoints"][name] = {
+            "requests": len(samples),
+            "errors": errors,
+            "rps": round(len(samples) / elapsed, 2),
+            "mean_ms": round(statistics.fmean(latencies), 2),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+        }
+    report["total_requests"] = total
+    report["total_rps"] = round(total / elapsed, 2)
+    return report
+
+def print_report(report):
+    print(f"{'endpoint':<12} {'reqs':>7} {'errs':>5} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stats in report["endpoints"].items():
+        print(f"{name:<12} {stats['requests']:>7} {stats['errors']:>5} {stats['rps']:>8} "
+              f"{stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+    print(f"total: {report['total_requests']} requests in {report['elapsed_s']}s ({report['total_rps']} req/s)")
+    if "server_peak_rss_mb" in report:
+        print(f"server peak RSS: {report['server_peak_rss_mb']} MB")
+
+# Baselines
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save_report(report, path):
+    data = {"revision": git_revision(), "created_at": time.time(), **report}
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+def compare_reports(baseline, current, tolerance=0.10):
+    """Per-endpoint changes against a baseline; returns (rows, regressions).
+
+    A regression is a latency percentile or peak RSS that grew, or throughput
+    that fell, by more than `tolerance` (a fraction).
+    """
+    rows = []
+    regressions = []
+
+    def check(name, metric, old, new, higher_is_worse=True):
+        if old is None or new is None:
+            return
+        change = (new - old) / old if old else 0.0
+        worse = change > tolerance if higher_is_worse else change < -tolerance
+        rows.append((name, metric, old, new, change, worse))
+        if worse:
+            regressions.append(f"{name} {metric}: {old} -> {new} ({change:+.0%})")
+
+    for name, stats in current["endpoints"].items():
+        old = baseline.get("endpoints", {}).get(name)
+        if old is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            check(name, metric, old.get(metric), stats.get(metric))
+        check(name, "rps", old.get("rps"), stats.get("rps"), higher_is_worse=False)
+    check("server", "peak_rss_mb", baseline.get("server_peak_rss_mb"), current.get("server_peak_rss_mb"))
+    return rows, regressions
+
+def print_comparison(rows, regressions):
+    print(f"{'endpoint':<16} {'metric':<12} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, metric, old, new, change, worse in rows:
+        flag = "  REGRESSION" if worse else ""
+        print(f"{name:<16} {metric:<12} {old:>10} {new:>10} {change:>+8.0%}{flag}")
+    print(f"{len(regressions)} regression(s)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the notes API")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--mix", default="ask=1,add_note=2,get_notes=4")
+    parser.add_argument("--save", help="write the report as JSON to this path")
+    parser.add_argument("--baseline", help="compare against a report saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed fractional change (default 0.10)")
+    args = parser.parse_args()
+    report = asyncio.run(run(args.base_url, args.concurrency, args.duration, parse_mix(args.mix)))
+    print_report(report)
+    if args.save:
+        save_report(report, args.save)
+    if args.baseline:
+        with open(args.baseline) as f:
+            rows, regressions = compare_reports(json.load(f), report, args.tolerance)
+        print_comparison(rows, regressions)
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
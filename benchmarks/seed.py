@@ -0,0 +1,81 @@
+"""Seed a notes database with a reproducible synthetic corpus.
+
+Rows are written straight to SQLite in large transactions, so a million
+notes take seconds rather than the hours the HTTP API would need. The API
+builds its derived state (search index, vector index, note summaries) on
+its next startup:
+
+    python -m benchmarks.seed --db bench.db --notes 100000
+    NOTES_DB_PATH=bench.db uvicorn app:app
+"""
+import argparse
+import random
+import sqlite3
+import time
+
+from note_store import init_note_store, insert_notes, register_functions
+
+TOPICS = {
+    "work": "project meeting budget deadline report review roadmap launch client milestone sprint hiring",
+    "home": "groceries milk eggs bread laundry rent plumber garden dinner recipe repair",
+    "travel": "flight hotel passport itinerary museum train booking beach visa luggage",
+    "ideas": "startup design prototype research experiment feature sketch podcast novel",
+    "health": "gym run doctor sleep vitamins yoga appointment diet steps",
+}
+FILLER = "the a and to with for on about after before next this that some more".split()
+
+def make_note(rng):
+    """One note of 5-200 words around a topic; lengths are skewed towards short notes"""
+    words = TOPICS[rng.choice(list(TOPICS))].split()
+    length = min(200, int(rng.paretovariate(1.2) * 5))
+    sentences = []
+    while sum(len(s.split()) for s in sentences) < length:
+        sentence = [rng.choice(words if rng.random() < 0.6 else FILLER) for _ in range(rng.randint(4, 12))]
+        sentences.append(" ".join(sentence).capitalize() + ".")
+    if rng.random() < 0.05:
+        sentences.append(f"Follow up on {rng.randint(1, 31)}/{rng.randint(1, 12)}.")
+    return " ".join(sentences)
+
+def seed(path, count, seed_value=0, batch_size=10000, duplicate_rate=0.02):
+    """Append `count` notes to the database at `path`; returns the number written.
+
+    A small share of notes repeats an earlier one so deduplication has work to do.
+    """
+    rng = random.Random(seed_value)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    # The search triggers of a database the API already opened decode bodies through note_body()
+    register_functions(conn)
+    # Same note storage as app.init_db; the remaining tables are created by the API on startup
+    init_note_store(conn)
+    recent = []
+    written = 0
+    while written < count:
+        batch = []
+        for _ in range(min(batch_size, count - written)):
+            if recent and rng.random() < duplicate_rate:
+                content = rng.choice(recent)
+            else:
+                content = make_note(rng)
+                if len(recent) < 1000:
+                    recent.append(content)
+            batch.append(content)
+        with conn:
+            insert_notes(conn, batch)
+        written += len(batch)
+    conn.close()
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a notes database with synthetic notes")
+    parser.add_argument("--db", default="bench.db")
+    parser.add_argument("--notes", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    written = seed(args.db, args.notes, args.seed)
+    print(f"Wrote {written} notes to {args.db} in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
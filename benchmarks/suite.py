@@ -0,0 +1,151 @@
+"""Reproducible benchmark suite: seed corpora of several sizes and load-test each.
+
+For every corpus size a fresh database is seeded, the API is started
+against the local fake OpenAI server, and the same endpoint mix is driven
+with the same concurrency. Results for all sizes are written as one JSON
+file that later runs can be compared against:
+
+    python -m benchmarks.suite --sizes 1000,10000,100000 --output baseline.json
+    python -m benchmarks.suite --sizes 1000,10000,100000 --baseline baseline.json
+
+No network access or API key is needed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.loadtest import compare_reports, git_revision, parse_mix, print_comparison, print_report, run
+from benchmarks.seed import seed
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = (
+    "add_note=4,add_notes_bulk=1,edit_note=2,delete_note=1,get_notes=8,get_notes_page=4,search=6,"
+    "ask=2,ask_stream=1,summarize=1,summarize_stream=1,transcribe_audio=1"
+)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until_ready(url, timeout):
+    """Poll url until it answers 200; the API syncs its indexes before accepting requests"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} was not ready after {timeout}s")
+
+def start_process(args, env=None, log_path=None):
+    log = open(log_path, "wb") if log_path else subprocess.DEVNULL
+    return subprocess.Popen(args, cwd=REPO_ROOT, env={**os.environ, **(env or {})}, stdout=log, stderr=subprocess.STDOUT)
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def run_size(size, args, fake_url, workdir):
+    db_path = os.path.join(workdir, f"notes-{size}.db")
+    start = time.perf_counter()
+    seed(db_path, size, seed_value=args.seed)
+    seed_seconds = time.perf_counter() - start
+
+    port = free_port()
+    env = {
+        "NOTES_DB_PATH": db_path,
+        "OPENAI_BASE_URL": fake_url,
+        "OPENAI_API_KEY": "fake",
+        "EMBEDDING_BACKEND": args.embedding_backend,
+        "PORT": str(port),
+        "WEB_CONCURRENCY": str(args.workers),
+    }
+    server = start_process([sys.executable, "serve.py"], env, os.path.join(workdir, f"server-{size}.log"))
+    try:
+        start = time.perf_counter()
+        # With several workers this only shows one is ready; the rest finish startup right after it
+        wait_until_ready(f"http://127.0.0.1:{port}/ready", args.startup_timeout)
+        startup_seconds = time.perf_counter() - start
+        report = asyncio.run(run(f"http://127.0.0.1:{port}", args.concurrency, args.duration, parse_mix(args.mix)))
+    finally:
+        stop_process(server)
+    report["seed_s"] = round(seed_seconds, 2)
+    report["startup_s"] = round(startup_seconds, 2)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed corpora of several sizes and load-test each one")
+    parser.add_argument("--sizes", default="1000,10000", help="comma-separated corpus sizes (up to 1000000)")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=300, help="fake OpenAI time to first token")
+    parser.add_argument("--token-ms", type=float, default=10, help="fake OpenAI delay between streamed tokens")
+    parser.add_argument("--embedding-backend", default="hashing", choices=("hashing", "openai"))
+    parser.add_argument("--workers", type=int, default=1, help="API worker processes (see serve.py)")
+    parser.add_argument("--startup-timeout", type=float, default=900)
+    parser.add_argument("--workdir", help="keep databases and server logs here (default: a temporary directory)")
+    parser.add_argument("--output", help="write all results as JSON to this path")
+    parser.add_argument("--baseline", help="compare against an earlier --output file")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="notes-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    fake_port = free_port()
+    fake = start_process(
+        [sys.executable, "-m", "benchmarks.fake_openai", "--port", str(fake_port),
+         "--latency-ms", str(args.latency_ms), "--token-ms", str(args.token_ms)],
+        log_path=os.path.join(workdir, "fake_openai.log"),
+    )
+    results = {
+        "revision": git_revision(),
+        "created_at": time.time(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "workdir")},
+        "sizes": {},
+    }
+    try:
+        wait_until_ready(f"http://127.0.0.1:{fake_port}/docs", 30)
+        for size in (int(value) for value in args.sizes.split(",")):
+            print(f"== {size} notes ==")
+            report = run_size(size, args, f"http://127.0.0.1:{fake_port}/v1", workdir)
+            results["sizes"][str(size)] = report
+            print_report(report)
+            print(f"seeded in {report['seed_s']}s, server ready in {report['startup_s']}s\n")
+    finally:
+        stop_process(fake)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = []
+        for size, report in results["sizes"].items():
+            if size not in baseline.get("sizes", {}):
+                continue
+            print(f"== {size} notes vs baseline {baseline.get('revision')} ==")
+            rows, found = compare_reports(baseline["sizes"][size], report, args.tolerance)
+            print_comparison(rows, found)
+            regressions.extend(found)
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import time
+
+def init_change_log(conn):
+    """Create the note change log and the triggers that keep it in sync.
+
+    Every note has one row holding the revision of its latest change; a
+    write replaces the row, so it moves to a new, higher revision. Deleted
+    notes keep a tombstone row so clients that synced earlier learn about
+    the delete. The current revision is the highest rev in the table.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_changes'")
+    exists = cursor.fetchone() is not None
+    # AUTOINCREMENT guarantees revisions are never reused, even after the newest row is replaced
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS note_changes (
+            rev INTEGER PRIMARY KEY AUTOINCREMENT,
+            note_id INTEGER NOT NULL UNIQUE,
+            deleted INTEGER NOT NULL,
+            changed_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_changes_insert AFTER INSERT ON notes BEGIN
+            INSERT OR REPLACE INTO note_changes (note_id, deleted, changed_at)
+            VALUES (new.id, 0, (julianday('now') - 2440587.5) * 86400.0);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_changes_update AFTER UPDATE OF body_hash ON notes BEGIN
+            INSERT OR REPLACE INTO note_changes (note_id, deleted, changed_at)
+            VALUES (new.id, 0, (julianday('now') - 2440587.5) * 86400.0);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_changes_delete AFTER DELETE ON notes BEGIN
+            INSERT OR REPLACE INTO note_changes (note_id, deleted, changed_at)
+            VALUES (old.id, 1, (julianday('now') - 2440587.5) * 86400.0);
+        END
+    ''')
+    if not exists:
+        # Record notes written before the change log existed
+        cursor.execute(
+            "INSERT INTO note_changes (note_id, deleted, changed_at) SELECT id, 0, ? FROM notes ORDER BY id",
+            (time.time(),),
+        )
+    conn.commit()
+
+def get_revision(conn):
+    """Revision of the latest committed note write (0 for a database that was never written)"""
+    return conn.execute("SELECT COALESCE(MAX(rev), 0) FROM note_changes").fetchone()[0]
+
+def get_changes(conn, since, limit):
+    """Return (revision, changes, has_more) for writes after revision `since`, oldest first.
+
+    Changes are (rev, note_id, deleted, content) with content None for
+    tombstones. Only changes up to the revision read first are returned, so a
+    client that stores `revision` (or the last rev while has_more) never skips
+    a write that commits concurrently.
+    """
+    revision = get_revision(conn)
+    rows = conn.execute(
+        '''
+        SELECT c.rev, c.note_id, c.deleted, n.content
+        FROM note_changes c LEFT JOIN note_contents n ON n.id = c.note_id AND c.deleted = 0
+        WHERE c.rev > ? AND c.rev <= ?
+        ORDER BY c.rev
+        LIMIT ?
+        ''',
+        (since, revision, limit + 1),
+    ).fetchall()
+    return revision, rows[:limit], len(rows) > limit
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value names `etag` (or is '*')"""
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    # Weak comparison: W/"x" matches "x"
+    return "*" in candidates or etag in (value.removeprefix("W/") for value in candidates)
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+
+from metrics import COALESCED_REQUESTS, UPSTREAM_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+def _consume_exception(future):
+    # Avoid "exception was never retrieved" when every caller went away
+    if not future.cancelled():
+        future.exception()
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls: one call runs per key, every caller gets its result.
+
+    The shared call is shielded, so a caller that is cancelled (e.g. a client
+    disconnect) does not cancel it for the others.
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def do(self, key, make_awaitable):
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(make_awaitable())
+            self._inflight[key] = future
+            future.add_done_callback(_consume_exception)
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            COALESCED_REQUESTS.inc(kind=self.kind)
+        return await asyncio.shield(future)
+
+
+class MicroBatcher:
+    """Collects items submitted within a short window into one batched call.
+
+    process_batch(items) -> results (same order). A batch is sent when
+    max_batch items are waiting or max_wait seconds after the first one
+    arrived. Identical items that are waiting or in flight share one result.
+
+    When a batch fails with an error for which is_item_error(error) is true
+    (the upstream rejected some input), it is bisected and retried so only
+    the callers whose own item is rejected get the error.
+    """
+
+    def __init__(self, process_batch, kind, max_batch=256, max_wait=0.005, is_item_error=None):
+        self.process_batch = process_batch
+        self.kind = kind
+        self.is_item_error = is_item_error
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._waiting = []
+        self._futures = {}
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, item):
+        future = self._futures.get(item)
+        if future is not None:
+            COALESCED_REQUESTS.inc(kind=self.kind)
+            return await asyncio.shield(future)
+        future = self._futures[item] = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        self._waiting.append(item)
+        if len(self._waiting) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await asyncio.shield(future)
+
+    async def submit_many(self, items):
+        return await asyncio.gather(*(self.submit(item) for item in items))
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiting:
+            batch, self._waiting = self._waiting[:self.max_batch], self._waiting[self.max_batch:]
+            task = asyncio.ensure_future(self._run(batch))
+            # Keep a reference so the task is not garbage collected mid-flight
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, batch):
+        """(error, result) per item; a batch rejected because of some of its items is split until they are found"""
+        try:
+            results = await self.process_batch(batch)
+        except Exception as e:
+            if self.is_item_error is None or not self.is_item_error(e):
+                raise
+            if len(batch) == 1:
+                return [(e, None)]
+            logger.info("%s batch of %d rejected (%s), retrying in halves", self.kind, len(batch), e)
+            half = len(batch) // 2
+            first, second = await asyncio.gather(self._resolve(batch[:half]), self._resolve(batch[half:]))
+            return first + second
+        if len(results) != len(batch):
+            raise ValueError(f"Batch of {len(batch)} returned {len(results)} results")
+        return [(None, result) for result in results]
+
+    async def _run(self, batch):
+        UPSTREAM_BATCH_SIZE.observe(len(batch), kind=self.kind)
+        try:
+            outcomes = await self._resolve(batch)
+        except BaseException as e:
+            # Fail (or on cancellation, cancel) every caller waiting on this batch
+            for item in batch:
+                future = self._futures.pop(item)
+                if not future.done():
+                    if isinstance(e, Exception):
+                        future.set_exception(e)
+                    else:
+                        future.cancel()
+            if not isinstance(e, Exception):
+                raise
+            return
+        for item, (error, result) in zip(batch, outcomes):
+            future = self._futures.pop(item)
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
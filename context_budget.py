@@ -0,0 +1,239 @@
+import functools
+import hashlib
+import logging
+import os
+import re
+
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:  # required; without it startup fails unless ALLOW_TOKEN_ESTIMATE is set
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Context budgeting settings (overridable through environment variables)
+ASK_CONTEXT_TOKENS = int(os.getenv("ASK_CONTEXT_TOKENS", "3000"))
+ASK_NOTE_MAX_TOKENS = int(os.getenv("ASK_NOTE_MAX_TOKENS", "600"))
+# Estimated Jaccard similarity above which a note counts as a duplicate
+ASK_DEDUP_THRESHOLD = float(os.getenv("ASK_DEDUP_THRESHOLD", "0.8"))
+# Notes that would get fewer tokens than this are dropped rather than cut to a stub
+MIN_NOTE_TOKENS = 32
+# Chat format overhead per message and per reply (role markers and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+# Budget with a conservative estimate when tiktoken is not installed (for tests and local tools only)
+ALLOW_TOKEN_ESTIMATE = os.getenv("ALLOW_TOKEN_ESTIMATE", "").lower() in ("1", "true", "yes")
+
+MINHASH_PERMUTATIONS = 64
+SHINGLE_WORDS = 3
+# 31-bit prime keeps (a * x + b) within uint64 without overflow
+_MERSENNE_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(1)
+_PERM_A = _rng.integers(1, _MERSENNE_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.integers(0, _MERSENNE_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+
+# Token counting
+TOKENIZER = "tiktoken" if tiktoken is not None else "estimate"
+# Pieces the estimate counts: single CJK characters, words, and punctuation marks
+_CJK = r"\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_ESTIMATE_RE = re.compile(rf"[{_CJK}]|[^\W{_CJK}]+|[^\w\s]")
+
+def check_tokenizer():
+    """Fail startup without tiktoken, unless the estimate was explicitly allowed"""
+    if tiktoken is None:
+        if not ALLOW_TOKEN_ESTIMATE:
+            raise RuntimeError("tiktoken is not installed; install it (see requirements.txt) "
+                               "or set ALLOW_TOKEN_ESTIMATE=1 to budget with an estimate")
+        logger.warning("tiktoken is not installed; token budgets use an estimate (ALLOW_TOKEN_ESTIMATE)")
+    return TOKENIZER
+
+def _estimate_step(piece):
+    # Characters per estimated token: English words split into ~4-character BPE pieces, other scripts
+    # into shorter ones, and a CJK character (matched alone) is about a token of its own
+    return 4 if piece.isascii() else 2
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def count_tokens(text, model="gpt-4o-mini"):
+    """Count tokens with tiktoken, or with the conservative estimate when that was allowed"""
+    if tiktoken is not None:
+        return len(_encoding(model).encode(text, disallowed_special=()))
+    return sum(len(piece) // _estimate_step(piece) + 1 for piece in _ESTIMATE_RE.findall(text))
+
+def _token_starts(text, model):
+    """Character offset at which each token of text starts"""
+    if tiktoken is not None:
+        encoding = _encoding(model)
+        return encoding.decode_with_offsets(encoding.encode(text, disallowed_special=()))[1]
+    # The pieces count_tokens estimates: slices of words, CJK characters and punctuation
+    starts = []
+    for match in _ESTIMATE_RE.finditer(text):
+        step = _estimate_step(match.group())
+        starts.extend(match.start() + offset for offset in range(0, len(match.group()) // step * step + 1, step))
+    return starts
+
+def split_tokens(text, max_tokens, model="gpt-4o-mini"):
+    """Cut text into consecutive pieces of at most max_tokens tokens each.
+
+    A piece ends at whitespace when that keeps at least three quarters of
+    it; a word or a run of text without spaces (CJK, base64, long CSV
+    rows) longer than max_tokens is cut inside.
+    """
+    starts = _token_starts(text, model)
+    pieces, first = [], 0
+    while first < len(starts):
+        last = min(first + max_tokens, len(starts))
+        if last < len(starts):
+            for cut in range(last, first + max_tokens * 3 // 4, -1):
+                if starts[cut] > 0 and text[starts[cut] - 1].isspace():
+                    last = cut
+                    break
+        piece = text[starts[first]:starts[last] if last < len(starts) else len(text)]
+        # A piece can tokenize slightly differently once cut out of its context
+        while last > first + 1 and count_tokens(piece, model) > max_tokens:
+            last -= 1
+            piece = text[starts[first]:starts[last]]
+        if piece.strip():
+            pieces.append(piece.strip())
+        first = last
+    return pieces
+
+def truncate_tokens(text, max_tokens, model="gpt-4o-mini"):
+    """The beginning of text, at most max_tokens tokens long"""
+    pieces = split_tokens(text, max_tokens, model) if max_tokens > 0 else []
+    return pieces[0] if pieces else ""
+
+def tail_tokens(text, max_tokens, model="gpt-4o-mini"):
+    """The end of text, at most max_tokens tokens long, starting at a word where possible"""
+    starts = _token_starts(text, model)
+    if max_tokens <= 0:
+        return ""
+    if len(starts) <= max_tokens:
+        return text.strip()
+    first = len(starts) - max_tokens
+    for cut in range(first, first + max_tokens // 4):
+        if starts[cut] > 0 and text[starts[cut] - 1].isspace():
+            first = cut
+            break
+    return text[starts[first]:].strip()
+
+def count_message_tokens(messages, model="gpt-4o-mini"):
+    """Prompt tokens for a chat request, including the per-message framing"""
+    return sum(count_tokens(message["content"], model) + MESSAGE_OVERHEAD_TOKENS for message in messages) \
+        + REPLY_OVERHEAD_TOKENS
+
+
+# Near-duplicate detection
+def minhash(text):
+    """MinHash signature over word shingles; equal slots estimate Jaccard similarity"""
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") % _MERSENNE_PRIME
+         for s in shingles],
+        dtype=np.uint64,
+    )
+    # One universal hash (a * x + b) mod p per permutation, vectorized over shingles
+    return ((hashes[:, None] * _PERM_A + _PERM_B) % _MERSENNE_PRIME).min(axis=0)
+
+def estimated_similarity(a, b):
+    return float(np.mean(a == b))
+
+
+# Relevant-span truncation
+def _spans(text):
+    """Split a note into sentences (or lines) that can be kept or dropped individually"""
+    return [span for span in re.split(r"(?<=[.!?])\s+|\n+", text) if span.strip()]
+
+def truncate_to_relevant(text, query, max_tokens, model="gpt-4o-mini"):
+    """Keep the spans sharing the most words with the query, in original order, within max_tokens"""
+    query_words = set(re.findall(r"\w+", query.lower()))
+    spans = _spans(text)
+    scored = []
+    for position, span in enumerate(spans):
+        words = re.findall(r"\w+", span.lower())
+        overlap = sum(1 for word in words if word in query_words)
+        # Earlier spans win ties so notes without matches keep their opening
+        scored.append((-overlap, position, span))
+    kept = []
+    used = 0
+    for _, position, span in sorted(scored):
+        tokens = count_tokens(span, model) + 1
+        if used + tokens > max_tokens:
+            continue
+        kept.append((position, span))
+        used += tokens
+    if not kept:
+        # A single span longer than the budget: cut it by tokens, leaving room for the marker
+        return truncate_tokens(text, max_tokens - count_tokens(" …", model), model) + " …"
+    kept.sort()
+    parts = []
+    for index, (position, span) in enumerate(kept):
+        if index and position != kept[index - 1][0] + 1:
+            parts.append("…")
+        parts.append(span.strip())
+    if kept[-1][0] != len(spans) - 1:
+        parts.append("…")
+    return " ".join(parts)
+
+
+# Budgeted context
+def pack_notes(notes, query, budget=ASK_CONTEXT_TOKENS, note_max_tokens=ASK_NOTE_MAX_TOKENS,
+               dedup_threshold=ASK_DEDUP_THRESHOLD, max_notes=None, model="gpt-4o-mini", summaries=None):
+    """Fit (note_id, content) pairs, most relevant first, into a token budget.
+
+    Near-duplicates of an already included note are skipped and long notes
+    are cut to their most query-relevant spans, preceded by the note's
+    precomputed summary when `summaries` has one. Returns the formatted
+    context parts, the included note IDs and a usage report.
+    """
+    summaries = summaries or {}
+    parts = []
+    note_ids = []
+    signatures = []
+    used = 0
+    duplicates = truncated = 0
+    for note_id, content in notes:
+        if max_notes is not None and len(note_ids) >= max_notes:
+            break
+        remaining = budget - used
+        if remaining < MIN_NOTE_TOKENS:
+            break
+        signature = minhash(content)
+        if any(estimated_similarity(signature, kept) >= dedup_threshold for kept in signatures):
+            duplicates += 1
+            continue
+        header = f"Note #{note_id}: "
+        allowance = min(note_max_tokens, remaining) - count_tokens(header, model)
+        if count_tokens(content, model) > allowance:
+            summary = summaries.get(note_id)
+            summary_tokens = count_tokens(summary, model) if summary else 0
+            if summary and allowance - summary_tokens >= MIN_NOTE_TOKENS:
+                excerpt = truncate_to_relevant(content, query, allowance - summary_tokens - 4, model)
+                content = f"{summary}\nExcerpt: {excerpt}"
+            else:
+                content = truncate_to_relevant(content, query, allowance, model)
+            truncated += 1
+        part = header + content
+        signatures.append(signature)
+        parts.append(part)
+        note_ids.append(note_id)
+        used += count_tokens(part, model) + 1
+    usage = {
+        "context_tokens": used,
+        "context_budget": budget,
+        "notes_considered": len(notes),
+        "notes_included": len(note_ids),
+        "notes_deduplicated": duplicates,
+        "notes_truncated": truncated,
+        "tokenizer": TOKENIZER,
+    }
+    return parts, note_ids, usage
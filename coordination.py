@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from contextlib import asynccontextmanager
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; startup there is single-process anyway
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# State shared by the worker processes serving one set of databases. Each
+# process keeps its own in-memory caches; SQLite holds what they agree on.
+
+def worker_id():
+    """Identifies this process among the workers (computed per call, so it is right after a fork)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+@asynccontextmanager
+async def startup_lock(path):
+    """Hold an exclusive lock on `path`.lock while initializing a database.
+
+    When several workers boot at once, the first creates or migrates the
+    schema and catches up derived state; the others wait (off the event
+    loop), then find nothing left to do instead of racing it.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a") as lock_file:
+        started = time.perf_counter()
+        await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+        waited = time.perf_counter() - started
+        if waited > 1:
+            logger.info("Waited %.1fs for another worker to initialize %s", waited, path)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Leases: background work that only one worker should do at a time
+def init_leases(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    conn.commit()
+
+def try_lease(conn, name, ttl):
+    """Take or renew the named lease for ttl seconds; True if this process holds it"""
+    now = time.time()
+    owner = worker_id()
+    conn.execute(
+        '''
+        INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+        ''',
+        (name, owner, now + ttl, now),
+    )
+    conn.commit()
+    return conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()[0] == owner
+
+def release_lease(conn, name):
+    """Give up the named lease if this process holds it, so another worker can take it at once"""
+    conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, worker_id()))
+    conn.commit()
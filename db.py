@@ -0,0 +1,186 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+
+from anyio import CapacityLimiter, to_thread
+
+from metrics import DB_CALL_SECONDS, DB_CHECKOUT_SECONDS
+from note_store import register_functions
+
+# Database configuration (overridable through environment variables)
+DB_PATH = os.getenv("NOTES_DB_PATH", "notes.db")
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "65536"))
+MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Worker threads for blocking database work; matching the pool size means
+# a worker never waits on a connection checkout
+DB_THREADS = int(os.getenv("DB_THREADS", str(POOL_SIZE)))
+
+
+def connect(path):
+    """Open a connection with WAL journaling and tuned pragmas"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    # Negative cache_size is in KiB rather than pages
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
+    register_functions(conn)
+    return conn
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the checkout timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe pool of long-lived SQLite connections.
+
+    Connections are opened lazily up to `size` and handed out LIFO so the
+    hottest connection (warm page cache) is reused first.
+    """
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._timeouts = 0
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                open_new = True
+            else:
+                open_new = False
+        if open_new:
+            try:
+                return connect(self.path)
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        # Pool exhausted: wait for a connection to be returned
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._waits += 1
+            self._wait_seconds += waited
+            self._max_wait_seconds = max(self._max_wait_seconds, waited)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        conn = self._acquire()
+        DB_CHECKOUT_SECONDS.observe(time.perf_counter() - start)
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+        try:
+            yield conn
+        finally:
+            # Never hand a connection with an open transaction to the next caller
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                self._in_use -= 1
+            self._idle.put(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "path": self.path,
+                "size": self.size,
+                "opened": self._opened,
+                "in_use": self._in_use,
+                "idle": self._opened - self._in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "total_wait_ms": round(self._wait_seconds * 1000, 3),
+                "max_wait_ms": round(self._max_wait_seconds * 1000, 3),
+            }
+
+
+pool = ConnectionPool(DB_PATH)
+
+# Pool of the database the current request or job works on (set per tenant); defaults to `pool`
+_current_pool = ContextVar("db_pool", default=None)
+
+def bind_pool(bound):
+    """Route get_db_connection() in the current context to another pool; returns a token for unbind_pool"""
+    return _current_pool.set(bound)
+
+def unbind_pool(token):
+    _current_pool.reset(token)
+
+def current_pool():
+    return _current_pool.get() or pool
+
+@contextmanager
+def get_db_connection():
+    """Context manager that checks a connection out of the current context's pool"""
+    with current_pool().connection() as conn:
+        yield conn
+
+def fetch_all(sql, params=()):
+    """Run a query on a pooled connection and return every row"""
+    with get_db_connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+def execute_write(sql, params=()):
+    """Run and commit one write statement; returns (lastrowid, rowcount)"""
+    with get_db_connection() as conn:
+        cursor = conn.execute(sql, params)
+        conn.commit()
+        return cursor.lastrowid, cursor.rowcount
+
+_db_limiter = None
+
+async def run_db(func, *args, **kwargs):
+    """Run blocking database work on the bounded database thread pool"""
+    global _db_limiter
+    if _db_limiter is None:
+        _db_limiter = CapacityLimiter(DB_THREADS)
+    with DB_CALL_SECONDS.time(operation=getattr(func, "__qualname__", type(func).__name__)):
+        return await to_thread.run_sync(partial(func, *args, **kwargs), limiter=_db_limiter)
@@ -0,0 +1,454 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+
+from coordination import worker_id
+from db import run_db
+from tenants import DEFAULT_TENANT
+
+logger = logging.getLogger(__name__)
+
+# Worker count per lane. AI work is capped per lane so a burst of one kind of
+# job cannot starve the others, and CRUD requests never wait behind jobs.
+DEFAULT_LANES = {
+    "interactive": int(os.getenv("JOB_WORKERS_INTERACTIVE", "4")),
+    "batch": int(os.getenv("JOB_WORKERS_BATCH", "2")),
+}
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", "86400"))
+# Running jobs are heartbeated this often; a job whose worker missed three beats is requeued
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "10"))
+
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+
+def init_jobs(conn):
+    """Create the table that persists jobs across restarts"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            lane TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            progress TEXT,
+            checkpoint TEXT,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            tenant TEXT NOT NULL DEFAULT 'default'
+        )
+    ''')
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+    if "tenant" not in columns:
+        # Jobs created before tenants existed belong to the default tenant
+        conn.execute("ALTER TABLE jobs ADD COLUMN tenant TEXT NOT NULL DEFAULT 'default'")
+    if "worker" not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN worker TEXT")
+        conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+    conn.commit()
+
+
+class JobContext:
+    """Handed to a running handler so it can report progress and checkpoint state"""
+
+    def __init__(self, queue, job_id, checkpoint, tenant=DEFAULT_TENANT):
+        self._queue = queue
+        self.job_id = job_id
+        self.checkpoint = checkpoint
+        self.tenant = tenant
+
+    async def report(self, progress, checkpoint=None):
+        """Persist progress (shown to pollers) and optional resume state (kept private)"""
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+        await run_db(self._queue._save_progress, self.job_id, progress, self.checkpoint)
+
+
+class JobQueue:
+    """In-process job queue: asyncio worker lanes in front of a SQLite jobs table.
+
+    Each job kind is registered with a handler and a lane. Lanes have their
+    own priority queue and worker count. Queued or interrupted jobs are picked
+    up again when the queue starts, and handlers can resume from the last
+    checkpoint they reported.
+
+    Several worker processes can share the table. A job is claimed by one
+    process, which heartbeats it while it runs; queued jobs are polled so
+    any idle process picks them up, and a job whose process died is requeued
+    once its heartbeat is stale.
+    """
+
+    def __init__(self, get_connection, lanes=None):
+        self.get_connection = get_connection
+        self.lanes = dict(lanes or DEFAULT_LANES)
+        self._handlers = {}
+        self._queues = {}
+        self._workers = []
+        self._running = {}
+        self._enqueued = set()
+        self._cancel_requested = set()
+        self._sequence = itertools.count()
+        self._stopping = False
+        self._last_prune = time.time()
+        self._counters = {}
+        self._wait_totals = {}
+
+    def register(self, kind, handler, lane="batch", cleanup=None):
+        """handler(payload, ctx) -> JSON-serializable result; cleanup(payload) runs when a job is dropped"""
+        if lane not in self.lanes:
+            raise ValueError(f"Unknown lane: {lane}")
+        self._handlers[kind] = (handler, lane, cleanup)
+
+    def _count(self, kind, event):
+        key = (kind, event)
+        self._counters[key] = self._counters.get(key, 0) + 1
+
+    # Database helpers (run on the database thread pool)
+    def _insert(self, job):
+        with self.get_connection() as conn:
+            conn.execute(
+                '''
+                INSERT INTO jobs (id, kind, lane, priority, status, payload, progress, created_at, tenant)
+                VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)
+                ''',
+                (job["id"], job["kind"], job["lane"], job["priority"], json.dumps(job["payload"]),
+                 json.dumps(job["progress"]) if job["progress"] is not None else None, job["created_at"],
+                 job["tenant"]),
+            )
+            conn.commit()
+
+    def _claim(self, job_id):
+        """Mark a queued job running here; returns its row or None if it was cancelled or claimed meanwhile"""
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.execute(
+                '''
+                UPDATE jobs SET status = 'running', started_at = ?, worker = ?, heartbeat_at = ?
+                WHERE id = ? AND status = 'queued'
+                ''',
+                (now, worker_id(), now, job_id),
+            )
+            conn.commit()
+            if cursor.rowcount == 0:
+                return None
+            return conn.execute(
+                "SELECT kind, payload, checkpoint, created_at, started_at, tenant FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+
+    def _finish(self, job_id, status, result=None, error=None):
+        # Only a job running here can finish; a cancellation, or a requeue after missed heartbeats, wins
+        with self.get_connection() as conn:
+            conn.execute(
+                '''
+                UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?
+                WHERE id = ? AND status = 'running' AND worker = ?
+                ''',
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id, worker_id()),
+            )
+            conn.commit()
+
+    def _save_progress(self, job_id, progress, checkpoint):
+        with self.get_connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ?, checkpoint = ? WHERE id = ?",
+                (json.dumps(progress), json.dumps(checkpoint) if checkpoint is not None else None, job_id),
+            )
+            conn.commit()
+
+    def _load(self, job_id, tenant=None):
+        """Load a job row; with a tenant given, jobs of other tenants are not found"""
+        sql = '''
+            SELECT id, kind, lane, priority, status, payload, progress, result, error,
+                   created_at, started_at, finished_at
+            FROM jobs WHERE id = ?
+        '''
+        params = [job_id]
+        if tenant is not None:
+            sql += " AND tenant = ?"
+            params.append(tenant)
+        with self.get_connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def _requeue_stale(self, conn):
+        """Requeue running jobs whose process stopped heartbeating (it crashed or was killed)"""
+        return conn.execute(
+            '''
+            UPDATE jobs SET status = 'queued', started_at = NULL, worker = NULL
+            WHERE status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)
+            ''',
+            (time.time() - 3 * JOB_HEARTBEAT_SECONDS,),
+        ).rowcount
+
+    def _queued(self, conn):
+        return conn.execute("SELECT id, kind, priority FROM jobs WHERE status = 'queued' ORDER BY created_at").fetchall()
+
+    def _recover(self):
+        """Requeue jobs left running by a dead process, prune old ones and return the queued ones"""
+        with self.get_connection() as conn:
+            self._requeue_stale(conn)
+            pruned = self._prune(conn)
+            rows = self._queued(conn)
+            conn.commit()
+        return rows, pruned
+
+    def _heartbeat(self, running_ids):
+        """Beat for the jobs running here; returns (those cancelled through other processes, queued jobs)"""
+        with self.get_connection() as conn:
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND worker = ?",
+                         (time.time(), worker_id()))
+            requeued = self._requeue_stale(conn)
+            if requeued:
+                logger.warning("Requeued %d jobs of unresponsive workers", requeued)
+            placeholders = ",".join("?" * len(running_ids))
+            cancelled = [row[0] for row in conn.execute(
+                f"SELECT id FROM jobs WHERE id IN ({placeholders}) AND status = 'cancelled'", running_ids
+            )] if running_ids else []
+            rows = self._queued(conn)
+            conn.commit()
+        return cancelled, rows
+
+    def _release_running(self):
+        with self.get_connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, worker = NULL WHERE status = 'running' AND worker = ?",
+                (worker_id(),),
+            )
+            conn.commit()
+
+    def _prune(self, conn):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        placeholders = ",".join("?" * len(FINISHED_STATUSES))
+        rows = conn.execute(
+            f"SELECT kind, payload FROM jobs WHERE status IN ({placeholders}) AND finished_at < ?",
+            (*FINISHED_STATUSES, cutoff),
+        ).fetchall()
+        conn.execute(
+            f"DELETE FROM jobs WHERE status IN ({placeholders}) AND finished_at < ?",
+            (*FINISHED_STATUSES, cutoff),
+        )
+        return rows
+
+    def _prune_finished(self):
+        with self.get_connection() as conn:
+            rows = self._prune(conn)
+            conn.commit()
+        return rows
+
+    async def _maybe_prune(self):
+        # Finished jobs are dropped at most once a minute as new ones arrive
+        if time.time() - self._last_prune < 60:
+            return
+        self._last_prune = time.time()
+        for kind, payload in await run_db(self._prune_finished):
+            self._run_cleanup(kind, json.loads(payload))
+
+    def _status_counts(self):
+        with self.get_connection() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    # Lifecycle
+    async def start(self):
+        """Start the lane workers and requeue unfinished jobs from the database"""
+        self._stopping = False
+        for lane, workers in self.lanes.items():
+            self._queues[lane] = asyncio.PriorityQueue()
+            for _ in range(workers):
+                self._workers.append(asyncio.create_task(self._worker(lane)))
+        rows, pruned = await run_db(self._recover)
+        for kind, payload in pruned:
+            self._run_cleanup(kind, json.loads(payload))
+        self._enqueue_rows(rows)
+        self._workers.append(asyncio.create_task(self._heartbeat_loop()))
+
+    async def stop(self):
+        """Stop workers; jobs running here are requeued so another process (or the next start) resumes them"""
+        self._stopping = True
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        await run_db(self._release_running)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                cancelled, rows = await run_db(self._heartbeat, list(self._running))
+            except Exception as e:
+                logger.warning("Job heartbeat failed: %s", e)
+                continue
+            for job_id in cancelled:
+                # Cancelled through another process; the worker runs the cleanup once the handler has unwound
+                if job_id in self._running:
+                    self._cancel_requested.add(job_id)
+                    self._running[job_id][1].cancel()
+            self._enqueue_rows(rows)
+
+    def _enqueue_rows(self, rows):
+        for job_id, kind, priority in rows:
+            if job_id in self._enqueued:
+                continue
+            if kind in self._handlers:
+                self._enqueue(job_id, kind, priority)
+            else:
+                logger.warning("No handler registered for queued job %s of kind %s", job_id, kind)
+
+    def _enqueue(self, job_id, kind, priority):
+        lane = self._handlers[kind][1]
+        # Lower numbers run first; the sequence keeps FIFO order within a priority
+        self._queues[lane].put_nowait((-priority, next(self._sequence), job_id))
+        self._enqueued.add(job_id)
+
+    def _run_cleanup(self, kind, payload):
+        cleanup = self._handlers.get(kind, (None, None, None))[2]
+        if cleanup is not None:
+            try:
+                cleanup(payload)
+            except Exception as e:
+                logger.warning("Cleanup for %s job failed: %s", kind, e)
+
+    async def _worker(self, lane):
+        queue = self._queues[lane]
+        while True:
+            _, _, job_id = await queue.get()
+            self._enqueued.discard(job_id)
+            row = await run_db(self._claim, job_id)
+            if row is None:
+                continue
+            kind, payload, checkpoint, created_at, started_at, tenant = row
+            waited, count = self._wait_totals.get(kind, (0.0, 0))
+            self._wait_totals[kind] = (waited + started_at - created_at, count + 1)
+            handler = self._handlers[kind][0]
+            ctx = JobContext(self, job_id, json.loads(checkpoint) if checkpoint else None, tenant)
+            task = asyncio.create_task(handler(json.loads(payload), ctx))
+            self._running[job_id] = (lane, task)
+            try:
+                result = await task
+            except asyncio.CancelledError:
+                if self._stopping or job_id not in self._cancel_requested:
+                    raise
+                self._cancel_requested.discard(job_id)
+                self._run_cleanup(kind, json.loads(payload))
+            except Exception as e:
+                logger.warning("Job %s (%s) failed: %s", job_id, kind, e)
+                await run_db(self._finish, job_id, "failed", error=str(e))
+                self._count(kind, "failed")
+            else:
+                await run_db(self._finish, job_id, "completed", result=result)
+                self._count(kind, "completed")
+            finally:
+                self._running.pop(job_id, None)
+
+    # Public API
+    async def submit(self, kind, payload, priority=0, progress=None, tenant=DEFAULT_TENANT):
+        """Persist and enqueue a job for a tenant; higher priorities run first within a lane. Returns its status dict"""
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        await self._maybe_prune()
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "lane": self._handlers[kind][1],
+            "priority": priority,
+            "payload": payload,
+            "progress": progress,
+            "created_at": time.time(),
+            "tenant": tenant,
+        }
+        await run_db(self._insert, job)
+        self._enqueue(job["id"], kind, priority)
+        self._count(kind, "submitted")
+        return await self.get(job["id"])
+
+    async def retry(self, job_id, tenant=None):
+        """Requeue a failed job; its handler sees the last checkpoint it reported"""
+        def requeue():
+            with self.get_connection() as conn:
+                cursor = conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = NULL, finished_at = NULL WHERE id = ? AND status = 'failed'",
+                    (job_id,),
+                )
+                conn.commit()
+                return cursor.rowcount > 0
+
+        row = await run_db(self._load, job_id, tenant)
+        if row is None:
+            return None
+        if await run_db(requeue):
+            self._enqueue(job_id, row[1], row[3])
+        return await self.get(job_id)
+
+    async def get(self, job_id, include_result=False, tenant=None):
+        row = await run_db(self._load, job_id, tenant)
+        if row is None:
+            return None
+        (job_id, kind, lane, priority, status, _, progress, result, error,
+         created_at, started_at, finished_at) = row
+        job = {
+            "id": job_id,
+            "kind": kind,
+            "lane": lane,
+            "priority": priority,
+            "status": status,
+            "progress": json.loads(progress) if progress else None,
+            "error": error,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+        }
+        if include_result and status == "completed":
+            job["result"] = json.loads(result) if result else None
+        return job
+
+    async def cancel(self, job_id, tenant=None):
+        """Cancel a queued or running job; finished jobs are left unchanged"""
+        def mark_cancelled():
+            with self.get_connection() as conn:
+                cursor = conn.execute(
+                    "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+                    (time.time(), job_id),
+                )
+                conn.commit()
+                return cursor.rowcount > 0
+
+        row = await run_db(self._load, job_id, tenant)
+        if row is None:
+            return None
+        if await run_db(mark_cancelled):
+            self._count(row[1], "cancelled")
+            if job_id in self._running:
+                # The worker runs the cleanup once the handler has unwound
+                self._cancel_requested.add(job_id)
+                self._running[job_id][1].cancel()
+            elif row[4] == "queued":
+                self._run_cleanup(row[1], json.loads(row[5]))
+            # A job running in another process is stopped and cleaned up there at its next heartbeat
+        return await self.get(job_id)
+
+    def depths(self):
+        """Queued jobs per lane"""
+        return {lane: queue.qsize() for lane, queue in self._queues.items()}
+
+    async def metrics(self):
+        """Queue depth and running jobs per lane, plus per-kind outcome counters"""
+        lanes = {}
+        for lane, workers in self.lanes.items():
+            queue = self._queues.get(lane)
+            lanes[lane] = {
+                "workers": workers,
+                "queued": queue.qsize() if queue else 0,
+                "running": sum(1 for running_lane, _ in self._running.values() if running_lane == lane),
+            }
+        kinds = {}
+        for (kind, event), count in self._counters.items():
+            kinds.setdefault(kind, {})[event] = count
+        for kind, (waited, count) in self._wait_totals.items():
+            kinds.setdefault(kind, {})["avg_queue_wait_ms"] = round(waited / count * 1000, 3)
+        return {"lanes": lanes, "kinds": kinds, "jobs_by_status": await run_db(self._status_counts)}
@@ -0,0 +1,238 @@
+import hashlib
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+# Dependency marker for responses that depend on every note (e.g. /summarize)
+ALL_NOTES = 0
+
+# USD per 1M tokens (input, output), used to report money saved by cache hits
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+
+def init_llm_cache(conn):
+    """Create the response cache tables and the trigger-maintained note-set version"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            notes_version TEXT NOT NULL,
+            response TEXT NOT NULL,
+            embedding BLOB,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS llm_cache_version ON llm_cache (model, notes_version)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache_notes (
+            note_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            PRIMARY KEY (note_id, key)
+        ) WITHOUT ROWID
+    ''')
+    # Single-row counter bumped by every write to notes
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS note_set_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO note_set_version (id, version) VALUES (1, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS note_set_version_{event.lower()} AFTER {event} ON notes BEGIN
+                UPDATE note_set_version SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+    conn.commit()
+
+def get_note_set_version(conn):
+    return conn.execute("SELECT version FROM note_set_version WHERE id = 1").fetchone()[0]
+
+def bump_note_set_version(conn):
+    """Retire responses cached for the current note set when something they were built from changed
+    outside the notes table (e.g. a note summary)"""
+    conn.execute("UPDATE note_set_version SET version = version + 1 WHERE id = 1")
+
+def normalize_prompt(prompt):
+    """Case-fold, collapse whitespace and drop trailing punctuation so trivial variants share a key"""
+    return re.sub(r"\s+", " ", prompt).strip().lower().rstrip("?!. ")
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return ((prompt_tokens or 0) * input_price + (completion_tokens or 0) * output_price) / 1_000_000
+
+
+class ResponseCache:
+    """SQLite-backed LLM response cache with TTL, LRU eviction and optional semantic hits.
+
+    Entries are keyed by (kind, model, normalized prompt, notes version). The
+    notes version identifies the exact notes the response was generated from,
+    and each entry records which note IDs it depends on so writes can drop it
+    eagerly. With a similarity threshold set, a miss falls back to the most
+    similar cached prompt embedding for the same model and notes version.
+    """
+
+    def __init__(self, get_connection, max_entries=10000, ttl_seconds=86400, similarity_threshold=0.0):
+        self.get_connection = get_connection
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._semantic_hits = 0
+        self._misses = 0
+        self._saved_usd = 0.0
+
+    @classmethod
+    def from_env(cls, get_connection):
+        return cls(
+            get_connection,
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+            ttl_seconds=float(os.getenv("LLM_CACHE_TTL_SECONDS", "86400")),
+            similarity_threshold=float(os.getenv("LLM_CACHE_SIMILARITY", "0")),
+        )
+
+    @staticmethod
+    def make_key(kind, model, prompt, notes_version):
+        digest = hashlib.sha256()
+        for part in (kind, model, normalize_prompt(prompt), str(notes_version)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _record(self, row, semantic):
+        with self._lock:
+            self._hits += 1
+            if semantic:
+                self._semantic_hits += 1
+            self._saved_usd += estimate_cost(row[1], row[2], row[3])
+
+    def lookup(self, kind, model, prompt, notes_version, embedding=None):
+        """Return a cached response or None; expired entries are deleted on sight"""
+        key = self.make_key(kind, model, prompt, notes_version)
+        now = time.time()
+        expired_before = now - self.ttl_seconds
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT response, model, prompt_tokens, completion_tokens, created_at FROM llm_cache WHERE key = ?",
+                (key,),
+            )
+            row = cursor.fetchone()
+            semantic = False
+            if row is not None and row[4] < expired_before:
+                self._delete(cursor, [key])
+                conn.commit()
+                row = None
+            if row is None and embedding is not None and self.similarity_threshold > 0:
+                key, row = self._semantic_lookup(cursor, model, notes_version, embedding, expired_before)
+                semantic = row is not None
+            if row is None:
+                with self._lock:
+                    self._misses += 1
+                return None
+            cursor.execute("UPDATE llm_cache SET last_used_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+        self._record(row, semantic)
+        return row[0]
+
+    def _semantic_lookup(self, cursor, model, notes_version, embedding, expired_before):
+        cursor.execute(
+            '''
+            SELECT key, embedding, response, model, prompt_tokens, completion_tokens
+            FROM llm_cache
+            WHERE model = ? AND notes_version = ? AND embedding IS NOT NULL AND created_at >= ?
+            ''',
+            (model, str(notes_version), expired_before),
+        )
+        candidates = cursor.fetchall()
+        if not candidates:
+            return None, None
+        query = np.asarray(embedding, dtype=np.float32)
+        matrix = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in candidates])
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+        norms[norms == 0] = 1.0
+        scores = matrix @ query / norms
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None, None
+        row = candidates[best]
+        return row[0], (row[2], row[3], row[4], row[5])
+
+    def store(self, kind, model, prompt, notes_version, response, note_ids,
+              embedding=None, prompt_tokens=None, completion_tokens=None):
+        """Cache a response and record the notes it depends on, then enforce the size bound"""
+        key = self.make_key(kind, model, prompt, notes_version)
+        now = time.time()
+        blob = np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                INSERT OR REPLACE INTO llm_cache
+                    (key, model, prompt, notes_version, response, embedding,
+                     prompt_tokens, completion_tokens, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''',
+                (key, model, normalize_prompt(prompt), str(notes_version), response, blob,
+                 prompt_tokens, completion_tokens, now, now),
+            )
+            cursor.executemany(
+                "INSERT OR IGNORE INTO llm_cache_notes (note_id, key) VALUES (?, ?)",
+                [(note_id, key) for note_id in note_ids],
+            )
+            cursor.execute("SELECT COUNT(*) FROM llm_cache")
+            overflow = cursor.fetchone()[0] - self.max_entries
+            if overflow > 0:
+                cursor.execute("SELECT key FROM llm_cache ORDER BY last_used_at LIMIT ?", (overflow,))
+                self._delete(cursor, [row[0] for row in cursor.fetchall()])
+            conn.commit()
+
+    def _delete(self, cursor, keys):
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            cursor.execute(f"DELETE FROM llm_cache WHERE key IN ({placeholders})", batch)
+            cursor.execute(f"DELETE FROM llm_cache_notes WHERE key IN ({placeholders})", batch)
+
+    def invalidate_notes(self, note_ids):
+        """Drop every entry that depends on one of these notes or on the whole note set"""
+        ids = [ALL_NOTES, *note_ids]
+        placeholders = ",".join("?" * len(ids))
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT DISTINCT key FROM llm_cache_notes WHERE note_id IN ({placeholders})", ids)
+            keys = [row[0] for row in cursor.fetchall()]
+            self._delete(cursor, keys)
+            conn.commit()
+        return len(keys)
+
+    def stats(self):
+        with self.get_connection() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "similarity_threshold": self.similarity_threshold,
+                "hits": self._hits,
+                "semantic_hits": self._semantic_hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+                "miss_ratio": round(self._misses / lookups, 4) if lookups else 0.0,
+                "saved_usd": round(self._saved_usd, 6),
+            }
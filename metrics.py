@@ -0,0 +1,260 @@
+import bisect
+import cProfile
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Default latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+BYTE_BUCKETS = tuple(1024 * 4 ** power for power in range(11))  # 1KiB .. 1GiB
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+
+# Sampled cProfile dumps for slow requests (disabled unless PROFILE_SAMPLE_RATE > 0)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "1000"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self, labels=()):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples(labels))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing count per label set"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, labels):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key, labels)} {value}" for key, value in items]
+
+
+class Gauge(Metric):
+    """Point-in-time values read from a callback when /metrics is scraped"""
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        super().__init__(name, help, labelnames)
+        self.collect = collect
+
+    def _samples(self, labels):
+        # collect() returns {label_values_tuple: value}
+        values = self.collect() if self.collect else {}
+        return [f"{self.name}{_format_labels(self.labelnames, key, labels)} {value}"
+                for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """Cumulative bucket counts, sum and count per label set"""
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, labels):
+        with self._lock:
+            items = sorted((key, [list(state[0]), state[1], state[2]]) for key, state in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames, key, [*labels, ("le", bound)])
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            sample_labels = _format_labels(self.labelnames, key, labels)
+            lines.append(f"{self.name}_sum{sample_labels} {total}")
+            lines.append(f"{self.name}_count{sample_labels} {count}")
+        return lines
+
+
+REGISTRY = []
+
+def render_metrics(labels=()):
+    """Every registered metric in the Prometheus text exposition format.
+
+    labels are (name, value) pairs added to every sample, e.g. the worker
+    process the values were collected in.
+    """
+    return "\n".join(metric.render(labels) for metric in REGISTRY) + "\n"
+
+
+# Shared metrics recorded by the hot paths
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time until the full response is sent", ("method", "route", "status")
+)
+STAGE_SECONDS = Histogram("stage_duration_seconds", "Time spent in one stage of request handling", ("stage",))
+DB_CHECKOUT_SECONDS = Histogram("db_checkout_seconds", "Time to check a connection out of the pool")
+DB_CALL_SECONDS = Histogram("db_call_seconds", "Blocking database work including thread handoff", ("operation",))
+UPSTREAM_SECONDS = Histogram("upstream_request_seconds", "OpenAI request latency per attempt", ("outcome",))
+UPSTREAM_QUEUE_SECONDS = Histogram("upstream_queue_seconds", "Wait for an OpenAI concurrency slot")
+UPSTREAM_RETRIES = Counter("upstream_retries_total", "OpenAI request attempts that were retried")
+UPSTREAM_SHED = Counter("upstream_shed_total", "OpenAI calls rejected without being sent", ("reason",))
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens reported by the OpenAI API", ("model", "type"))
+LLM_PROMPT_TOKENS = Histogram("llm_prompt_tokens", "Prompt tokens per OpenAI request", ("model",), TOKEN_BUCKETS)
+UPLOAD_BYTES = Histogram("upload_bytes", "Size of uploaded files", ("endpoint",), BYTE_BUCKETS)
+UPSTREAM_BATCH_SIZE = Histogram("upstream_batch_size", "Items sent per batched OpenAI request", ("kind",), BATCH_BUCKETS)
+COALESCED_REQUESTS = Counter("coalesced_requests_total", "Calls answered by an identical call already in flight", ("kind",))
+
+def stage(name):
+    """Context manager timing one named stage"""
+    return STAGE_SECONDS.time(stage=name)
+
+def process_memory():
+    """(current RSS, peak RSS) of this process in bytes; None where the platform does not report it"""
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["VmRSS"].split()[0]) * 1024, int(fields["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        if resource is None:
+            return None, None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in KiB on Linux but in bytes on macOS
+        return None, peak if sys.platform == "darwin" else peak * 1024
+
+Gauge("process_resident_memory_bytes", "Resident set size of this process",
+      collect=lambda: {(): rss} if (rss := process_memory()[0]) is not None else {})
+Gauge("process_peak_rss_bytes", "Peak resident set size of this process",
+      collect=lambda: {(): peak} if (peak := process_memory()[1]) is not None else {})
+
+
+# Sampled profiling
+_profile_lock = threading.Lock()
+
+class RequestProfiler:
+    """Profiles a sample of requests and keeps the profile only when the request was slow.
+
+    cProfile sees the whole event loop thread, so a dump can include work from
+    requests that ran concurrently; only one request is profiled at a time.
+    """
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, slow_ms=PROFILE_SLOW_MS, directory=PROFILE_DIR):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.directory = directory
+
+    def start(self):
+        """Return a running profiler for a sampled request, or None"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        if not _profile_lock.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler (e.g. a debugger) is already active
+            _profile_lock.release()
+            return None
+        return profiler
+
+    def finish(self, profiler, elapsed, label):
+        profiler.disable()
+        try:
+            if elapsed * 1000 >= self.slow_ms:
+                os.makedirs(self.directory, exist_ok=True)
+                safe_label = "".join(c if c.isalnum() else "_" for c in label).strip("_")
+                path = os.path.join(self.directory, f"{int(time.time() * 1000)}-{safe_label}.prof")
+                profiler.dump_stats(path)
+                return path
+        finally:
+            _profile_lock.release()
+        return None
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency (until the last body byte) and sampled profiles"""
+
+    def __init__(self, app, profiler=None):
+        self.app = app
+        self.profiler = profiler or RequestProfiler()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        profile = self.profiler.start()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            # The router stores the matched route in the scope; use its template to bound cardinality
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.observe(elapsed, method=scope["method"], route=route, status=status)
+            if profile is not None:
+                path = self.profiler.finish(profile, elapsed, f"{scope['method']} {route}")
+                if path is not None:
+                    logger.warning("Slow request %s %s took %.0fms, profile saved to %s",
+                                   scope["method"], route, elapsed * 1000, path)
@@ -0,0 +1,385 @@
+import asyncio
+import logging
+import os
+import re
+import time
+
+from context_budget import count_tokens, split_tokens, tail_tokens, truncate_tokens
+from coordination import release_lease, try_lease
+from db import run_db
+
+logger = logging.getLogger(__name__)
+
+# Chunking settings (overridable through environment variables)
+# Notes larger than this (UTF-8 bytes) are split into chunks; smaller ones are retrieved whole
+NOTE_CHUNK_MIN_BYTES = int(os.getenv("NOTE_CHUNK_MIN_BYTES", "4096"))
+NOTE_CHUNK_TOKENS = int(os.getenv("NOTE_CHUNK_TOKENS", "400"))
+NOTE_CHUNK_OVERLAP = int(os.getenv("NOTE_CHUNK_OVERLAP", "50"))
+# Headings are repeated in front of every chunk of their section, so overlong ones are cut
+HEADING_MAX_TOKENS = 32
+
+HEADING_RE = re.compile(r"^\s{0,3}(#{1,6})\s+(.+?)\s*#*\s*$")
+PARAGRAPH_BREAK_RE = re.compile(r"\n\s*\n")
+
+# (id, text) of chunks as they are embedded; the heading gives a chunk its context
+CHUNK_IDS_SQL = "SELECT id FROM note_chunks"
+CHUNK_TEXTS_SQL = '''
+    SELECT id, CASE WHEN heading IS NULL THEN content ELSE heading || char(10) || content END
+    FROM note_chunks WHERE id IN ({placeholders})
+'''
+# The note-level vector index only embeds the opening of a long note (see note_embedding_text, applied
+# to these rows); its chunks cover the rest
+NOTE_TEXTS_SQL = f'''
+    SELECT id, substr(content, 1, {NOTE_CHUNK_MIN_BYTES}) FROM note_contents WHERE id IN ({{placeholders}})
+'''
+
+def init_note_chunks(conn):
+    """Create the chunk table of long notes, its search index and the triggers that invalidate it.
+
+    note_chunk_sources records which body a note's chunks were cut from; an
+    edit deletes both, and the chunker rebuilds them in the background.
+    Chunks go away with their note through the foreign key cascade.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS note_chunks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            note_id INTEGER NOT NULL REFERENCES notes (id) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            heading TEXT,
+            content TEXT NOT NULL,
+            token_count INTEGER NOT NULL,
+            UNIQUE (note_id, seq)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS note_chunk_sources (
+            note_id INTEGER PRIMARY KEY REFERENCES notes (id) ON DELETE CASCADE,
+            body_hash BLOB NOT NULL,
+            chunked_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_chunks_invalidate AFTER UPDATE OF body_hash ON notes
+        WHEN old.body_hash IS NOT new.body_hash BEGIN
+            DELETE FROM note_chunks WHERE note_id = old.id;
+            DELETE FROM note_chunk_sources WHERE note_id = old.id;
+        END
+    ''')
+    # Chunks are never updated in place, only inserted and deleted
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS note_chunks_fts USING fts5(
+            content,
+            content='note_chunks',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_chunks_fts_insert AFTER INSERT ON note_chunks BEGIN
+            INSERT INTO note_chunks_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_chunks_fts_delete AFTER DELETE ON note_chunks BEGIN
+            INSERT INTO note_chunks_fts (note_chunks_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    ''')
+    conn.commit()
+
+def is_long(content):
+    """Whether a note is chunked: larger than NOTE_CHUNK_MIN_BYTES in UTF-8, like notes.size"""
+    # A character is at least one byte, so only short texts need encoding
+    return len(content) > NOTE_CHUNK_MIN_BYTES or len(content.encode("utf-8")) > NOTE_CHUNK_MIN_BYTES
+
+def note_embedding_text(content):
+    """Text embedded for a whole note: all of a short note, the first NOTE_CHUNK_MIN_BYTES bytes of a long one.
+
+    A token is at least one byte, so the opening stays within the embedding model's input limit.
+    """
+    return content.encode("utf-8")[:NOTE_CHUNK_MIN_BYTES].decode("utf-8", "ignore")
+
+def chunk_text(heading, content):
+    """A chunk as it is embedded and shown to the model, under its section heading"""
+    return f"{heading}\n{content}" if heading else content
+
+
+# Splitting
+def _sections(text):
+    """Yield (heading, paragraphs) for the text before the first Markdown heading and under each heading"""
+    heading, lines = None, []
+    for line in text.splitlines():
+        match = HEADING_RE.match(line)
+        if match:
+            yield heading, _paragraphs(lines)
+            heading, lines = truncate_tokens(match.group(2), HEADING_MAX_TOKENS), []
+        else:
+            lines.append(line)
+    yield heading, _paragraphs(lines)
+
+def _paragraphs(lines):
+    return [paragraph.strip() for paragraph in PARAGRAPH_BREAK_RE.split("\n".join(lines)) if paragraph.strip()]
+
+def split_text(text, chunk_tokens=NOTE_CHUNK_TOKENS, overlap_tokens=NOTE_CHUNK_OVERLAP, model="gpt-4o-mini"):
+    """Split a long note into (heading, content, token_count) chunks of at most about chunk_tokens.
+
+    Sections start at Markdown headings. Within a section paragraphs are
+    packed greedily into chunks and paragraphs longer than a chunk are cut
+    on token boundaries (at whitespace where possible), so text without
+    paragraphs or spaces is bounded too. Each chunk after the first in a
+    section starts with the last overlap_tokens of the previous one, so a
+    passage split at a boundary is still whole in one of them.
+    """
+    overlap_tokens = min(overlap_tokens, chunk_tokens // 2)
+    # Room for the overlap in front of a window, so a chunk of one window stays within chunk_tokens
+    window_tokens = chunk_tokens - overlap_tokens
+    chunks = []
+    for heading, paragraphs in _sections(text):
+        pieces = []
+        for paragraph in paragraphs:
+            tokens = count_tokens(paragraph, model)
+            if tokens > window_tokens:
+                pieces.extend((window, count_tokens(window, model))
+                              for window in split_tokens(paragraph, window_tokens, model))
+            else:
+                pieces.append((paragraph, tokens))
+        current, current_tokens, fresh = [], 0, False
+        for piece, tokens in pieces:
+            # One token for the paragraph break joining them
+            if fresh and current_tokens + 1 + tokens > chunk_tokens:
+                content = "\n\n".join(current)
+                chunks.append((heading, content, count_tokens(content, model)))
+                tail = tail_tokens(content, overlap_tokens, model)
+                current, current_tokens, fresh = ([tail], count_tokens(tail, model), False) if tail else ([], 0, False)
+            current_tokens += tokens + (1 if current else 0)
+            current.append(piece)
+            fresh = True
+        if fresh:
+            content = "\n\n".join(current)
+            chunks.append((heading, content, count_tokens(content, model)))
+    return chunks
+
+def excerpt_chunks(chunks, budget_tokens):
+    """Evenly spaced chunks, in document order, that fit in budget_tokens (a long note's stand-in for summaries)"""
+    if not chunks:
+        return []
+    average = max(1, sum(tokens for _, _, tokens in chunks) // len(chunks))
+    wanted = max(1, min(len(chunks), budget_tokens // average))
+    picked = sorted({round(i * (len(chunks) - 1) / max(1, wanted - 1)) for i in range(wanted)})
+    excerpts, used = [], 0
+    for index in picked:
+        heading, content, tokens = chunks[index]
+        if excerpts and used + tokens > budget_tokens:
+            break
+        excerpts.append(chunk_text(heading, content))
+        used += tokens
+    return excerpts
+
+
+class NoteChunker:
+    """Chunks of long notes and their embeddings, maintained in the background.
+
+    Writes mark notes dirty; a worker re-splits the long ones whose body
+    changed since they were last chunked and embeds the new chunks into a
+    separate vector index. An edit drops the old chunks at once (by trigger),
+    so readers never see chunks of a previous version, only none until the
+    worker catches up; their vectors are pruned after each batch. A
+    periodic reconcile pass queues any long note without current chunks and
+    compacts the removal markers of compact_indexes (by default the chunk
+    index); with several worker processes only the one holding the lease
+    runs it.
+    """
+
+    def __init__(self, get_connection, index, chunk_tokens=NOTE_CHUNK_TOKENS, overlap_tokens=NOTE_CHUNK_OVERLAP,
+                 batch_size=20, reconcile_seconds=300, compact_indexes=None):
+        self.get_connection = get_connection
+        self.index = index
+        self.compact_indexes = compact_indexes if compact_indexes is not None else [index]
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.batch_size = batch_size
+        self.reconcile_seconds = reconcile_seconds
+        self._dirty = set()
+        self._wake = asyncio.Event()
+        self._tasks = []
+        self._chunked = 0
+        self._failures = 0
+
+    # Lifecycle
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()), asyncio.create_task(self._reconcile_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await run_db(self._lease, False)
+
+    def _lease(self, take=True):
+        with self.get_connection() as conn:
+            if take:
+                return try_lease(conn, "note_chunks.reconcile", self.reconcile_seconds * 2)
+            release_lease(conn, "note_chunks.reconcile")
+
+    def pending(self):
+        return len(self._dirty)
+
+    def mark_dirty(self, note_ids):
+        """Queue notes for (re)chunking after a committed write or delete; short notes are skipped by refresh"""
+        self._dirty.update(int(note_id) for note_id in note_ids)
+        self._wake.set()
+
+    async def _worker(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while self._dirty:
+                batch = [self._dirty.pop() for _ in range(min(self.batch_size, len(self._dirty)))]
+                try:
+                    await self.refresh(batch)
+                except Exception as e:
+                    # Picked up again by the next reconcile
+                    self._failures += 1
+                    logger.warning("Note chunking failed for %d notes: %s", len(batch), e)
+            try:
+                await self.prune()
+            except Exception as e:
+                logger.warning("Chunk index prune failed: %s", e)
+
+    async def _reconcile_loop(self):
+        while True:
+            try:
+                if await run_db(self._lease):
+                    await self.reconcile()
+                    for index in self.compact_indexes:
+                        await asyncio.to_thread(index.compact)
+            except Exception as e:
+                logger.warning("Note chunk reconcile failed: %s", e)
+            await asyncio.sleep(self.reconcile_seconds)
+
+    # Computation
+    def _load_stale(self, note_ids):
+        placeholders = ",".join("?" * len(note_ids))
+        with self.get_connection() as conn:
+            return conn.execute(
+                f'''
+                SELECT n.id, n.body_hash
+                FROM notes n LEFT JOIN note_chunk_sources s ON s.note_id = n.id
+                WHERE n.id IN ({placeholders}) AND n.size > ? AND s.body_hash IS NOT n.body_hash
+                ''',
+                (*note_ids, NOTE_CHUNK_MIN_BYTES),
+            ).fetchall()
+
+    def _load_content(self, note_id, body_hash):
+        with self.get_connection() as conn:
+            row = conn.execute(
+                "SELECT content FROM note_contents WHERE id = ? AND body_hash = lower(hex(?))", (note_id, body_hash)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _store(self, note_id, body_hash, chunks):
+        """Replace a note's chunks; returns the new chunk ids, or none if the note changed meanwhile"""
+        with self.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # The note may have been edited or deleted while it was being split
+                if conn.execute("SELECT 1 FROM notes WHERE id = ? AND body_hash = ?",
+                                (note_id, body_hash)).fetchone() is None:
+                    conn.rollback()
+                    return []
+                conn.execute("DELETE FROM note_chunks WHERE note_id = ?", (note_id,))
+                conn.executemany(
+                    "INSERT INTO note_chunks (note_id, seq, heading, content, token_count) VALUES (?, ?, ?, ?, ?)",
+                    ((note_id, seq, heading, content, tokens) for seq, (heading, content, tokens) in enumerate(chunks)),
+                )
+                added = [row[0] for row in conn.execute(
+                    "SELECT id FROM note_chunks WHERE note_id = ? ORDER BY seq", (note_id,)
+                )]
+                conn.execute(
+                    "INSERT OR REPLACE INTO note_chunk_sources (note_id, body_hash, chunked_at) VALUES (?, ?, ?)",
+                    (note_id, body_hash, time.time()),
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return added
+
+    async def refresh(self, note_ids):
+        """Re-split the given long notes whose body changed since they were chunked, and embed the chunks"""
+        stale = await run_db(self._load_stale, list(note_ids))
+        for note_id, body_hash in stale:
+            content = await run_db(self._load_content, note_id, body_hash)
+            if content is None:
+                continue
+            chunks = await asyncio.to_thread(split_text, content, self.chunk_tokens, self.overlap_tokens)
+            added = await run_db(self._store, note_id, body_hash, chunks)
+            if added:
+                # Stored chunks that fail to embed are added by index.sync() when the shard is next opened
+                await self.index.upsert_many(added, [chunk_text(heading, text) for heading, text, _ in chunks])
+                self._chunked += 1
+        return len(stale)
+
+    def _chunk_ids(self):
+        with self.get_connection() as conn:
+            return {row[0] for row in conn.execute(CHUNK_IDS_SQL)}
+
+    async def prune(self):
+        """Drop vectors of chunks deleted by edits and note deletes"""
+        chunk_ids = await run_db(self._chunk_ids)
+        stale = [chunk_id for chunk_id in self.index.ids() if chunk_id not in chunk_ids]
+        await asyncio.to_thread(self.index.remove_many, stale)
+        return len(stale)
+
+    def _scan(self):
+        with self.get_connection() as conn:
+            return [row[0] for row in conn.execute(
+                '''
+                SELECT n.id FROM notes n LEFT JOIN note_chunk_sources s ON s.note_id = n.id
+                WHERE n.size > ? AND s.body_hash IS NOT n.body_hash
+                ''',
+                (NOTE_CHUNK_MIN_BYTES,),
+            )]
+
+    async def reconcile(self):
+        """Queue every long note whose chunks are missing or were cut from other content"""
+        stale = await run_db(self._scan)
+        if stale:
+            self.mark_dirty(stale)
+            logger.info("Queued %d long notes for chunking", len(stale))
+        return len(stale)
+
+    # Reads
+    def get(self, note_id):
+        """A note's chunks in order, or None if the note is short or not chunked yet"""
+        with self.get_connection() as conn:
+            rows = conn.execute(
+                "SELECT id, seq, heading, content, token_count FROM note_chunks WHERE note_id = ? ORDER BY seq",
+                (note_id,),
+            ).fetchall()
+        if not rows:
+            return None
+        return [
+            {"id": chunk_id, "seq": seq, "heading": heading, "content": content, "token_count": tokens}
+            for chunk_id, seq, heading, content, tokens in rows
+        ]
+
+    def stats(self):
+        with self.get_connection() as conn:
+            long_notes = conn.execute("SELECT COUNT(*) FROM notes WHERE size > ?", (NOTE_CHUNK_MIN_BYTES,)).fetchone()[0]
+            chunked = conn.execute("SELECT COUNT(*) FROM note_chunk_sources").fetchone()[0]
+            chunks, chunk_tokens = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(token_count), 0) FROM note_chunks"
+            ).fetchone()
+        return {
+            "long_notes": long_notes,
+            "chunked_notes": chunked,
+            "pending": self.pending(),
+            "chunks": chunks,
+            "chunk_tokens": chunk_tokens,
+            "indexed_chunks": len(self.index),
+            "chunked": self._chunked,
+            "failures": self._failures,
+        }
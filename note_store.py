@@ -0,0 +1,223 @@
+import hashlib
+import logging
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; bodies are compressed with zlib instead
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Note body storage (overridable through environment variables)
+# Bodies at least this large (UTF-8 bytes, after the preview) are stored compressed
+NOTE_COMPRESS_MIN_BYTES = int(os.getenv("NOTE_COMPRESS_MIN_BYTES", "512"))
+NOTE_CODEC = os.getenv("NOTE_CODEC", "zstd" if zstandard is not None else "zlib").lower()
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+# Leading characters of every note kept in notes.preview for list views; notes
+# no longer than this live entirely in the preview and get no body row
+PREVIEW_CHARS = 200
+MIGRATE_BATCH_SIZE = 1000
+
+if NOTE_CODEC not in ("zlib", "zstd"):
+    raise ValueError("NOTE_CODEC must be 'zlib' or 'zstd'")
+if NOTE_CODEC == "zstd" and zstandard is None:
+    raise ValueError("NOTE_CODEC=zstd requires the zstandard package")
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def body_key(content):
+    """notes.body_hash of a content: the 32-byte form of content_hash(content), None for short notes"""
+    return None if is_inline(content) else bytes.fromhex(content_hash(content))
+
+def is_inline(content):
+    return len(content) <= PREVIEW_CHARS
+
+# Codecs
+def encode_body(content):
+    """Return (codec, size, data) for storing a body; small or incompressible bodies stay raw text"""
+    raw = content.encode("utf-8")
+    if len(raw) >= NOTE_COMPRESS_MIN_BYTES:
+        if NOTE_CODEC == "zstd":
+            data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+        else:
+            data = zlib.compress(raw, ZLIB_LEVEL)
+        if len(data) < len(raw):
+            return NOTE_CODEC, len(raw), data
+    return "raw", len(raw), content
+
+def decode_body(codec, data):
+    if codec == "raw":
+        return data
+    if codec == "zlib":
+        return zlib.decompress(data).decode("utf-8")
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Note body is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    raise ValueError(f"Unknown note body codec: {codec}")
+
+def register_functions(conn):
+    """Make note_body(codec, data) available to the note_contents view, and content_hash(text) to queries
+    comparing a short note's preview with a hash stored for it"""
+    conn.create_function("note_body", 2, decode_body, deterministic=True)
+    conn.create_function("content_hash", 1, content_hash, deterministic=True)
+
+# Schema
+def init_note_store(conn):
+    """Create the notes table and its content-addressed body store.
+
+    notes rows hold a preview and the size in bytes. Short notes are stored
+    whole in the preview (with no body hash). Longer ones keep their first
+    PREVIEW_CHARS characters in the preview and the rest in note_bodies under
+    the hash of the whole content: once per distinct content, compressed when
+    large, and dropped by triggers when the last note using it goes away. The
+    note_contents view joins them back into (id, body_hash, preview, size,
+    content) for readers that need the text.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS note_bodies (
+            hash BLOB PRIMARY KEY,
+            codec TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            body_hash BLOB,
+            preview TEXT NOT NULL,
+            size INTEGER NOT NULL
+        )
+    ''')
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(notes)")}
+    migrated = "content" in columns
+    if migrated:
+        _migrate_inline_content(conn)
+    cursor.execute("CREATE INDEX IF NOT EXISTS notes_body_hash ON notes (body_hash) WHERE body_hash IS NOT NULL")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_bodies_release_delete AFTER DELETE ON notes
+        WHEN old.body_hash IS NOT NULL BEGIN
+            DELETE FROM note_bodies
+            WHERE hash = old.body_hash AND NOT EXISTS (SELECT 1 FROM notes WHERE body_hash = old.body_hash);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_bodies_release_update AFTER UPDATE OF body_hash ON notes
+        WHEN old.body_hash IS NOT NULL AND old.body_hash IS NOT new.body_hash BEGIN
+            DELETE FROM note_bodies
+            WHERE hash = old.body_hash AND NOT EXISTS (SELECT 1 FROM notes WHERE body_hash = old.body_hash);
+        END
+    ''')
+    # Raw bodies are returned as stored; only compressed ones go through the Python decoder
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS note_contents AS
+        SELECT n.id AS id, nullif(lower(hex(n.body_hash)), '') AS body_hash, n.preview AS preview, n.size AS size,
+               CASE WHEN b.hash IS NULL THEN n.preview WHEN b.codec = 'raw' THEN n.preview || b.data
+                    ELSE n.preview || note_body(b.codec, b.data) END AS content
+        FROM notes n LEFT JOIN note_bodies b ON b.hash = n.body_hash
+    ''')
+    conn.commit()
+    if migrated:
+        # Reclaim the pages that held the inline bodies
+        conn.execute("VACUUM")
+
+def _migrate_inline_content(conn):
+    """Move bodies out of a notes table that still stores them inline in notes.content"""
+    logger.info("Moving note bodies into note_bodies")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # The search index and change log triggers read notes.content; they are recreated on top of the new schema
+        for trigger in ("notes_fts_insert", "notes_fts_delete", "notes_fts_update", "note_changes_update"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.execute("DROP TABLE IF EXISTS notes_fts")
+        conn.execute("ALTER TABLE notes ADD COLUMN body_hash BLOB")
+        conn.execute("ALTER TABLE notes ADD COLUMN preview TEXT NOT NULL DEFAULT ''")
+        conn.execute("ALTER TABLE notes ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+        after_id = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, content FROM notes WHERE id > ? ORDER BY id LIMIT ?", (after_id, MIGRATE_BATCH_SIZE)
+            ).fetchall()
+            if not rows:
+                break
+            keys = store_bodies(conn, [content for _, content in rows])
+            conn.executemany(
+                "UPDATE notes SET body_hash = ?, preview = ?, size = ? WHERE id = ?",
+                (_note_row(key, content) + (note_id,) for key, (note_id, content) in zip(keys, rows)),
+            )
+            after_id = rows[-1][0]
+        conn.execute("ALTER TABLE notes DROP COLUMN content")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+# Writes; call inside a write transaction (BEGIN IMMEDIATE) so a body cannot be released between the
+# existence check and the note row that references it
+def _note_row(key, content):
+    return key, content[:PREVIEW_CHARS], len(content.encode("utf-8"))
+
+def store_bodies(conn, contents):
+    """Store the part after the preview of every long content not stored yet; returns every body key"""
+    keys = [body_key(content) for content in contents]
+    new = {}
+    for key, content in zip(keys, contents):
+        if key is None or key in new:
+            continue
+        if conn.execute("SELECT 1 FROM note_bodies WHERE hash = ?", (key,)).fetchone() is None:
+            new[key] = content
+    conn.executemany(
+        "INSERT INTO note_bodies (hash, codec, size, data) VALUES (?, ?, ?, ?)",
+        ((key, *encode_body(content[PREVIEW_CHARS:])) for key, content in new.items()),
+    )
+    return keys
+
+def insert_notes(conn, contents):
+    """Insert one note per content; IDs are contiguous while the write lock is held"""
+    keys = store_bodies(conn, contents)
+    conn.executemany(
+        "INSERT INTO notes (body_hash, preview, size) VALUES (?, ?, ?)",
+        (_note_row(key, content) for key, content in zip(keys, contents)),
+    )
+
+def update_note(conn, note_id, content):
+    """Point a note at new content; returns the number of rows updated (0 if the note does not exist)"""
+    key, = store_bodies(conn, [content])
+    rowcount = conn.execute(
+        "UPDATE notes SET body_hash = ?, preview = ?, size = ? WHERE id = ?", _note_row(key, content) + (note_id,)
+    ).rowcount
+    if not rowcount and key is not None:
+        conn.execute(
+            "DELETE FROM note_bodies WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM notes WHERE body_hash = ?)",
+            (key, key),
+        )
+    return rowcount
+
+# Reads
+def storage_stats(conn):
+    """Note count and bytes as written, and the bodies of long notes before and after compression"""
+    notes, note_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM notes").fetchone()
+    codecs = {
+        codec: {"bodies": bodies, "bytes": size, "stored_bytes": stored}
+        for codec, bodies, size, stored in conn.execute(
+            "SELECT codec, COUNT(*), SUM(size), SUM(length(CAST(data AS BLOB))) FROM note_bodies GROUP BY codec"
+        )
+    }
+    return {
+        "notes": notes,
+        "note_bytes": note_bytes,
+        "bodies": sum(entry["bodies"] for entry in codecs.values()),
+        "body_bytes": sum(entry["bytes"] for entry in codecs.values()),
+        "stored_body_bytes": sum(entry["stored_bytes"] for entry in codecs.values()),
+        "bodies_by_codec": codecs,
+    }
@@ -0,0 +1,308 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+
+from coalesce import SingleFlight
+from context_budget import count_tokens
+from coordination import release_lease, try_lease
+from db import run_db
+from llm_cache import bump_note_set_version
+from note_chunks import NOTE_CHUNK_MIN_BYTES, excerpt_chunks, is_long, split_text
+from note_store import content_hash
+from upstream import call_openai
+
+logger = logging.getLogger(__name__)
+
+NOTE_SUMMARY_PROMPT = "Summarize this note in one or two sentences. Keep names, dates and numbers."
+KEYWORD_COUNT = 8
+STOPWORDS = frozenset("""
+    a about after all also an and any are as at be because been but by can could did do does for from had has
+    have he her his how i if in into is it its just me more my no not of on or our out she so some than that
+    the their them then there these they this to too up us was we were what when which who will with would
+    you your
+""".split())
+
+def init_note_summaries(conn):
+    """Create the per-note summary table; rows are dropped with their note"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS note_summaries (
+            note_id INTEGER PRIMARY KEY REFERENCES notes (id) ON DELETE CASCADE,
+            content_hash TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            keywords TEXT NOT NULL,
+            token_count INTEGER NOT NULL,
+            summary_tokens INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    conn.commit()
+
+def extract_keywords(text, count=KEYWORD_COUNT):
+    """Most frequent non-stopword terms, earliest first on ties"""
+    words = [word for word in re.findall(r"[a-z0-9][a-z0-9'-]{2,}", text.lower()) if word not in STOPWORDS]
+    return [word for word, _ in Counter(words).most_common(count)]
+
+# The stored summary of note n (joined as s) if it was computed from the note's current content, else NULL;
+# a long note's body hash is content_hash(content) and a short note is whole in its preview
+FRESH_SUMMARY_SQL = (
+    "CASE WHEN s.content_hash = COALESCE(nullif(lower(hex(n.body_hash)), ''), content_hash(n.preview)) "
+    "THEN s.summary END"
+)
+
+# (note_id, text) for every note, using the precomputed summary where it is up to date; a long note
+# still waiting for its summary stands in with its first chunk (or preview) rather than its whole body
+COMPACT_NOTES_SQL = f'''
+    SELECT n.id, COALESCE(
+        {FRESH_SUMMARY_SQL},
+        CASE WHEN n.size > {NOTE_CHUNK_MIN_BYTES}
+             THEN COALESCE((SELECT content FROM note_chunks WHERE note_id = n.id AND seq = 0), n.preview)
+             ELSE (SELECT content FROM note_contents WHERE id = n.id) END
+    )
+    FROM notes n LEFT JOIN note_summaries s ON s.note_id = n.id
+    ORDER BY n.id
+'''
+
+
+class NoteSummaries:
+    """Per-note summary, keywords and token count, maintained in the background.
+
+    Writes mark notes dirty; a worker coalesces them and recomputes only notes
+    whose content hash changed. Short notes are their own summary, so only
+    long notes cost a model call, and notes beyond max_input_tokens are
+    summarized from evenly spaced chunks rather than sent whole. A periodic
+    reconciler compares stored hashes with the notes table and requeues
+    anything missing or stale; with several worker processes only the one
+    holding the lease runs it.
+    """
+
+    def __init__(self, client, get_connection, model="gpt-4o-mini", min_tokens=80, max_input_tokens=3000,
+                 max_workers=4, batch_size=100, reconcile_seconds=300):
+        self.client = client
+        self.get_connection = get_connection
+        self.model = model
+        self.min_tokens = min_tokens
+        self.max_input_tokens = max_input_tokens
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.reconcile_seconds = reconcile_seconds
+        self._dirty = set()
+        self._wake = asyncio.Event()
+        self._tasks = []
+        self._computed = 0
+        self._model_calls = 0
+        self._failures = 0
+        self._last_reconcile = None
+        # Notes with identical content (duplicates) share one model call
+        self._inflight = SingleFlight("note_summary")
+
+    @classmethod
+    def from_env(cls, client, get_connection):
+        return cls(
+            client,
+            get_connection,
+            model=os.getenv("NOTE_SUMMARY_MODEL", "gpt-4o-mini"),
+            min_tokens=int(os.getenv("NOTE_SUMMARY_MIN_TOKENS", "80")),
+            max_input_tokens=int(os.getenv("NOTE_SUMMARY_MAX_INPUT_TOKENS", "3000")),
+            max_workers=int(os.getenv("NOTE_SUMMARY_MAX_WORKERS", "4")),
+            reconcile_seconds=float(os.getenv("NOTE_SUMMARY_RECONCILE_SECONDS", "300")),
+        )
+
+    # Lifecycle
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()), asyncio.create_task(self._reconcile_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await run_db(self._lease, False)
+
+    def _lease(self, take=True):
+        with self.get_connection() as conn:
+            if take:
+                return try_lease(conn, "note_summaries.reconcile", self.reconcile_seconds * 2)
+            release_lease(conn, "note_summaries.reconcile")
+
+    def pending(self):
+        return len(self._dirty)
+
+    def mark_dirty(self, note_ids):
+        """Queue notes for (re)summarization after a committed write"""
+        self._dirty.update(int(note_id) for note_id in note_ids)
+        self._wake.set()
+
+    async def _worker(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while self._dirty:
+                batch = [self._dirty.pop() for _ in range(min(self.batch_size, len(self._dirty)))]
+                try:
+                    await self.refresh(batch)
+                except Exception as e:
+                    # The reconciler picks these notes up again on its next pass
+                    self._failures += 1
+                    logger.warning("Note summary refresh failed for %d notes: %s", len(batch), e)
+
+    async def _reconcile_loop(self):
+        while True:
+            try:
+                if await run_db(self._lease):
+                    await self.reconcile()
+            except Exception as e:
+                logger.warning("Note summary reconcile failed: %s", e)
+            await asyncio.sleep(self.reconcile_seconds)
+
+    # Computation
+    async def summarize_note(self, content):
+        """Return (summary, keywords, token_count) for one note"""
+        if is_long(content):
+            # Tokenizing and scanning a multi-megabyte note would stall the event loop
+            tokens = await asyncio.to_thread(count_tokens, content, self.model)
+            keywords = await asyncio.to_thread(extract_keywords, content)
+        else:
+            tokens = count_tokens(content, self.model)
+            keywords = extract_keywords(content)
+        text, text_tokens = content, tokens
+        if tokens > self.max_input_tokens:
+            chunks = await asyncio.to_thread(split_text, content, model=self.model)
+            text = "\n\n".join(excerpt_chunks(chunks, self.max_input_tokens))
+            text_tokens = count_tokens(text, self.model)
+        if tokens <= self.min_tokens:
+            summary = content.strip()
+        else:
+            response = await call_openai(lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": NOTE_SUMMARY_PROMPT},
+                    {"role": "user", "content": text},
+                ],
+                max_tokens=120,
+                temperature=0.2,
+            ), tokens=text_tokens + 120, kind="note_summary")
+            self._model_calls += 1
+            summary = response.choices[0].message.content.strip()
+        return summary, keywords, tokens
+
+    def _load_stale(self, note_ids):
+        placeholders = ",".join("?" * len(note_ids))
+        with self.get_connection() as conn:
+            # A long note's body hash is content_hash(content), so unchanged ones are skipped without reading
+            # their body; short notes are read whole from the preview
+            rows = conn.execute(
+                f'''
+                SELECT n.id, n.content, s.content_hash
+                FROM note_contents n LEFT JOIN note_summaries s ON s.note_id = n.id
+                WHERE n.id IN ({placeholders}) AND (n.body_hash IS NULL OR s.content_hash IS NOT n.body_hash)
+                ''',
+                note_ids,
+            ).fetchall()
+        return [(note_id, content) for note_id, content, stored in rows if stored != content_hash(content)]
+
+    def _store(self, rows):
+        with self.get_connection() as conn:
+            # Notes deleted while their summary was computed are skipped
+            stored = conn.executemany(
+                '''
+                INSERT OR REPLACE INTO note_summaries
+                    (note_id, content_hash, summary, keywords, token_count, summary_tokens, updated_at)
+                SELECT ?, ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM notes WHERE id = ?)
+                ''',
+                rows,
+            ).rowcount
+            if stored:
+                # /summarize and /ask answers cached for this note set were built without these summaries
+                bump_note_set_version(conn)
+            conn.commit()
+
+    async def refresh(self, note_ids):
+        """Recompute summaries for the given notes whose content hash changed"""
+        stale = await run_db(self._load_stale, list(note_ids))
+        if not stale:
+            return 0
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def compute(note_id, content):
+            async with semaphore:
+                summary, keywords, tokens = await self._inflight.do(
+                    content_hash(self.model, content), lambda: self.summarize_note(content)
+                )
+            return (note_id, content_hash(content), summary, json.dumps(keywords), tokens,
+                    count_tokens(summary, self.model), time.time(), note_id)
+
+        rows = await asyncio.gather(*(compute(note_id, content) for note_id, content in stale))
+        await run_db(self._store, rows)
+        self._computed += len(rows)
+        return len(rows)
+
+    def _scan(self, after_id, limit):
+        with self.get_connection() as conn:
+            return conn.execute(
+                '''
+                SELECT n.id, nullif(lower(hex(n.body_hash)), ''), n.preview, s.content_hash
+                FROM notes n LEFT JOIN note_summaries s ON s.note_id = n.id
+                WHERE n.id > ? ORDER BY n.id LIMIT ?
+                ''',
+                (after_id, limit),
+            ).fetchall()
+
+    async def reconcile(self, scan_size=500):
+        """Queue every note whose summary is missing or was computed from other content"""
+        queued = 0
+        after_id = 0
+        while True:
+            rows = await run_db(self._scan, after_id, scan_size)
+            if not rows:
+                break
+            stale = [note_id for note_id, body_hash, preview, stored in rows
+                     if stored != (body_hash or content_hash(preview))]
+            if stale:
+                self.mark_dirty(stale)
+                queued += len(stale)
+            after_id = rows[-1][0]
+        self._last_reconcile = time.time()
+        if queued:
+            logger.info("Reconciler queued %d stale note summaries", queued)
+        return queued
+
+    # Reads
+    def get(self, note_id):
+        """Stored summary for one note, or None (may lag behind a very recent edit)"""
+        with self.get_connection() as conn:
+            row = conn.execute(
+                "SELECT summary, keywords, token_count, updated_at FROM note_summaries WHERE note_id = ?",
+                (note_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        summary, keywords, token_count, updated_at = row
+        return {
+            "note_id": note_id,
+            "summary": summary,
+            "keywords": json.loads(keywords),
+            "token_count": token_count,
+            "updated_at": updated_at,
+        }
+
+    def stats(self):
+        with self.get_connection() as conn:
+            notes = conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+            summarized, note_tokens, summary_tokens = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(token_count), 0), COALESCE(SUM(summary_tokens), 0) FROM note_summaries"
+            ).fetchone()
+        return {
+            "notes": notes,
+            "summarized": summarized,
+            "pending": self.pending(),
+            "note_tokens": note_tokens,
+            "summary_tokens": summary_tokens,
+            "computed": self._computed,
+            "model_calls": self._model_calls,
+            "failures": self._failures,
+            "last_reconcile": self._last_reconcile,
+        }
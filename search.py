@@ -0,0 +1,109 @@
+import re
+
+from note_chunks import NOTE_CHUNK_MIN_BYTES
+
+def init_search_index(conn):
+    """Create the FTS5 index over notes and the triggers that keep it in sync"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'")
+    exists = cursor.fetchone() is not None
+    # External-content table: the index stores tokens only, text is read back through note_contents
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            content,
+            content='note_contents',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, content) SELECT id, content FROM note_contents WHERE id = new.id;
+        END
+    ''')
+    # Removing a row needs its old text, so deletes run while the row and its body still exist
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete BEFORE DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, content)
+            SELECT 'delete', id, content FROM note_contents WHERE id = old.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update_delete BEFORE UPDATE OF body_hash ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, content)
+            SELECT 'delete', id, content FROM note_contents WHERE id = old.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update_insert AFTER UPDATE OF body_hash ON notes BEGIN
+            INSERT INTO notes_fts (rowid, content) SELECT id, content FROM note_contents WHERE id = new.id;
+        END
+    ''')
+    if not exists:
+        # Index notes written before the FTS table existed
+        cursor.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+    conn.commit()
+
+def build_match_query(query, prefix=False):
+    """Turn free text into a safe FTS5 MATCH expression.
+
+    Every term is quoted so user input cannot inject FTS syntax. A term ending
+    in '*' becomes a prefix query, and prefix=True does the same for the last
+    term (search-as-you-type). Terms are ANDed together.
+    """
+    terms = []
+    for raw in query.split():
+        is_prefix = raw.endswith("*")
+        term = re.sub(r"[^\w]+", " ", raw).strip()
+        for word in term.split():
+            terms.append([word, False])
+        if terms and is_prefix and term:
+            terms[-1][1] = True
+    if not terms:
+        return None
+    if prefix:
+        terms[-1][1] = True
+    return " ".join(f'"{word}"' + ("*" if is_prefix else "") for word, is_prefix in terms)
+
+def search_notes(conn, match, limit, offset, snippet_tokens=16, highlight=("<mark>", "</mark>")):
+    """Return (id, bm25 score, snippet) rows ordered by relevance.
+
+    Ranking needs only the index, but a snippet reads the note's text; for
+    long notes the snippet comes from their best matching chunk instead of
+    decompressing the whole body (or is the preview until they are chunked).
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        '''
+        SELECT rowid, bm25(notes_fts),
+               CASE WHEN (SELECT size FROM notes WHERE id = notes_fts.rowid) > ? THEN NULL
+                    ELSE snippet(notes_fts, 0, ?, ?, '…', ?) END
+        FROM notes_fts
+        WHERE notes_fts MATCH ?
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+        ''',
+        (NOTE_CHUNK_MIN_BYTES, highlight[0], highlight[1], snippet_tokens, match, limit, offset),
+    )
+    rows = cursor.fetchall()
+    return [
+        (note_id, score, snippet if snippet is not None else _chunk_snippet(conn, note_id, match, snippet_tokens, highlight))
+        for note_id, score, snippet in rows
+    ]
+
+def _chunk_snippet(conn, note_id, match, snippet_tokens, highlight):
+    row = conn.execute(
+        '''
+        SELECT snippet(note_chunks_fts, 0, ?, ?, '…', ?)
+        FROM note_chunks_fts
+        WHERE note_chunks_fts MATCH ? AND rowid IN (SELECT id FROM note_chunks WHERE note_id = ?)
+        ORDER BY rank
+        LIMIT 1
+        ''',
+        (highlight[0], highlight[1], snippet_tokens, match, note_id),
+    ).fetchone()
+    if row is None:
+        # Terms matching only across a chunk boundary, or a note still waiting to be chunked
+        row = conn.execute("SELECT preview FROM notes WHERE id = ?", (note_id,)).fetchone()
+    return row[0] if row else ""
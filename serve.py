@@ -0,0 +1,78 @@
+"""Production launcher: serve app:app from several worker processes.
+
+    python serve.py
+    WEB_CONCURRENCY=8 PORT=8000 python serve.py
+
+With gunicorn installed, it manages uvicorn workers (restarting ones that
+hang or die, and recycling them after WORKER_MAX_REQUESTS requests);
+otherwise uvicorn's own process manager is used. Each worker imports the
+app without I/O and initializes in its lifespan hook; see coordination.py
+for what the workers share.
+
+Metrics are not shared: /metrics, /upstream/stats and the other stats
+endpoints describe only the worker that happened to accept the request.
+To see every worker, run single-worker instances on separate ports
+(WEB_CONCURRENCY=1) and scrape and sum each one.
+"""
+import os
+
+from dotenv import load_dotenv
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # gunicorn is optional; uvicorn supervises the workers instead
+    BaseApplication = None
+
+load_dotenv()
+
+# Server settings (overridable through environment variables)
+HOST = os.getenv("HOST", "127.0.0.1")
+PORT = int(os.getenv("PORT", "8000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+# A gunicorn worker silent for this long is killed and replaced
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT", "120"))
+# Time a stopping worker gets to finish in-flight requests and hand back its jobs
+WORKER_GRACEFUL_TIMEOUT = int(os.getenv("WORKER_GRACEFUL_TIMEOUT", "30"))
+# Recycle a gunicorn worker after this many requests (0 never), with jitter so they do not restart together
+WORKER_MAX_REQUESTS = int(os.getenv("WORKER_MAX_REQUESTS", "0"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
+
+# Workers read this to take their share of the OpenAI rate limits
+os.environ["WEB_CONCURRENCY"] = str(WEB_CONCURRENCY)
+
+
+if BaseApplication is not None:
+    class GunicornApp(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app import app
+            return app
+
+
+def main():
+    if BaseApplication is not None:
+        GunicornApp({
+            "bind": f"{HOST}:{PORT}",
+            "workers": WEB_CONCURRENCY,
+            "worker_class": "uvicorn.workers.UvicornWorker",
+            "timeout": WORKER_TIMEOUT,
+            "graceful_timeout": WORKER_GRACEFUL_TIMEOUT,
+            "max_requests": WORKER_MAX_REQUESTS,
+            "max_requests_jitter": WORKER_MAX_REQUESTS // 10,
+            "loglevel": LOG_LEVEL,
+        }).run()
+    else:
+        import uvicorn
+        uvicorn.run("app:app", host=HOST, port=PORT, workers=WEB_CONCURRENCY, log_level=LOG_LEVEL,
+                    timeout_graceful_shutdown=WORKER_GRACEFUL_TIMEOUT)
+
+
+if __name__ == "__main__":
+    main()
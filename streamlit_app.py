@@ -1,5 +1,11 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+import json
+import csv
+import html
+import io
+import time
 from datetime import datetime
 
 # Configure the page
@@ -16,6 +22,17 @@ st.markdown("**Bay2BayHacks2025** - Create, manage, and get AI insights from you
 # API base URL
 API_BASE_URL = "http://localhost:8000"
 
+# Notes fetched per /get_notes or /search page on the View Notes page
+NOTES_PAGE_SIZE = 50
+NOTES_PREVIEW_CHARS = 200
+
+# Connections kept open to the API, shared by every browser session
+HTTP_POOL_SIZE = 16
+# (connect, read) timeout in seconds; long enough for uploads and summaries
+REQUEST_TIMEOUT = (5, 300)
+# Cached note lists are refetched after this many seconds even without local changes
+NOTES_CACHE_TTL = 30
+
 # Sidebar for navigation
 st.sidebar.title("Navigation")
 page = st.sidebar.selectbox(
@@ -26,28 +43,39 @@ page = st.sidebar.selectbox(
 # Initialize session state for editing and delete confirmations
 # Note: Session state variables are created dynamically as needed
 
+# Pooled HTTP session so reruns reuse open connections instead of reconnecting
+@st.cache_resource
+def get_http_session():
+    """One requests.Session with a connection pool, shared across reruns and browser sessions"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 # Function to make API calls to the FastAPI backend
 def make_api_call(endpoint, method="GET", data=None, show_response=True, files=None):
     try:
         url = f"{API_BASE_URL}{endpoint}"
+        session = get_http_session()
         response = None
         
         if method == "GET":
-            response = requests.get(url)
+            response = session.get(url, timeout=REQUEST_TIMEOUT)
         elif method == "POST":
             if files:
-                response = requests.post(url, files=files)
+                response = session.post(url, files=files, timeout=REQUEST_TIMEOUT)
             else:
-                response = requests.post(url, json=data)
+                response = session.post(url, json=data, timeout=REQUEST_TIMEOUT)
         elif method == "PUT":
-            response = requests.put(url, json=data)
+            response = session.put(url, json=data, timeout=REQUEST_TIMEOUT)
         elif method == "DELETE":
-            response = requests.delete(url)
+            response = session.delete(url, timeout=REQUEST_TIMEOUT)
         else:
             st.error(f"❌ Unsupported HTTP method: {method}")
             return None
         
-        if response and response.status_code == 200:
+        if response is not None and response.status_code in (200, 202):
             result = response.json()
             # Print the return message for debugging/information (only if show_response=True)
             if show_response:
@@ -69,6 +97,214 @@ def make_api_call(endpoint, method="GET", data=None, show_response=True, files=N
         st.error(f"❌ Error: {str(e)}")
         return None
 
+# Cached readers for the View Notes page. They raise on errors so failures are never cached.
+def api_get(endpoint, params=None):
+    response = get_http_session().get(f"{API_BASE_URL}{endpoint}", params=params, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+@st.cache_data(ttl=NOTES_CACHE_TTL, show_spinner=False)
+def fetch_notes_page(after_id=None):
+    """One page of (id, preview) rows, newest first"""
+    params = {"limit": NOTES_PAGE_SIZE, "fields": "preview", "preview_chars": NOTES_PREVIEW_CHARS}
+    if after_id is not None:
+        params["after_id"] = after_id
+    return api_get("/get_notes", params)
+
+@st.cache_data(ttl=NOTES_CACHE_TTL, show_spinner=False)
+def fetch_note(note_id):
+    """Full content of one note, or None if it no longer exists"""
+    rows = api_get("/get_notes", {"limit": 1, "after_id": note_id + 1})
+    return rows[0][1] if rows and rows[0][0] == note_id else None
+
+@st.cache_data(ttl=NOTES_CACHE_TTL, show_spinner=False)
+def fetch_search_page(query, offset=0):
+    """One page of full-text search hits; the last word is matched as a prefix"""
+    return api_get("/search", {"q": query, "limit": NOTES_PAGE_SIZE, "offset": offset, "prefix": "true"})
+
+def invalidate_notes_cache():
+    """Drop cached note lists after this client adds, edits or deletes notes"""
+    fetch_notes_page.clear()
+    fetch_note.clear()
+    fetch_search_page.clear()
+
+def load_notes(query, pages):
+    """Return ([(id, preview), ...], has_more) for the first `pages` pages of the list or the search hits"""
+    notes = []
+    after_id, offset = None, 0
+    has_more = False
+    for _ in range(pages):
+        if query:
+            result = fetch_search_page(query, offset)
+            notes.extend((hit["id"], hit["snippet"]) for hit in result["results"])
+            offset = result["next_offset"]
+            has_more = offset is not None
+        else:
+            rows = fetch_notes_page(after_id)
+            notes.extend((row[0], row[1]) for row in rows)
+            has_more = len(rows) == NOTES_PAGE_SIZE
+            after_id = rows[-1][0] if rows else None
+        if not has_more:
+            break
+    return notes, has_more
+
+def escape_snippet(snippet):
+    """Escape a search snippet for HTML while keeping its <mark> highlights"""
+    return html.escape(snippet).replace("&lt;mark&gt;", "<mark>").replace("&lt;/mark&gt;", "</mark>")
+
+# Function to split a CSV / JSON / JSON-lines file into one note per record
+def parse_multi_note_file(filename, text):
+    """Return a list of note contents, or None if the file is not a multi-note format"""
+    extension = filename.rsplit(".", 1)[-1].lower()
+    
+    def to_content(item):
+        if isinstance(item, dict):
+            return item.get("content") if "content" in item else json.dumps(item)
+        return item if isinstance(item, str) else json.dumps(item)
+    
+    if extension == "csv":
+        rows = list(csv.reader(io.StringIO(text)))
+        if rows and "content" in [cell.strip().lower() for cell in rows[0]]:
+            # Use the "content" column when the file has a header
+            column = [cell.strip().lower() for cell in rows[0]].index("content")
+            return [row[column] for row in rows[1:] if len(row) > column and row[column].strip()]
+        return [", ".join(row) for row in rows if any(cell.strip() for cell in row)]
+    if extension in ("jsonl", "ndjson"):
+        return [to_content(json.loads(line)) for line in text.splitlines() if line.strip()]
+    if extension == "json":
+        data = json.loads(text)
+        if isinstance(data, list):
+            return [to_content(item) for item in data]
+    return None
+
+# Function to stream tokens from a server-sent events endpoint
+def stream_api_call(endpoint, data=None):
+    """Yield text tokens from a streaming endpoint as they arrive (for st.write_stream)"""
+    url = f"{API_BASE_URL}{endpoint}"
+    try:
+        with get_http_session().post(url, json=data, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            if response.status_code != 200:
+                st.error(f"API Error: {response.status_code} - {response.text}")
+                return
+            event = "message"
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    payload = json.loads(line[len("data:"):].strip())
+                    if event == "token":
+                        yield payload["text"]
+                    elif event == "error":
+                        st.error(f"❌ Error: {payload['detail']}")
+                        return
+                    elif event == "done":
+                        return
+    except requests.exceptions.ConnectionError:
+        st.error("❌ Cannot connect to the API. Make sure your FastAPI server is running on http://localhost:8000")
+
+# One note card on the View Notes page. As a fragment, its buttons rerun only this card;
+# changes that affect the list (save, delete) rerun the whole page.
+@st.fragment
+def render_note_card(note_id, preview):
+    label = preview.replace("<mark>", "").replace("</mark>", "").replace("\n", " ")[:50]
+    with st.expander(f"📄 Note #{note_id} - {label}..."):
+        st.write(f"**ID:** {note_id}")
+        
+        # Check if this note is being edited
+        is_editing = st.session_state.get(f"editing_{note_id}", False)
+        
+        if is_editing:
+            # Edit mode needs the full note, fetched only now
+            try:
+                content = fetch_note(note_id)
+            except requests.exceptions.RequestException as e:
+                st.error(f"❌ Error loading note: {str(e)}")
+                return
+            if content is None:
+                st.warning(f"⚠️ Note #{note_id} no longer exists")
+                return
+            edited_content = st.text_area(
+                "Edit Note:",
+                value=content,
+                height=150,
+                key=f"edit_text_{note_id}"
+            )
+            
+            col1, col2, col3 = st.columns([1, 1, 2])
+            with col1:
+                if st.button(f"💾 Save", key=f"save_{note_id}"):
+                    if edited_content.strip():
+                        result = make_api_call(f"/edit_note/{note_id}", method="PUT", data={"content": edited_content}, show_response=False)
+                        if result:
+                            st.success(f"✅ Note #{note_id} updated successfully!")
+                            st.session_state[f"editing_{note_id}"] = False
+                            invalidate_notes_cache()
+                            st.rerun()
+                    else:
+                        st.error("❌ Note content cannot be empty!")
+            
+            with col2:
+                if st.button(f"❌ Cancel", key=f"cancel_{note_id}"):
+                    st.session_state[f"editing_{note_id}"] = False
+                    st.rerun(scope="fragment")
+        else:
+            # View mode shows the preview until the full note is asked for
+            if st.session_state.get(f"full_{note_id}", False):
+                try:
+                    content = fetch_note(note_id)
+                except requests.exceptions.RequestException as e:
+                    content = None
+                    st.error(f"❌ Error loading note: {str(e)}")
+                st.write(f"**Content:** {content if content is not None else preview}")
+            else:
+                st.markdown(f"**Content:** {escape_snippet(preview)}", unsafe_allow_html=True)
+            st.write(f"**Added:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            
+            # Action buttons
+            col1, col2, col3 = st.columns([1, 1, 2])
+            
+            with col1:
+                if st.button(f"✏️ Edit", key=f"edit_{note_id}"):
+                    st.session_state[f"editing_{note_id}"] = True
+                    st.rerun(scope="fragment")
+            
+            with col2:
+                if st.button(f"🗑️ Delete", key=f"delete_{note_id}"):
+                    # Two-step delete confirmation: first click sets flag, second click deletes
+                    if st.session_state.get(f"confirm_delete_{note_id}", False):
+                        # Second click: actually delete the note
+                        result = make_api_call(f"/delete_note/{note_id}", method="DELETE", show_response=False)
+                        if result:
+                            st.success(f"✅ Note #{note_id} deleted successfully!")
+                            # Clear the confirmation flag
+                            if f"confirm_delete_{note_id}" in st.session_state:
+                                del st.session_state[f"confirm_delete_{note_id}"]
+                            invalidate_notes_cache()
+                            st.rerun()
+                    else:
+                        # First click: set confirmation flag for next click
+                        st.session_state[f"confirm_delete_{note_id}"] = True
+                        st.rerun(scope="fragment")
+            
+            with col3:
+                if not st.session_state.get(f"full_{note_id}", False) and st.button("📖 Show full note", key=f"full_button_{note_id}"):
+                    st.session_state[f"full_{note_id}"] = True
+                    st.rerun(scope="fragment")
+            
+            # Show confirmation UI when delete is pending
+            if st.session_state.get(f"confirm_delete_{note_id}", False):
+                st.warning(f"⚠️ Click '✅Confirm Delete' to delete the Note #{note_id}")
+                with col1:
+                    if st.button(f"✅ Confirm Delete", key=f"confirm_{note_id}"):
+                        result = make_api_call(f"/delete_note/{note_id}", method="DELETE", show_response=False)
+                        if result:
+                            st.success(f"✅ Note #{note_id} deleted successfully!")
+                            # Clear the confirmation flag
+                            if f"confirm_delete_{note_id}" in st.session_state:
+                                del st.session_state[f"confirm_delete_{note_id}"]
+                            invalidate_notes_cache()
+                            st.rerun()
+
 # Page 1: Add Note
 if page == "📝 Add Note":
     st.header("📝 Add a New Note")
@@ -79,8 +315,8 @@ if page == "📝 Add Note":
     # Text file upload
     uploaded_text_file = st.file_uploader(
         "Choose a text file to upload",
-        type=['txt', 'md', 'csv', 'json'],
-        help="Upload a text file to convert its content into a note",
+        type=['txt', 'md', 'csv', 'json', 'jsonl', 'ndjson'],
+        help="Upload a text file to convert its content into a note. CSV, JSON arrays and JSON lines can also be imported as one note per record.",
         key="text_uploader"
     )
     
@@ -94,6 +330,7 @@ if page == "📝 Add Note":
     
     # Handle text file upload
     if uploaded_text_file is not None:
+        file_content = None
         try:
             # Check file size (limit to 5MB for text files)
             if uploaded_text_file.size and uploaded_text_file.size > 5 * 1024 * 1024:
@@ -113,10 +350,33 @@ if page == "📝 Add Note":
                 if file_content:
                     result = make_api_call("/add_note", method="POST", data={"content": file_content})
                     if result:
+                        invalidate_notes_cache()
                         st.balloons()
                         st.rerun()
                 else:
                     st.error("❌ No valid content to save")
+            
+            # Multi-note files (one note per CSV row / JSON record) go through the bulk endpoint
+            if file_content and uploaded_text_file.name.rsplit(".", 1)[-1].lower() in ("csv", "json", "jsonl", "ndjson"):
+                if st.button("📚 Import as Multiple Notes", key="save_bulk"):
+                    try:
+                        records = parse_multi_note_file(uploaded_text_file.name, file_content)
+                    except (ValueError, csv.Error) as e:
+                        records = None
+                        st.error(f"❌ Could not parse file: {str(e)}")
+                    if records:
+                        with st.spinner(f"📚 Importing {len(records)} notes..."):
+                            result = make_api_call("/add_notes/bulk", method="POST", data=[{"content": record} for record in records])
+                        if result:
+                            invalidate_notes_cache()
+                            if result.get("failed"):
+                                st.warning(f"⚠️ {result['failed']} records could not be imported")
+                                for error in result.get("errors", [])[:10]:
+                                    st.write(f"Record {error['row'] + 1}: {error['error']}")
+                            else:
+                                st.balloons()
+                    elif records is not None:
+                        st.error("❌ No records found in file")
         except Exception as e:
             st.error(f"❌ Error reading text file: {str(e)}")
     
@@ -135,6 +395,7 @@ if page == "📝 Add Note":
                 if st.button("💾 Save Transcription as Note", key="save_audio_session"):
                     note_result = make_api_call("/add_note", method="POST", data={"content": st.session_state.transcribed_text}, show_response=True)
                     if note_result:
+                        invalidate_notes_cache()
                         st.success("✅ Transcription saved as note!")
                         st.balloons()
                         # Clear the transcribed text from session state
@@ -146,9 +407,22 @@ if page == "📝 Add Note":
             # Add button to convert audio to text
             if st.button("🎤 Convert Audio to Text", key="convert_audio"):
                 with st.spinner("🎤 Converting audio to text using OpenAI Whisper..."):
-                    # Send audio file to FastAPI for transcription
+                    # Send audio file to FastAPI as a background job and poll its progress
                     files = {"audio_file": (uploaded_audio_file.name, uploaded_audio_file.getvalue(), uploaded_audio_file.type)}
-                    result = make_api_call("/transcribe_audio", method="POST", files=files, show_response=False)
+                    job = make_api_call("/transcribe_audio/jobs", method="POST", files=files, show_response=False)
+                    result = None
+                    if job:
+                        progress_bar = st.progress(0.0, text="Transcribing...")
+                        while job and job["status"] in ("queued", "running"):
+                            time.sleep(1)
+                            job = make_api_call(f"/transcribe_audio/jobs/{job['id']}", show_response=False)
+                            if job and job["progress"]["total"]:
+                                done, total = job["progress"]["done"], job["progress"]["total"]
+                                progress_bar.progress(done / total, text=f"Transcribed {done} of {total} segments")
+                        if job and job["status"] == "completed":
+                            result = job["result"]
+                        elif job and job.get("error"):
+                            st.error(f"❌ {job['error']}")
                     
                     if result and "transcription" in result:
                         transcribed_text = result["transcription"]
@@ -179,6 +453,7 @@ if page == "📝 Add Note":
             if note_content.strip():
                 result = make_api_call("/add_note", method="POST", data={"content": note_content})
                 if result:
+                    invalidate_notes_cache()
                     st.balloons()
                     st.rerun()
             else:
@@ -188,94 +463,47 @@ if page == "📝 Add Note":
 elif page == "📋 View Notes":
     st.header("📋 Your Notes")
     
-    # Refresh button
-    if st.button("🔄 Refresh Notes"):
-        st.rerun()
+    col_search, col_refresh = st.columns([4, 1])
+    with col_search:
+        # Text inputs submit on Enter or when focus leaves; the last word is matched as a prefix
+        query = st.text_input("🔎 Search notes", placeholder="Search your notes and press Enter...", key="notes_search").strip()
+    with col_refresh:
+        # Refresh button
+        if st.button("🔄 Refresh Notes"):
+            invalidate_notes_cache()
+            st.rerun()
+    
+    # Notes are loaded one cached page at a time; a new query starts again from the first page
+    if "notes_pages" not in st.session_state or st.session_state.get("notes_query") != query:
+        st.session_state.notes_pages = 1
+        st.session_state.notes_query = query
     
-    # Get notes from API
-    notes = make_api_call("/get_notes", show_response=False)
+    try:
+        notes, has_more = load_notes(query, st.session_state.notes_pages)
+    except requests.exceptions.ConnectionError:
+        notes, has_more = None, False
+        st.error("❌ Cannot connect to the API. Make sure your FastAPI server is running on http://localhost:8000")
+    except requests.exceptions.RequestException as e:
+        notes, has_more = None, False
+        st.error(f"❌ Error loading notes: {str(e)}")
     
-    if notes:
+    if notes is not None:
         if len(notes) == 0:
-            st.info("📭 No notes found. Add some notes to get started!")
+            if query:
+                st.info(f"🔎 No notes match '{query}'")
+            else:
+                st.info("📭 No notes found. Add some notes to get started!")
         else:
-            st.success(f"📊 Found {len(notes)} notes")
+            found = f"🔎 {len(notes)} matching notes" if query else f"📊 Showing {len(notes)} notes"
+            st.success(found + (" (more available)" if has_more else ""))
             
             # Display notes in a nice format
-            for i, note in enumerate(notes, 1):
-                with st.expander(f"📄 Note #{note[0]} - {note[1][:50]}..."):
-                    st.write(f"**ID:** {note[0]}")
-                    
-                    # Check if this note is being edited
-                    is_editing = st.session_state.get(f"editing_{note[0]}", False)
-                    
-                    if is_editing:
-                        # Edit mode
-                        edited_content = st.text_area(
-                            "Edit Note:",
-                            value=note[1],
-                            height=150,
-                            key=f"edit_text_{note[0]}"
-                        )
-                        
-                        col1, col2, col3 = st.columns([1, 1, 2])
-                        with col1:
-                            if st.button(f"💾 Save", key=f"save_{note[0]}"):
-                                if edited_content.strip():
-                                    result = make_api_call(f"/edit_note/{note[0]}", method="PUT", data={"content": edited_content}, show_response=False)
-                                    if result:
-                                        st.success(f"✅ Note #{note[0]} updated successfully!")
-                                        st.session_state[f"editing_{note[0]}"] = False
-                                        st.rerun()
-                                else:
-                                    st.error("❌ Note content cannot be empty!")
-                        
-                        with col2:
-                            if st.button(f"❌ Cancel", key=f"cancel_{note[0]}"):
-                                st.session_state[f"editing_{note[0]}"] = False
-                                st.rerun()
-                    else:
-                        # View mode
-                        st.write(f"**Content:** {note[1]}")
-                        st.write(f"**Added:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-                        
-                        # Action buttons
-                        col1, col2, col3 = st.columns([1, 1, 2])
-                        
-                        with col1:
-                            if st.button(f"✏️ Edit", key=f"edit_{note[0]}"):
-                                st.session_state[f"editing_{note[0]}"] = True
-                                st.rerun()
-                        
-                        with col2:
-                            if st.button(f"🗑️ Delete", key=f"delete_{note[0]}"):
-                                # Two-step delete confirmation: first click sets flag, second click deletes
-                                if st.session_state.get(f"confirm_delete_{note[0]}", False):
-                                    # Second click: actually delete the note
-                                    result = make_api_call(f"/delete_note/{note[0]}", method="DELETE", show_response=False)
-                                    if result:
-                                        st.success(f"✅ Note #{note[0]} deleted successfully!")
-                                        # Clear the confirmation flag
-                                        if f"confirm_delete_{note[0]}" in st.session_state:
-                                            del st.session_state[f"confirm_delete_{note[0]}"]
-                                        st.rerun()
-                                else:
-                                    # First click: set confirmation flag for next click
-                                    st.session_state[f"confirm_delete_{note[0]}"] = True
-                                    st.rerun()
-                        
-                        # Show confirmation UI when delete is pending
-                        if st.session_state.get(f"confirm_delete_{note[0]}", False):
-                            st.warning(f"⚠️ Click '✅Confirm Delete' to delete the Note #{note[0]}")
-                            with col1:
-                                if st.button(f"✅ Confirm Delete", key=f"confirm_{note[0]}"):
-                                    result = make_api_call(f"/delete_note/{note[0]}", method="DELETE", show_response=False)
-                                    if result:
-                                        st.success(f"✅ Note #{note[0]} deleted successfully!")
-                                        # Clear the confirmation flag
-                                        if f"confirm_delete_{note[0]}" in st.session_state:
-                                            del st.session_state[f"confirm_delete_{note[0]}"]
-                                        st.rerun()
+            for note_id, preview in notes:
+                render_note_card(note_id, preview)
+
+            if has_more and st.button("⬇️ Load more notes" if query else "⬇️ Load older notes"):
+                st.session_state.notes_pages += 1
+                st.rerun()
 
 # Page 3: Summarize Notes
 elif page == "🤖 Summarize Notes":
@@ -283,14 +511,13 @@ elif page == "🤖 Summarize Notes":
     st.markdown("Get an AI-powered summary of all your notes!")
     
     if st.button("🧠 Generate Summary"):
-        with st.spinner("🤖 AI is analyzing your notes..."):
-            summary = make_api_call("/summarize", method="POST", show_response=False)
-            
-            if summary:
-                st.success("✅ Summary generated!")
-                st.markdown("---")
-                st.markdown("### 📋 Summary:")
-                st.write(summary)
+        st.markdown("---")
+        st.markdown("### 📋 Summary:")
+        # Tokens are rendered as they arrive from the server
+        summary = st.write_stream(stream_api_call("/summarize/stream"))
+        
+        if summary:
+            st.success("✅ Summary generated!")
 
 # Page 4: Ask Questions
 elif page == "❓ Ask Questions":
@@ -308,15 +535,14 @@ elif page == "❓ Ask Questions":
         
         if submitted:
             if question.strip():
-                with st.spinner("🤖 AI is thinking..."):
-                    result = make_api_call("/ask", method="POST", data={"query": question}, show_response=False)
-                    
-                    if result:
-                        st.success("✅ Answer generated!")
-                        st.markdown("---")
-                        st.markdown("### 🤖 AI Answer:")
-                        st.write(result)
-                        
+                st.markdown("---")
+                st.markdown("### 🤖 AI Answer:")
+                # Tokens are rendered as they arrive from the server
+                result = st.write_stream(stream_api_call("/ask/stream", data={"query": question}))
+                
+                if result:
+                    st.success("✅ Answer generated!")
+                
             else:
                 st.error("❌ Please enter a question!")
 
@@ -343,7 +569,7 @@ st.sidebar.markdown("---")
 st.sidebar.markdown("### ⚙️ API Status")
 if st.sidebar.button("🔍 Check API"):
     try:
-        response = requests.get(f"{API_BASE_URL}/docs")
+        response = get_http_session().get(f"{API_BASE_URL}/docs", timeout=REQUEST_TIMEOUT)
         if response.status_code == 200:
             st.sidebar.success("✅ API is running")
         else:
@@ -0,0 +1,251 @@
+import asyncio
+import os
+import time
+
+from coalesce import SingleFlight
+from context_budget import count_tokens, split_tokens, truncate_tokens
+from db import run_db
+from note_store import content_hash
+from upstream import call_openai
+
+MAP_PROMPT = "Concisely summarize the following notes."
+REDUCE_PROMPT = "Combine the following partial summaries of a user's notes into one concise summary."
+
+def init_summary_cache(conn):
+    """Create the table holding persisted chunk and reduce summaries"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS summary_cache (
+            hash TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_used_at REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(summary_cache)")]
+    if "last_used_at" not in columns:
+        # Summaries cached before eviction existed are the first to go
+        conn.execute("ALTER TABLE summary_cache ADD COLUMN last_used_at REAL NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS summary_cache_last_used ON summary_cache (last_used_at)")
+    conn.commit()
+
+
+class MapReduceSummarizer:
+    """Hierarchical summarizer: summarize token-budgeted chunks, then reduce in a tree.
+
+    Every node of the tree is cached in SQLite under a hash of its input, so
+    after one note is edited only its chunk and the reduce nodes above it are
+    recomputed. Chunk boundaries are placed by note ID (plus the token budget),
+    so editing a note does not shift which notes the other chunks contain.
+    The cache keeps the max_entries most recently used summaries; nodes of
+    trees built from old versions of the notes age out.
+    """
+
+    def __init__(self, client, get_connection, model="gpt-4o-mini",
+                 chunk_tokens=3000, fanout=4, boundary_every=8, max_workers=4, max_entries=20000):
+        # With fewer than two summaries per group a reduce level would never shrink the tree
+        if fanout < 2:
+            raise ValueError("SUMMARY_REDUCE_FANOUT must be at least 2")
+        if chunk_tokens < 1 or boundary_every < 1:
+            raise ValueError("SUMMARY_CHUNK_TOKENS and the chunk boundary interval must be positive")
+        self.client = client
+        self.get_connection = get_connection
+        self.model = model
+        self.chunk_tokens = chunk_tokens
+        self.fanout = fanout
+        self.boundary_every = boundary_every
+        self.max_workers = max_workers
+        self.max_entries = max_entries
+        # Concurrent summaries over the same notes share the model calls for identical chunks
+        self._inflight = SingleFlight("summary_chunk")
+
+    @classmethod
+    def from_env(cls, client, get_connection):
+        return cls(
+            client,
+            get_connection,
+            model=os.getenv("SUMMARY_MODEL", "gpt-4o-mini"),
+            chunk_tokens=int(os.getenv("SUMMARY_CHUNK_TOKENS", "3000")),
+            fanout=int(os.getenv("SUMMARY_REDUCE_FANOUT", "4")),
+            max_workers=int(os.getenv("SUMMARY_MAX_WORKERS", "4")),
+            max_entries=int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "20000")),
+        )
+
+    def chunk_notes(self, notes):
+        """Split (id, content) rows into chunk texts that fit the token budget"""
+        chunks, current, current_tokens = [], [], 0
+        for note_id, content in notes:
+            # Oversized notes are split into budget-sized pieces of their own
+            text = f"Note #{note_id}: {content}"
+            text_tokens = count_tokens(text, self.model)
+            if text_tokens > self.chunk_tokens:
+                pieces = [(piece, count_tokens(piece, self.model))
+                          for piece in split_tokens(text, self.chunk_tokens, self.model)]
+            else:
+                pieces = [(text, text_tokens)]
+            for piece, tokens in pieces:
+                if current and current_tokens + tokens > self.chunk_tokens:
+                    chunks.append("\n\n".join(current))
+                    current, current_tokens = [], 0
+                current.append(piece)
+                current_tokens += tokens
+            if len(pieces) > 1 or note_id % self.boundary_every == 0:
+                chunks.append("\n\n".join(current))
+                current, current_tokens = [], 0
+        if current:
+            chunks.append("\n\n".join(current))
+        return chunks
+
+    async def _complete(self, system_prompt, text, semaphore):
+        async with semaphore:
+            response = await call_openai(lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": text}
+                ]
+            ), tokens=count_tokens(system_prompt, self.model) + count_tokens(text, self.model), kind="summary")
+        return response.choices[0].message.content
+
+    def _load_cached(self, keys):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cached = {}
+            unique_keys = list(set(keys))
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                cursor.execute(f"SELECT hash, summary FROM summary_cache WHERE hash IN ({placeholders})", batch)
+                cached.update(cursor.fetchall())
+            if cached:
+                cursor.executemany("UPDATE summary_cache SET last_used_at = ? WHERE hash = ?",
+                                   [(time.time(), key) for key in cached])
+                conn.commit()
+        return cached
+
+    def _store(self, summaries):
+        """Persist fresh summaries, then evict the least recently used beyond max_entries"""
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "INSERT OR REPLACE INTO summary_cache (hash, summary, last_used_at) VALUES (?, ?, ?)",
+                [(key, summary, now) for key, summary in summaries.items()],
+            )
+            cursor.execute("SELECT COUNT(*) FROM summary_cache")
+            overflow = cursor.fetchone()[0] - self.max_entries
+            if overflow > 0:
+                cursor.execute(
+                    "DELETE FROM summary_cache WHERE hash IN "
+                    "(SELECT hash FROM summary_cache ORDER BY last_used_at LIMIT ?)",
+                    (overflow,),
+                )
+            conn.commit()
+
+    async def _run_level(self, system_prompt, texts):
+        """Summarize a list of texts, reusing cached results and running misses concurrently"""
+        keys = [content_hash(self.model, system_prompt, text) for text in texts]
+        cached = await run_db(self._load_cached, keys)
+
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                pending[key] = text
+        if pending:
+            semaphore = asyncio.Semaphore(self.max_workers)
+            results = await asyncio.gather(*(
+                self._inflight.do(key, lambda text=text: self._complete(system_prompt, text, semaphore))
+                for key, text in pending.items()
+            ))
+            fresh = dict(zip(pending.keys(), results))
+            await run_db(self._store, fresh)
+            cached.update(fresh)
+        return [cached[key] for key in keys], len(pending)
+
+    def _group(self, summaries):
+        """Group sibling summaries for the next reduce level.
+
+        Group boundaries depend on each summary's content rather than its
+        position, so a chunk appearing or disappearing only changes the group
+        it lands in instead of shifting every group after it. A group's joined
+        text stays within chunk_tokens: summaries longer than half of it are
+        cut, and a group is closed early rather than grow past it.
+        """
+        half = max(1, self.chunk_tokens // 2 - 2)
+        summaries = [summary if count_tokens(summary, self.model) <= half
+                     else truncate_tokens(summary, half, self.model) for summary in summaries]
+        # Each summary also costs the separator joining it to the next
+        sizes = [count_tokens(summary, self.model) + 2 for summary in summaries]
+        groups = self._fill(summaries, sizes, lambda summary, group: (
+            int(content_hash(summary)[:8], 16) % self.fanout == 0 or len(group) >= 2 * self.fanout))
+        if len(groups) == len(summaries):
+            # No reduction would happen at this level; fall back to fixed-size groups
+            groups = self._fill(summaries, sizes, lambda summary, group: len(group) >= self.fanout)
+        return groups
+
+    def _fill(self, summaries, sizes, ends_group):
+        """Split summaries into groups ending where ends_group(summary, group) says or at the token budget"""
+        groups, current, used = [], [], 0
+        for summary, size in zip(summaries, sizes):
+            # Every summary fits in half the budget, so a group always takes at least two
+            if len(current) >= 2 and used + size > self.chunk_tokens:
+                groups.append(current)
+                current, used = [], 0
+            current.append(summary)
+            used += size
+            if ends_group(summary, current):
+                groups.append(current)
+                current, used = [], 0
+        if current:
+            groups.append(current)
+        return groups
+
+    async def _build_root(self, notes):
+        """Run every level below the root; returns (system prompt, input text, calls made) for the root"""
+        system_prompt, texts, calls = MAP_PROMPT, await asyncio.to_thread(self.chunk_notes, notes), 0
+        while len(texts) > 1:
+            level, level_calls = await self._run_level(system_prompt, texts)
+            calls += level_calls
+            system_prompt = REDUCE_PROMPT
+            texts = ["\n\n".join(group) for group in self._group(level)]
+        return system_prompt, texts[0], calls
+
+    async def summarize(self, notes):
+        """Summarize (id, content) rows; returns (summary, number of model calls made)"""
+        system_prompt, text, calls = await self._build_root(notes)
+        level, root_calls = await self._run_level(system_prompt, [text])
+        return level[0], calls + root_calls
+
+    async def summarize_stream(self, notes):
+        """Like summarize(), but returns an async iterator over the root summary's tokens.
+
+        The lower levels run (or hit the cache) and the final call is opened
+        before this returns, so upstream errors such as UpstreamOverloaded
+        are raised here rather than mid-stream. The root's full text is
+        cached once the stream ends.
+        """
+        system_prompt, text, _ = await self._build_root(notes)
+        key = content_hash(self.model, system_prompt, text)
+        cached = await run_db(self._load_cached, [key])
+        if key in cached:
+            return _single_token(cached[key])
+        stream = await call_openai(lambda: self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": text}
+            ],
+            stream=True
+        ), tokens=count_tokens(system_prompt, self.model) + count_tokens(text, self.model), kind="summary",
+            stream=True)
+        return self._stream_tokens(stream, key)
+
+    async def _stream_tokens(self, stream, key):
+        parts = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        await run_db(self._store, {key: "".join(parts)})
+
+
+async def _single_token(text):
+    yield text
@@ -0,0 +1,241 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import secrets
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from db import bind_pool, unbind_pool
+
+logger = logging.getLogger(__name__)
+
+# Tenant sharding settings (overridable through environment variables)
+DEFAULT_TENANT = "default"
+TENANT_HEADER = "X-Tenant-ID"
+TENANT_DATA_DIR = os.getenv("TENANT_DATA_DIR", "tenants")
+# Open tenant databases kept in the LRU; tenants in use are never closed
+TENANT_CACHE_SIZE = int(os.getenv("TENANT_CACHE_SIZE", "32"))
+TENANT_POOL_SIZE = int(os.getenv("TENANT_POOL_SIZE", "4"))
+# Bearer token for creating tenants and issuing their keys (POST /tenants); unset disables it
+TENANT_ADMIN_TOKEN = os.getenv("TENANT_ADMIN_TOKEN", "")
+
+# Tenant IDs become file names, so they are restricted to a safe alphabet
+TENANT_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+
+_current_shard = ContextVar("tenant_shard", default=None)
+
+def validate_tenant_id(tenant_id):
+    if not TENANT_ID_PATTERN.match(tenant_id):
+        raise ValueError("Tenant ID must be 1-64 letters, digits, '-' or '_' and start with a letter or digit")
+    return tenant_id
+
+def tenant_db_path(tenant_id):
+    return os.path.join(TENANT_DATA_DIR, f"{tenant_id}.db")
+
+def bearer_token(authorization):
+    """The token of an 'Authorization: Bearer <token>' header value, or None"""
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+def current_shard():
+    """The shard of the tenant the current request or job works on"""
+    shard = _current_shard.get()
+    if shard is None:
+        raise RuntimeError("No tenant is bound to this context")
+    return shard
+
+
+# Tenant keys: a named tenant exists only once registered, and every request
+# for it must carry its key. The registry lives in the default database.
+def init_tenants(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tenants (
+            id TEXT PRIMARY KEY,
+            key_hash BLOB NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    conn.commit()
+
+def _key_hash(key):
+    return hashlib.sha256(key.encode("utf-8")).digest()
+
+def issue_tenant_key(conn, tenant_id):
+    """Register a tenant, or replace its key; returns the new key (only its hash is stored)"""
+    validate_tenant_id(tenant_id)
+    if tenant_id == DEFAULT_TENANT:
+        raise ValueError("The default tenant needs no key")
+    key = secrets.token_urlsafe(32)
+    conn.execute(
+        "INSERT INTO tenants (id, key_hash, created_at) VALUES (?, ?, ?) "
+        "ON CONFLICT (id) DO UPDATE SET key_hash = excluded.key_hash",
+        (tenant_id, _key_hash(key), time.time()),
+    )
+    conn.commit()
+    return key
+
+def tenant_key_matches(conn, tenant_id, key):
+    """True if tenant_id is registered and key is its current key"""
+    row = conn.execute("SELECT key_hash FROM tenants WHERE id = ?", (tenant_id,)).fetchone()
+    return row is not None and key is not None and hmac.compare_digest(row[0], _key_hash(key))
+
+def admin_token_matches(token):
+    return bool(TENANT_ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, TENANT_ADMIN_TOKEN)
+
+
+class TenantRegistry:
+    """LRU of open tenant shards.
+
+    open_shard(tenant_id) builds a shard (any object with a `pool` attribute)
+    and close_shard(shard) releases it. Shards are reference counted while in
+    use; when more than `capacity` are open, the least recently used idle
+    shards are closed. Pinned tenants are never closed.
+    """
+
+    def __init__(self, open_shard, close_shard, capacity=TENANT_CACHE_SIZE, pinned=(DEFAULT_TENANT,)):
+        self.open_shard = open_shard
+        self.close_shard = close_shard
+        self.capacity = capacity
+        self.pinned = set(pinned)
+        self._shards = OrderedDict()
+        self._users = {}
+        self._opening = {}
+        self._hits = 0
+        self._opens = 0
+        self._evictions = 0
+
+    def shards(self):
+        return list(self._shards.values())
+
+    async def _open(self, tenant_id):
+        # Runs to completion even if the request that started it goes away
+        try:
+            shard = await self.open_shard(tenant_id)
+            self._shards[tenant_id] = shard
+            self._opens += 1
+            return shard
+        finally:
+            del self._opening[tenant_id]
+
+    async def acquire(self, tenant_id):
+        """Return the tenant's shard, opening it if needed; pair with release()"""
+        shard = self._shards.get(tenant_id)
+        if shard is not None:
+            self._hits += 1
+        while shard is None:
+            # Concurrent first requests for a tenant share one open
+            opening = self._opening.get(tenant_id)
+            if opening is None:
+                opening = self._opening[tenant_id] = asyncio.ensure_future(self._open(tenant_id))
+            await asyncio.shield(opening)
+            # Look the shard up again: it may have been closed before this request resumed
+            shard = self._shards.get(tenant_id)
+        self._shards.move_to_end(tenant_id)
+        self._users[tenant_id] = self._users.get(tenant_id, 0) + 1
+        await self._evict()
+        return shard
+
+    def release(self, tenant_id):
+        self._users[tenant_id] -= 1
+        if not self._users[tenant_id]:
+            del self._users[tenant_id]
+
+    async def _evict(self):
+        while len(self._shards) > self.capacity:
+            idle = next((tenant_id for tenant_id in self._shards
+                         if tenant_id not in self._users and tenant_id not in self.pinned), None)
+            if idle is None:
+                # Every open shard is busy; go over capacity rather than wait
+                return
+            shard = self._shards.pop(idle)
+            self._evictions += 1
+            try:
+                await self.close_shard(shard)
+            except Exception as e:
+                logger.warning("Closing tenant %s failed: %s", idle, e)
+
+    @asynccontextmanager
+    async def use(self, tenant_id):
+        """Bind the tenant's shard and database pool to the current context"""
+        shard = await self.acquire(tenant_id)
+        shard_token = _current_shard.set(shard)
+        pool_token = bind_pool(shard.pool)
+        try:
+            yield shard
+        finally:
+            unbind_pool(pool_token)
+            _current_shard.reset(shard_token)
+            self.release(tenant_id)
+
+    async def close_all(self):
+        while self._shards:
+            _, shard = self._shards.popitem()
+            try:
+                await self.close_shard(shard)
+            except Exception as e:
+                logger.warning("Closing tenant shard failed: %s", e)
+
+    def stats(self):
+        return {
+            "open": len(self._shards),
+            "capacity": self.capacity,
+            "in_use": len(self._users),
+            "hits": self._hits,
+            "opens": self._opens,
+            "evictions": self._evictions,
+        }
+
+
+class TenantMiddleware:
+    """ASGI middleware binding the tenant named in the X-Tenant-ID header (or the default) to each request.
+
+    A named tenant is only served when authorize(tenant_id, key) accepts the
+    key sent as 'Authorization: Bearer <key>', so unknown tenants are refused
+    before any database is created for them. Paths in exempt_paths (health
+    probes, tenant registration) run without a tenant shard.
+    """
+
+    def __init__(self, app, registry, authorize, exempt_paths=()):
+        self.app = app
+        self.registry = registry
+        self.authorize = authorize
+        self.header = TENANT_HEADER.lower().encode("latin-1")
+        self.exempt_paths = frozenset(exempt_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exempt_paths:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        raw = headers.get(self.header)
+        tenant_id = raw.decode("latin-1").strip() if raw else DEFAULT_TENANT
+        try:
+            validate_tenant_id(tenant_id)
+        except ValueError as e:
+            await _send_error(send, 400, str(e))
+            return
+        if tenant_id != DEFAULT_TENANT:
+            key = bearer_token(headers.get(b"authorization", b"").decode("latin-1"))
+            if not await self.authorize(tenant_id, key):
+                # The same answer for unknown tenants and wrong keys, so tenant names cannot be probed
+                await _send_error(send, 401, "Unknown tenant or wrong tenant key",
+                                  [(b"www-authenticate", b"Bearer")])
+                return
+        # The shard stays bound until the last byte of a streamed response is sent
+        async with self.registry.use(tenant_id):
+            await self.app(scope, receive, send)
+
+async def _send_error(send, status, detail, headers=()):
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                            *headers]})
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,133 @@
+import json
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import httpx
+import openai
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Settings are read at import time, so point everything at a scratch directory before the app is imported
+DATA_DIR = tempfile.mkdtemp(prefix="notes-tests-")
+os.environ.update({
+    "NOTES_DB_PATH": os.path.join(DATA_DIR, "notes.db"),
+    "TENANT_DATA_DIR": os.path.join(DATA_DIR, "tenants"),
+    "TRANSCRIBE_TMP_DIR": os.path.join(DATA_DIR, "transcribe"),
+    "TENANT_ADMIN_TOKEN": "test-admin",
+    # tiktoken needs its encoding files from the network; the tests check budgets against the estimate
+    "ALLOW_TOKEN_ESTIMATE": "1",
+    "EMBEDDING_BACKEND": "hashing",
+    "OPENAI_API_KEY": "fake",
+    "OPENAI_BASE_URL": "http://fake-openai.invalid/v1",
+    "OPENAI_MAX_RETRIES": "0",
+    "FAKE_OPENAI_LATENCY_MS": "0",
+    "FAKE_OPENAI_JITTER_MS": "0",
+    "FAKE_OPENAI_TOKEN_MS": "0",
+})
+
+from benchmarks import fake_openai  # noqa: E402
+from db import connect  # noqa: E402
+from llm_cache import init_llm_cache  # noqa: E402
+from note_chunks import init_note_chunks  # noqa: E402
+from note_store import init_note_store  # noqa: E402
+from note_summaries import init_note_summaries  # noqa: E402
+from vector_index import init_vector_store  # noqa: E402
+
+
+class FakeOpenAITransport(httpx.ASGITransport):
+    """Serves OpenAI requests from the fake server in-process and records (path, JSON body) of each"""
+
+    def __init__(self):
+        super().__init__(app=fake_openai.app)
+        self.requests = []
+
+    async def handle_async_request(self, request):
+        body = await request.aread()
+        try:
+            payload = json.loads(body) if body else None
+        except ValueError:
+            payload = None
+        self.requests.append((request.url.path, payload))
+        return await super().handle_async_request(request)
+
+    def paths(self):
+        return [path for path, _ in self.requests]
+
+
+def fake_openai_client(transport):
+    return openai.AsyncOpenAI(api_key="fake", base_url="http://fake-openai/v1", max_retries=0,
+                              http_client=httpx.AsyncClient(transport=transport))
+
+
+@pytest.fixture
+def openai_transport():
+    return FakeOpenAITransport()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """A notes database with the tables the note pipelines and vector indexes read and write"""
+    path = str(tmp_path / "notes.db")
+    conn = connect(path)
+    init_note_store(conn)
+    init_note_chunks(conn)
+    init_llm_cache(conn)
+    init_note_summaries(conn)
+    init_vector_store(conn)
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def get_connection(db_path):
+    """A get_connection callable like ConnectionPool.connection, opening a fresh connection per use"""
+    opened = []
+
+    @contextmanager
+    def connection():
+        conn = connect(db_path)
+        opened.append(conn)
+        yield conn
+
+    yield connection
+    for conn in opened:
+        conn.close()
+
+
+@pytest.fixture(scope="session")
+def app_transport():
+    """Fake OpenAI transport behind the app's client for the whole session"""
+    return FakeOpenAITransport()
+
+
+@pytest.fixture(scope="session")
+def client(app_transport):
+    """TestClient for the app, started once; tests keep apart by using their own tenants or notes"""
+    from fastapi.testclient import TestClient
+
+    import app as app_module
+
+    app_module.client._client = fake_openai_client(app_transport)
+    with TestClient(app_module.app) as client:
+        yield client
+
+
+@pytest.fixture(scope="session")
+def tenant_headers(client):
+    """Headers for a named tenant, registered on first use"""
+    from tenants import TENANT_HEADER
+
+    keys = {}
+
+    def headers(tenant_id):
+        if tenant_id not in keys:
+            response = client.post("/tenants", json={"tenant_id": tenant_id},
+                                   headers={"Authorization": "Bearer test-admin"})
+            keys[tenant_id] = response.json()["key"]
+        return {TENANT_HEADER: tenant_id, "Authorization": f"Bearer {keys[tenant_id]}"}
+
+    return headers
@@ -0,0 +1,133 @@
+import json
+import sqlite3
+
+import pytest
+
+import app
+
+
+@pytest.fixture(scope="module")
+def paging(client, tenant_headers):
+    """A tenant with 25 notes, newest last"""
+    headers = tenant_headers("paging")
+    for index in range(25):
+        client.post("/add_note", json={"content": f"page note {index} " + "x" * 300}, headers=headers)
+    return headers
+
+
+def test_keyset_pages_cover_every_note_once(client, paging):
+    ids, after_id = [], None
+    while True:
+        params = {"limit": 10, **({"after_id": after_id} if after_id is not None else {})}
+        response = client.get("/get_notes", params=params, headers=paging)
+        assert response.status_code == 200
+        ids.extend(row[0] for row in response.json())
+        after_id = response.headers.get("X-Next-After-Id")
+        if after_id is None:
+            break
+        assert int(after_id) == ids[-1]
+    assert len(ids) == 25 and len(set(ids)) == 25
+    assert ids == sorted(ids, reverse=True)
+
+
+def test_last_short_page_has_no_next_cursor(client, paging):
+    first = client.get("/get_notes", params={"limit": 20}, headers=paging)
+    rest = client.get("/get_notes", params={"limit": 20, "after_id": first.headers["X-Next-After-Id"]},
+                      headers=paging)
+    assert len(rest.json()) == 5
+    assert "X-Next-After-Id" not in rest.headers
+
+
+def test_preview_fields_are_cut(client, paging):
+    rows = client.get("/get_notes", params={"fields": "preview", "preview_chars": 12}, headers=paging).json()
+    assert len(rows) == 25
+    assert all(len(text) <= 12 for _, text in rows)
+    assert rows[0][1] == "page note 24"
+    # Longer than the stored inline preview, so read from the note bodies
+    rows = client.get("/get_notes", params={"fields": "preview", "preview_chars": 250}, headers=paging).json()
+    assert all(len(text) == 250 for _, text in rows)
+
+
+def test_ndjson_streams_one_object_per_note(client, paging):
+    json_rows = client.get("/get_notes", params={"limit": 1000}, headers=paging).json()
+    response = client.get("/get_notes", params={"format": "ndjson"}, headers=paging)
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert "etag" in response.headers
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [[line["id"], line["content"]] for line in lines] == json_rows
+
+    after_id = json_rows[4][0]
+    page = client.get("/get_notes", params={"format": "ndjson", "after_id": after_id, "limit": 3,
+                                            "fields": "preview", "preview_chars": 12}, headers=paging)
+    assert [json.loads(line) for line in page.text.splitlines()] == \
+        [{"id": note_id, "preview": content[:12]} for note_id, content in json_rows[5:8]]
+
+
+@pytest.mark.parametrize("params", [{"limit": 0}, {"limit": 1001}, {"fields": "all"}, {"format": "csv"},
+                                    {"preview_chars": 0}])
+def test_invalid_listing_parameters_are_rejected(client, paging, params):
+    assert client.get("/get_notes", params=params, headers=paging).status_code == 400
+
+
+@pytest.fixture
+def bulk(client, tenant_headers):
+    return tenant_headers("bulk")
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    """Record the rows of each insert transaction; rows containing "poison" make it fail"""
+    calls = []
+    insert = app.insert_notes_batch
+
+    def recording(contents):
+        calls.append(list(contents))
+        if any("poison" in content for content in contents):
+            raise sqlite3.IntegrityError("poisoned row")
+        return insert(contents)
+
+    monkeypatch.setattr(app, "BULK_BATCH_SIZE", 3)
+    monkeypatch.setattr(app, "insert_notes_batch", recording)
+    return calls
+
+
+def test_bulk_rows_are_written_in_bounded_batches(client, bulk, batches):
+    result = client.post("/add_notes/bulk", json=[f"bulk {index}" for index in range(7)], headers=bulk).json()
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert result["inserted"] == 7 and result["failed"] == 0
+    # IDs are contiguous across batches and merge into one range
+    [(first, last)] = result["id_ranges"]
+    assert last - first == 6
+    rows = client.get("/get_notes", params={"limit": 7}, headers=bulk).json()
+    assert [content for _, content in reversed(rows)] == [f"bulk {index}" for index in range(7)]
+
+
+def test_bulk_reports_invalid_rows_and_keeps_the_rest(client, bulk, batches):
+    body = ["fine 0", {"content": 5}, {"text": "no content"}, {"content": "fine 1"}]
+    result = client.post("/add_notes/bulk", json=body, headers=bulk).json()
+    assert result["inserted"] == 2 and result["failed"] == 2
+    assert [error["row"] for error in result["errors"]] == [1, 2]
+
+
+def test_bulk_isolates_a_failing_row_within_its_batch(client, bulk, batches):
+    result = client.post("/add_notes/bulk", json=["a", "b", "poison", "c", "d"], headers=bulk).json()
+    # The failed batch is retried one row at a time; the next batch is unaffected
+    assert batches == [["a", "b", "poison"], ["a"], ["b"], ["poison"], ["c", "d"]]
+    assert result["inserted"] == 4 and result["failed"] == 1
+    assert result["errors"] == [{"row": 2, "error": "Database error: poisoned row"}]
+    assert sum(last - first + 1 for first, last in result["id_ranges"]) == 4
+
+
+def test_bulk_ndjson_reports_bad_lines_by_row(client, bulk, batches):
+    body = b'{"content": "line 0"}\nnot json\n\n"line 2"\n{"content": "line 3"}'
+    result = client.post("/add_notes/bulk", content=body, headers={**bulk, "Content-Type": "application/x-ndjson"})
+    result = result.json()
+    assert result["inserted"] == 3 and result["failed"] == 1
+    assert result["errors"][0]["row"] == 1 and result["errors"][0]["error"].startswith("Invalid JSON")
+    assert [len(batch) for batch in batches] == [3]
+
+
+@pytest.mark.parametrize("body", [b"not json", b'{"content": "not a list"}'])
+def test_bulk_rejects_a_body_that_is_not_a_json_array(client, bulk, body):
+    response = client.post("/add_notes/bulk", content=body, headers={**bulk, "Content-Type": "application/json"})
+    assert response.status_code == 400
@@ -0,0 +1,79 @@
+import pytest
+
+from app import response_etag
+from changes import etag_matches
+from tenants import TENANT_HEADER
+
+
+@pytest.fixture(scope="module")
+def acme(client, tenant_headers):
+    return tenant_headers("acme")
+
+
+@pytest.fixture(scope="module")
+def globex(client, tenant_headers):
+    return tenant_headers("globex")
+
+
+@pytest.fixture(scope="module", autouse=True)
+def notes(client, acme, globex):
+    # One note each, so both tenants are at the same revision
+    client.post("/add_note", json={"content": "etag scoping"}, headers=acme)
+    client.post("/add_note", json={"content": "etag scoping"}, headers=globex)
+
+
+def test_etag_covers_tenant_and_query():
+    etag = response_etag("acme", 7, "/get_notes", [("limit", "10")])
+    assert etag.startswith('"notes-acme-7-')
+    assert etag != response_etag("globex", 7, "/get_notes", [("limit", "10")])
+    assert etag != response_etag("acme", 7, "/get_notes", [("limit", "20")])
+    assert etag != response_etag("acme", 7, "/search", [("limit", "10")])
+    assert etag == response_etag("acme", 7, "/get_notes", [("limit", "10")])
+    # Parameter order does not change the request
+    assert response_etag("acme", 7, "/get_notes", [("a", "1"), ("b", "2")]) == \
+        response_etag("acme", 7, "/get_notes", [("b", "2"), ("a", "1")])
+
+
+def test_if_none_match_lists_and_wildcards():
+    etag = '"notes-acme-7-0123456789abcdef"'
+    assert etag_matches(etag, etag)
+    assert etag_matches(f'"other", {etag}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"notes-acme-7"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_responses_vary_by_tenant(client, acme):
+    response = client.get("/get_notes?limit=10", headers=acme)
+    assert response.status_code == 200
+    assert response.headers["vary"] == TENANT_HEADER
+    assert response.headers["etag"]
+
+
+def test_etag_revalidates_the_same_request(client, acme):
+    etag = client.get("/get_notes?limit=10", headers=acme).headers["etag"]
+    response = client.get("/get_notes?limit=10", headers={**acme, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["vary"] == TENANT_HEADER
+
+
+def test_etag_does_not_match_another_tenant(client, acme, globex):
+    etag = client.get("/get_notes?limit=10", headers=acme).headers["etag"]
+    response = client.get("/get_notes?limit=10", headers={**globex, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+def test_etag_does_not_match_another_query(client, acme):
+    etag = client.get("/get_notes?limit=10", headers=acme).headers["etag"]
+    for url in ("/get_notes?limit=11", "/get_notes?limit=10&fields=preview", "/search?q=etag&limit=10"):
+        response = client.get(url, headers={**acme, "If-None-Match": etag})
+        assert response.status_code == 200, url
+        assert response.headers["etag"] != etag
+
+
+def test_ndjson_stream_carries_the_validator(client, acme):
+    response = client.get("/get_notes?format=ndjson", headers=acme)
+    assert response.status_code == 200
+    assert response.headers["etag"]
+    assert response.headers["vary"] == TENANT_HEADER
@@ -0,0 +1,70 @@
+import asyncio
+
+import numpy as np
+import openai
+import pytest
+
+from benchmarks.fake_openai import EMBEDDING_MAX_INPUT_TOKENS
+from coalesce import MicroBatcher
+from conftest import fake_openai_client
+from vector_index import OpenAIEmbedder
+
+OVERSIZED = "word " * (EMBEDDING_MAX_INPUT_TOKENS * 2)
+
+
+@pytest.fixture
+def embedder(openai_transport):
+    return OpenAIEmbedder(fake_openai_client(openai_transport), dim=1536, batch_wait=0.01)
+
+
+async def _embed_each(embedder, texts):
+    return await asyncio.gather(*(embedder.embed([text]) for text in texts), return_exceptions=True)
+
+
+def test_concurrent_texts_share_one_request(embedder, openai_transport):
+    texts = [f"note {index}" for index in range(20)]
+    results = asyncio.run(_embed_each(embedder, texts))
+    assert all(isinstance(result, np.ndarray) and result.shape == (1, 1536) for result in results)
+    assert len(openai_transport.requests) == 1
+
+
+def test_rejected_input_fails_only_its_caller(embedder, openai_transport):
+    texts = [f"note {index}" for index in range(15)] + [OVERSIZED]
+    results = asyncio.run(_embed_each(embedder, texts))
+    assert isinstance(results[-1], openai.BadRequestError)
+    assert all(isinstance(result, np.ndarray) for result in results[:-1])
+    # Bisection finds the rejected input in about log2(16) rounds rather than one request per text
+    assert len(openai_transport.requests) <= 2 * 4 + 1
+
+
+def test_other_errors_fail_the_whole_batch():
+    async def process_batch(items):
+        raise ConnectionError("upstream down")
+
+    async def main():
+        batcher = MicroBatcher(process_batch, "test", is_item_error=lambda error: isinstance(error, ValueError))
+        return await asyncio.gather(*(batcher.submit(item) for item in range(4)), return_exceptions=True)
+
+    assert all(isinstance(result, ConnectionError) for result in asyncio.run(main()))
+
+
+def test_item_errors_are_isolated_by_bisection():
+    calls = []
+
+    async def process_batch(items):
+        calls.append(list(items))
+        if any(item % 5 == 0 for item in items):
+            raise ValueError("rejected")
+        return [item * 10 for item in items]
+
+    async def main():
+        batcher = MicroBatcher(process_batch, "test", is_item_error=lambda error: isinstance(error, ValueError))
+        return await asyncio.gather(*(batcher.submit(item) for item in range(1, 13)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    for item, result in zip(range(1, 13), results):
+        if item % 5 == 0:
+            assert isinstance(result, ValueError)
+        else:
+            assert result == item * 10
+    assert len(calls) < 2 * 12
@@ -0,0 +1,46 @@
+import pytest
+
+import context_budget
+from context_budget import count_tokens, pack_notes, split_tokens, truncate_to_relevant
+
+TEXTS = {
+    "csv": "\n".join(f"{row},{row * 7},{row * 13}" for row in range(3000)),
+    "no_spaces": "x" * 20000,
+    "cjk": "長い文章を分割する必要があります。" * 500,
+    "prose": "The deployment review covers latency and budget. " * 300,
+}
+
+
+@pytest.mark.parametrize("name", sorted(TEXTS))
+def test_split_tokens_bounds_every_piece(name):
+    pieces = split_tokens(TEXTS[name], 100)
+    assert pieces
+    assert all(count_tokens(piece) <= 100 for piece in pieces)
+
+
+@pytest.mark.parametrize("name", sorted(TEXTS))
+def test_relevant_truncation_stays_within_the_budget(name):
+    assert count_tokens(truncate_to_relevant(TEXTS[name], "unrelated", 100)) <= 100
+
+
+def test_packed_context_stays_within_the_budget():
+    notes = [(note_id, TEXTS[name]) for note_id, name in enumerate(sorted(TEXTS), 1)]
+    parts, note_ids, usage = pack_notes(notes, "latency", budget=800, note_max_tokens=200)
+    assert note_ids
+    assert usage["context_tokens"] <= 800
+    assert sum(count_tokens(part) + 1 for part in parts) == usage["context_tokens"]
+
+
+def test_estimate_does_not_undercount_text_without_spaces():
+    text = TEXTS["cjk"]
+    # BPE tokenizers spend about one token per CJK character
+    assert count_tokens(text) >= len(text)
+
+
+def test_missing_tokenizer_fails_unless_the_estimate_is_allowed(monkeypatch):
+    monkeypatch.setattr(context_budget, "tiktoken", None)
+    monkeypatch.setattr(context_budget, "ALLOW_TOKEN_ESTIMATE", False)
+    with pytest.raises(RuntimeError):
+        context_budget.check_tokenizer()
+    monkeypatch.setattr(context_budget, "ALLOW_TOKEN_ESTIMATE", True)
+    assert context_budget.check_tokenizer() == "estimate"
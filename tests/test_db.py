@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+import db
+from db import ConnectionPool, PoolTimeout, bind_pool, connect, current_pool, get_db_connection, unbind_pool
+
+
+@pytest.fixture
+def make_pool(tmp_path):
+    pools = []
+
+    def make(**kwargs):
+        pools.append(ConnectionPool(str(tmp_path / "pool.db"), **kwargs))
+        return pools[-1]
+
+    yield make
+    for opened in pools:
+        opened.close()
+
+
+def test_connections_use_wal_and_tuned_pragmas(tmp_path):
+    conn = connect(str(tmp_path / "pragmas.db"))
+    try:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        # NORMAL
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+        assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] > 0
+        assert conn.execute("PRAGMA cache_size").fetchone()[0] < 0
+    finally:
+        conn.close()
+
+
+def test_returned_connection_is_reused(make_pool):
+    pool = make_pool(size=2)
+    with pool.connection() as first:
+        assert pool.stats()["in_use"] == 1
+    with pool.connection() as second:
+        assert second is first
+    stats = pool.stats()
+    assert (stats["opened"], stats["in_use"], stats["idle"], stats["checkouts"]) == (1, 0, 1, 2)
+
+
+def test_open_transaction_is_rolled_back_on_return(make_pool):
+    pool = make_pool(size=1)
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE items (name TEXT)")
+        conn.commit()
+        conn.execute("INSERT INTO items VALUES ('uncommitted')")
+    with pool.connection() as conn:
+        assert not conn.in_transaction
+        assert conn.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 0
+
+
+def test_exhausted_pool_waits_for_a_return_then_times_out(make_pool):
+    pool = make_pool(size=1, timeout=0.05)
+    with pool.connection():
+        with pytest.raises(PoolTimeout):
+            with pool.connection():
+                pass
+    assert pool.stats()["timeouts"] == 1
+
+    pool.timeout = 5
+    checked_out, release = threading.Event(), threading.Event()
+
+    def hold():
+        with pool.connection():
+            checked_out.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    checked_out.wait()
+    threading.Timer(0.05, release.set).start()
+    with pool.connection():
+        pass
+    holder.join()
+    stats = pool.stats()
+    assert stats["opened"] == 1 and stats["waits"] == 1 and stats["max_wait_ms"] > 0
+
+
+def test_bound_pool_routes_the_current_context(make_pool):
+    bound = make_pool(size=1)
+    token = bind_pool(bound)
+    try:
+        assert current_pool() is bound
+        with get_db_connection():
+            assert bound.stats()["in_use"] == 1
+    finally:
+        unbind_pool(token)
+    assert current_pool() is db.pool
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from jobs import JobQueue, init_jobs
+
+
+@pytest.fixture
+def make_queue(get_connection):
+    with get_connection() as conn:
+        init_jobs(conn)
+
+    def make(**lanes):
+        return JobQueue(get_connection, lanes=lanes or {"interactive": 1, "batch": 1})
+
+    return make
+
+
+async def _wait_for(queue, job_id, *statuses):
+    for _ in range(500):
+        job = await queue.get(job_id, include_result=True)
+        if job["status"] in statuses:
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"job {job_id} stayed {job['status']}")
+
+
+def test_busy_lane_does_not_hold_up_another(make_queue):
+    queue = make_queue()
+    order = []
+
+    async def main():
+        gate = asyncio.Event()
+
+        async def slow(payload, ctx):
+            order.append(payload["name"])
+            await gate.wait()
+            return payload["name"]
+
+        async def quick(payload, ctx):
+            order.append(payload["name"])
+            return payload["name"]
+
+        queue.register("slow", slow, lane="batch")
+        queue.register("also_batch", quick, lane="batch")
+        queue.register("quick", quick, lane="interactive")
+        await queue.start()
+        try:
+            first = await queue.submit("slow", {"name": "slow"})
+            await _wait_for(queue, first["id"], "running")
+            low = await queue.submit("also_batch", {"name": "low"})
+            high = await queue.submit("also_batch", {"name": "high"}, priority=5)
+            answered = await queue.submit("quick", {"name": "quick"})
+            assert (await _wait_for(queue, answered["id"], "completed"))["result"] == "quick"
+            assert (await queue.get(low["id"]))["status"] == "queued"
+            assert (await queue.metrics())["lanes"]["batch"] == {"workers": 1, "queued": 2, "running": 1}
+            gate.set()
+            await _wait_for(queue, low["id"], "completed")
+        finally:
+            await queue.stop()
+
+    asyncio.run(main())
+    # Higher priority runs first within the lane
+    assert order == ["slow", "quick", "high", "low"]
+
+
+def test_job_of_a_dead_worker_is_requeued_from_its_checkpoint(make_queue, get_connection):
+    queue = make_queue()
+    now = time.time()
+    with get_connection() as conn:
+        for job_id, heartbeat in [("stale", now - 3600), ("alive", now)]:
+            conn.execute(
+                '''
+                INSERT INTO jobs (id, kind, lane, status, payload, checkpoint, created_at, started_at,
+                                  worker, heartbeat_at)
+                VALUES (?, 'resume', 'batch', 'running', '{}', ?, ?, ?, 'gone-host:1', ?)
+                ''',
+                (job_id, json.dumps({"done": 2}), now - 3600, now - 3600, heartbeat),
+            )
+        conn.commit()
+    seen = []
+
+    async def resume(payload, ctx):
+        seen.append(ctx.checkpoint)
+        return "resumed"
+
+    async def main():
+        queue.register("resume", resume)
+        await queue.start()
+        try:
+            stale = await _wait_for(queue, "stale", "completed")
+            # A job still heartbeating in another process is left to it
+            alive = await queue.get("alive")
+        finally:
+            await queue.stop()
+        return stale, alive
+
+    stale, alive = asyncio.run(main())
+    assert stale["result"] == "resumed" and seen == [{"done": 2}]
+    assert alive["status"] == "running"
+
+
+def test_cancel_queued_and_running_jobs(make_queue):
+    queue = make_queue(batch=1)
+    cleaned, interrupted = [], []
+
+    async def main():
+        started = asyncio.Event()
+
+        async def work(payload, ctx):
+            started.set()
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                interrupted.append(payload["name"])
+                raise
+
+        queue.register("work", work, cleanup=lambda payload: cleaned.append(payload["name"]))
+        await queue.start()
+        try:
+            running = await queue.submit("work", {"name": "running"})
+            waiting = await queue.submit("work", {"name": "waiting"})
+            await started.wait()
+            assert (await queue.cancel(waiting["id"]))["status"] == "cancelled"
+            assert (await queue.cancel(running["id"]))["status"] == "cancelled"
+            await asyncio.sleep(0.05)
+            assert await queue.cancel("no-such-job") is None
+            return await queue.get(running["id"]), await queue.get(waiting["id"])
+        finally:
+            await queue.stop()
+
+    running, waiting = asyncio.run(main())
+    assert running["status"] == waiting["status"] == "cancelled"
+    # The queued job never started; the running one was interrupted, and both were cleaned up once
+    assert interrupted == ["running"]
+    assert sorted(cleaned) == ["running", "waiting"]
+
+
+def test_failed_job_keeps_its_error_and_can_be_retried(make_queue):
+    queue = make_queue()
+    attempts = []
+
+    async def flaky(payload, ctx):
+        attempts.append(ctx.checkpoint)
+        if len(attempts) == 1:
+            await ctx.report({"step": 1}, checkpoint={"step": 1})
+            raise RuntimeError("upstream went away")
+        return "done"
+
+    async def main():
+        queue.register("flaky", flaky)
+        await queue.start()
+        try:
+            job = await queue.submit("flaky", {})
+            failed = await _wait_for(queue, job["id"], "failed")
+            await queue.retry(job["id"])
+            return failed, await _wait_for(queue, job["id"], "completed")
+        finally:
+            await queue.stop()
+
+    failed, completed = asyncio.run(main())
+    assert failed["error"] == "upstream went away" and failed["progress"] == {"step": 1}
+    assert completed["result"] == "done"
+    assert attempts == [None, {"step": 1}]
+
+
+def test_unknown_kinds_and_lanes_are_rejected(make_queue):
+    queue = make_queue()
+    with pytest.raises(ValueError):
+        queue.register("anything", None, lane="nightly")
+    with pytest.raises(ValueError):
+        asyncio.run(queue.submit("unregistered", {}))
@@ -0,0 +1,94 @@
+import itertools
+import types
+
+import pytest
+
+import llm_cache
+from llm_cache import ALL_NOTES, ResponseCache, get_note_set_version
+from note_store import insert_notes
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = types.SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(llm_cache, "time", types.SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def _cache(get_connection, **kwargs):
+    return ResponseCache(get_connection, **kwargs)
+
+
+def test_hit_for_trivially_different_prompts(get_connection):
+    cache = _cache(get_connection)
+    cache.store("ask", "gpt-4o-mini", "What is due Friday?", 3, "The report", [1])
+    assert cache.lookup("ask", "gpt-4o-mini", "  what is DUE friday ", 3) == "The report"
+    assert cache.lookup("ask", "gpt-4o-mini", "What is due Friday?", 4) is None
+    assert cache.lookup("ask", "gpt-4o", "What is due Friday?", 3) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 1)
+
+
+def test_expired_entries_are_dropped(get_connection, clock):
+    cache = _cache(get_connection, ttl_seconds=60)
+    cache.store("ask", "gpt-4o-mini", "question", 1, "answer", [1])
+    clock.value += 59
+    assert cache.lookup("ask", "gpt-4o-mini", "question", 1) == "answer"
+    clock.value += 2
+    assert cache.lookup("ask", "gpt-4o-mini", "question", 1) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(get_connection, clock):
+    ticks = itertools.count()
+    cache = _cache(get_connection, max_entries=2)
+    for prompt in ("first", "second"):
+        clock.value = 1000 + next(ticks)
+        cache.store("ask", "gpt-4o-mini", prompt, 1, prompt.upper(), [1])
+    clock.value = 1000 + next(ticks)
+    assert cache.lookup("ask", "gpt-4o-mini", "first", 1) == "FIRST"
+    clock.value = 1000 + next(ticks)
+    cache.store("ask", "gpt-4o-mini", "third", 1, "THIRD", [1])
+    assert cache.lookup("ask", "gpt-4o-mini", "second", 1) is None
+    assert cache.lookup("ask", "gpt-4o-mini", "first", 1) == "FIRST"
+    assert cache.lookup("ask", "gpt-4o-mini", "third", 1) == "THIRD"
+
+
+def test_semantic_hit_needs_a_similar_prompt_over_the_same_notes(get_connection):
+    cache = _cache(get_connection, similarity_threshold=0.9)
+    cache.store("ask", "gpt-4o-mini", "when is the offsite", 5, "In June", [1], embedding=[1.0, 0.0, 0.0])
+    assert cache.lookup("ask", "gpt-4o-mini", "offsite date?", 5, embedding=[0.98, 0.1, 0.0]) == "In June"
+    assert cache.lookup("ask", "gpt-4o-mini", "who is coming", 5, embedding=[0.0, 1.0, 0.0]) is None
+    assert cache.lookup("ask", "gpt-4o-mini", "offsite date?", 6, embedding=[0.98, 0.1, 0.0]) is None
+    assert cache.stats()["semantic_hits"] == 1
+
+
+def test_invalidation_drops_entries_built_from_changed_notes(get_connection):
+    cache = _cache(get_connection)
+    cache.store("ask", "gpt-4o-mini", "about note one", 1, "one", [1, 3])
+    cache.store("ask", "gpt-4o-mini", "about note two", 1, "two", [2])
+    cache.store("summarize", "gpt-4o-mini", "", 1, "everything", [ALL_NOTES])
+    # Entries over the whole note set go with any change
+    assert cache.invalidate_notes([3]) == 2
+    assert cache.lookup("ask", "gpt-4o-mini", "about note one", 1) is None
+    assert cache.lookup("summarize", "gpt-4o-mini", "", 1) is None
+    assert cache.lookup("ask", "gpt-4o-mini", "about note two", 1) == "two"
+
+
+def test_note_writes_bump_the_note_set_version(get_connection):
+    with get_connection() as conn:
+        before = get_note_set_version(conn)
+        insert_notes(conn, ["a new note"])
+        conn.commit()
+        assert get_note_set_version(conn) > before
+
+
+def test_ask_is_cached_until_a_note_changes(client, tenant_headers):
+    headers = tenant_headers("response-cache")
+    client.post("/add_note", json={"content": "The launch review is on Tuesday"}, headers=headers)
+    question = {"query": "When is the launch review?"}
+
+    assert client.post("/ask", json=question, headers=headers).headers["X-Cache"] == "miss"
+    assert client.post("/ask", json=question, headers=headers).headers["X-Cache"] == "hit"
+    client.post("/add_note", json={"content": "The launch review moved to Wednesday"}, headers=headers)
+    assert client.post("/ask", json=question, headers=headers).headers["X-Cache"] == "miss"
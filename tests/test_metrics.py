@@ -0,0 +1,78 @@
+import re
+
+import pytest
+
+from coordination import worker_id
+from metrics import REGISTRY, Counter, Gauge, Histogram, RequestProfiler
+
+
+@pytest.fixture
+def unregistered():
+    """Drop metrics a test creates from the process-wide registry again"""
+    before = list(REGISTRY)
+    yield
+    REGISTRY[:] = before
+
+
+def test_counter_renders_one_sample_per_label_set(unregistered):
+    counter = Counter("test_events_total", "Events seen", ("kind",))
+    counter.inc(kind="b")
+    counter.inc(2, kind='a "quoted"\nvalue')
+    counter.inc(kind="b")
+    assert counter.render([("worker", "w1")]).splitlines() == [
+        "# HELP test_events_total Events seen",
+        "# TYPE test_events_total counter",
+        'test_events_total{kind="a \\"quoted\\"\\nvalue",worker="w1"} 2',
+        'test_events_total{kind="b",worker="w1"} 2',
+    ]
+
+
+def test_histogram_buckets_are_cumulative(unregistered):
+    histogram = Histogram("test_seconds", "Durations", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+    assert histogram.render().splitlines()[2:] == [
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="1.0"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        "test_seconds_sum 3.65",
+        "test_seconds_count 4",
+    ]
+
+
+def test_gauge_reads_its_callback_at_render_time(unregistered):
+    values = {("interactive",): 1}
+    gauge = Gauge("test_depth", "Queue depth", ("lane",), collect=lambda: dict(values))
+    values[("batch",)] = 4
+    assert gauge.render().splitlines()[1:] == [
+        "# TYPE test_depth gauge",
+        'test_depth{lane="batch"} 4',
+        'test_depth{lane="interactive"} 1',
+    ]
+
+
+def test_requests_are_recorded_by_route_template(client, tenant_headers):
+    headers = tenant_headers("metrics")
+    client.get("/note_summaries/123456", headers=headers)
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert re.search(r'^http_request_duration_seconds_count\{method="GET",route="/note_summaries/\{note_id\}",'
+                     r'status="\d+",worker="[^"]+"\} \d+$', response.text, re.MULTILINE)
+    assert "/note_summaries/123456" not in response.text
+
+
+def test_metrics_and_cache_stats_name_the_worker(client):
+    text = client.get("/metrics").text
+    samples = [line for line in text.splitlines() if line and not line.startswith("#")]
+    assert samples
+    assert all(f'worker="{worker_id()}"' in line for line in samples)
+    assert re.search(r'^http_request_duration_seconds_bucket\{.*worker="[^"]+",le="\+Inf"\} \d+$', text, re.MULTILINE)
+    assert client.get("/cache/stats").json()["worker"] == worker_id()
+
+
+def test_profiler_keeps_only_slow_requests(tmp_path):
+    profiler = RequestProfiler(sample_rate=1.0, slow_ms=50, directory=str(tmp_path))
+    assert profiler.finish(profiler.start(), 0.01, "GET /fast") is None
+    path = profiler.finish(profiler.start(), 0.2, "GET /get_notes")
+    assert path.endswith("-GET__get_notes.prof") and (tmp_path / path.rsplit("/", 1)[1]).exists()
+    assert RequestProfiler(sample_rate=0, directory=str(tmp_path)).start() is None
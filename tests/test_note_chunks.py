@@ -0,0 +1,48 @@
+import base64
+import random
+
+import pytest
+
+from context_budget import count_tokens
+from note_chunks import NOTE_CHUNK_MIN_BYTES, is_long, note_embedding_text, split_text
+
+CHUNK_TOKENS = 400
+
+random.seed(7)
+WORDS = ["alpha", "budget", "customer", "deployment", "embedding", "forecast", "gateway", "latency", "review"]
+INPUTS = {
+    "prose": "\n\n".join(" ".join(random.choices(WORDS, k=120)) + "." for _ in range(40)),
+    "csv": "\n".join(",".join(str(random.randint(0, 10 ** 6)) for _ in range(12)) for _ in range(2000)),
+    "no_spaces": "x" * 60000,
+    "base64": base64.b64encode(random.randbytes(30000)).decode("ascii"),
+    "cjk": "長い文章を分割する必要があります。" * 2000,
+    "markdown": "\n\n".join(f"## Section {i}\n\n" + " ".join(random.choices(WORDS, k=900)) for i in range(5)),
+    "long_heading": "# " + "heading " * 500 + "\n\n" + "body text " * 2000,
+}
+
+
+@pytest.mark.parametrize("name", sorted(INPUTS))
+def test_chunks_stay_within_the_token_bound(name):
+    chunks = split_text(INPUTS[name], CHUNK_TOKENS, 50)
+    assert chunks
+    for heading, content, token_count in chunks:
+        assert token_count == count_tokens(content)
+        assert token_count <= CHUNK_TOKENS
+        if heading:
+            assert count_tokens(heading) <= 32
+
+
+def test_chunks_cover_the_whole_text():
+    text = INPUTS["no_spaces"]
+    chunks = split_text(text, CHUNK_TOKENS, 0)
+    assert "".join(content for _, content, _ in chunks) == text
+
+
+def test_long_notes_are_measured_in_bytes():
+    # Three bytes per character in UTF-8: short by characters, long by bytes like notes.size
+    content = "語" * (NOTE_CHUNK_MIN_BYTES // 3 + 1)
+    assert len(content) < NOTE_CHUNK_MIN_BYTES
+    assert is_long(content)
+    assert not is_long("a" * NOTE_CHUNK_MIN_BYTES)
+    assert len(note_embedding_text(content).encode("utf-8")) <= NOTE_CHUNK_MIN_BYTES
+
@@ -0,0 +1,87 @@
+import pytest
+
+from db import connect
+from note_store import PREVIEW_CHARS, init_note_store, insert_notes, storage_stats, update_note
+from search import init_search_index
+
+LONG = "Long meeting notes. " * 40
+OTHER_LONG = "A different long note. " * 40
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = connect(str(tmp_path / "notes.db"))
+    yield conn
+    conn.close()
+
+
+def _contents(conn):
+    return dict(conn.execute("SELECT id, content FROM note_contents").fetchall())
+
+
+def _bodies(conn):
+    return conn.execute("SELECT COUNT(*) FROM note_bodies").fetchone()[0]
+
+
+def test_inline_content_is_moved_into_note_bodies(conn):
+    # The schema before bodies were split out: full text inline, indexed by triggers reading it
+    conn.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY AUTOINCREMENT, content TEXT NOT NULL)")
+    conn.execute("CREATE VIRTUAL TABLE notes_fts USING fts5(content, content='notes', content_rowid='id')")
+    conn.execute('''
+        CREATE TRIGGER notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    old = ["short note", LONG, LONG, "café ☕ " + OTHER_LONG]
+    conn.executemany("INSERT INTO notes (content) VALUES (?)", [(content,) for content in old])
+    conn.commit()
+
+    init_note_store(conn)
+    init_search_index(conn)
+
+    assert "content" not in {row[1] for row in conn.execute("PRAGMA table_info(notes)")}
+    assert _contents(conn) == dict(enumerate(old, start=1))
+    # The duplicate long note shares one body; the short one needs none
+    assert _bodies(conn) == 2
+    assert conn.execute("SELECT body_hash IS NULL, size FROM notes WHERE id = 1").fetchone() == (1, 10)
+    assert conn.execute("SELECT size FROM notes WHERE id = 4").fetchone()[0] == len(old[3].encode("utf-8"))
+    assert [row[0] for row in conn.execute("SELECT rowid FROM notes_fts WHERE notes_fts MATCH 'meeting'")] == [2, 3]
+
+    # Migrating again is a no-op
+    init_note_store(conn)
+    assert _contents(conn) == dict(enumerate(old, start=1))
+
+
+def test_shared_body_is_released_with_its_last_note(conn):
+    init_note_store(conn)
+    insert_notes(conn, [LONG, LONG, "short"])
+    conn.commit()
+    assert _bodies(conn) == 1
+
+    conn.execute("DELETE FROM notes WHERE id = 1")
+    assert _bodies(conn) == 1 and _contents(conn)[2] == LONG
+    # Editing the last user away from the body releases it too
+    update_note(conn, 2, OTHER_LONG)
+    assert _bodies(conn) == 1
+    assert conn.execute("SELECT preview FROM notes WHERE id = 2").fetchone()[0] == OTHER_LONG[:PREVIEW_CHARS]
+    conn.execute("DELETE FROM notes WHERE id = 2")
+    conn.commit()
+    assert _bodies(conn) == 0
+
+
+def test_update_of_a_missing_note_leaves_no_body(conn):
+    init_note_store(conn)
+    assert update_note(conn, 99, LONG) == 0
+    assert _bodies(conn) == 0
+
+
+def test_large_bodies_are_compressed_and_read_back(conn):
+    init_note_store(conn)
+    content = "x" * PREVIEW_CHARS + "the same line again\n" * 500
+    insert_notes(conn, [content])
+    conn.commit()
+    assert _contents(conn) == {1: content}
+    stats = storage_stats(conn)
+    assert stats["notes"] == 1 and stats["note_bytes"] == len(content)
+    assert stats["body_bytes"] == len(content) - PREVIEW_CHARS
+    assert stats["stored_body_bytes"] < stats["body_bytes"] // 10
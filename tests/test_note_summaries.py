@@ -0,0 +1,69 @@
+import time
+
+from llm_cache import get_note_set_version
+from note_chunks import NOTE_CHUNK_MIN_BYTES
+from note_store import content_hash, insert_notes, update_note
+from note_summaries import COMPACT_NOTES_SQL, NoteSummaries
+
+
+def _add_note(get_connection, content):
+    with get_connection() as conn:
+        insert_notes(conn, [content])
+        conn.commit()
+        return conn.execute("SELECT max(id) FROM notes").fetchone()[0]
+
+
+def _store_summary(summaries, note_id, content, summary):
+    summaries._store([(note_id, content_hash(content), summary, "[]", 100, 2, time.time(), note_id)])
+
+
+def _compact_text(get_connection, note_id):
+    with get_connection() as conn:
+        return dict(conn.execute(COMPACT_NOTES_SQL).fetchall())[note_id]
+
+
+def test_summary_is_used_while_current(get_connection):
+    content = "quarterly planning " * (NOTE_CHUNK_MIN_BYTES // 10)
+    note_id = _add_note(get_connection, content)
+    summaries = NoteSummaries(None, get_connection)
+    _store_summary(summaries, note_id, content, "OLD SUMMARY")
+    assert _compact_text(get_connection, note_id) == "OLD SUMMARY"
+
+
+def test_edited_long_note_drops_its_stale_summary(get_connection):
+    content = "quarterly planning " * (NOTE_CHUNK_MIN_BYTES // 10)
+    note_id = _add_note(get_connection, content)
+    summaries = NoteSummaries(None, get_connection)
+    _store_summary(summaries, note_id, content, "OLD SUMMARY")
+
+    edited = "migration runbook " * (NOTE_CHUNK_MIN_BYTES // 10)
+    with get_connection() as conn:
+        update_note(conn, note_id, edited)
+        conn.commit()
+
+    text = _compact_text(get_connection, note_id)
+    assert text != "OLD SUMMARY"
+    assert text.startswith("migration runbook")
+
+
+def test_edited_short_note_drops_its_stale_summary(get_connection):
+    note_id = _add_note(get_connection, "call the bank")
+    summaries = NoteSummaries(None, get_connection)
+    _store_summary(summaries, note_id, "call the bank", "OLD SUMMARY")
+    assert _compact_text(get_connection, note_id) == "OLD SUMMARY"
+
+    with get_connection() as conn:
+        update_note(conn, note_id, "call the dentist")
+        conn.commit()
+
+    assert _compact_text(get_connection, note_id) == "call the dentist"
+
+
+def test_storing_summaries_invalidates_cached_answers(get_connection):
+    note_id = _add_note(get_connection, "call the bank")
+    summaries = NoteSummaries(None, get_connection)
+    with get_connection() as conn:
+        before = get_note_set_version(conn)
+    _store_summary(summaries, note_id, "call the bank", "Bank call")
+    with get_connection() as conn:
+        assert get_note_set_version(conn) > before
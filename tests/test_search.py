@@ -0,0 +1,76 @@
+import pytest
+
+from search import build_match_query
+
+
+@pytest.fixture(scope="module")
+def searcher(client, tenant_headers):
+    headers = tenant_headers("search")
+    for content in ["Deploy the billing service on Friday",
+                    "Billing dashboard shows deployment errors",
+                    "Lunch with the design team",
+                    "Café opening hours changed"]:
+        client.post("/add_note", json={"content": content}, headers=headers)
+    return headers
+
+
+def _search(client, headers, **params):
+    response = client.get("/search", params=params, headers=headers)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_terms_are_quoted_and_anded():
+    assert build_match_query("billing deploy") == '"billing" "deploy"'
+    # FTS operators and punctuation are searched as plain words, never parsed
+    assert build_match_query('billing OR "x" NEAR(a') == '"billing" "OR" "x" "NEAR" "a"'
+    assert build_match_query("*** --") is None
+
+
+def test_prefix_terms():
+    assert build_match_query("bill* deploy") == '"bill"* "deploy"'
+    assert build_match_query("billing dep", prefix=True) == '"billing" "dep"*'
+    assert build_match_query("e-mail*") == '"e" "mail"*'
+
+
+def test_search_ranks_and_highlights(client, searcher):
+    results = _search(client, searcher, q="billing")["results"]
+    assert len(results) == 2
+    assert all("<mark>billing</mark>" in hit["snippet"].lower() for hit in results)
+    assert results[0]["score"] >= results[1]["score"]
+
+
+def test_prefix_search_as_you_type(client, searcher):
+    assert len(_search(client, searcher, q="deploy")["results"]) == 1
+    assert len(_search(client, searcher, q="depl", prefix=True)["results"]) == 2
+    assert len(_search(client, searcher, q="depl*")["results"]) == 2
+    # Diacritics are folded both ways
+    assert len(_search(client, searcher, q="cafe")["results"]) == 1
+
+
+def test_injected_syntax_is_harmless(client, searcher):
+    for query in ['billing OR lunch', '"unbalanced', 'NEAR(billing', 'content:billing', '^billing']:
+        response = client.get("/search", params={"q": query}, headers=searcher)
+        assert response.status_code == 200
+    assert _search(client, searcher, q="billing OR lunch")["results"] == []
+
+
+def test_offset_pages_through_results(client, searcher):
+    first = _search(client, searcher, q="billing", limit=1)
+    assert len(first["results"]) == 1 and first["next_offset"] == 1
+    second = _search(client, searcher, q="billing", limit=1, offset=first["next_offset"])
+    assert len(second["results"]) == 1
+    assert second["results"][0]["id"] != first["results"][0]["id"]
+    last = _search(client, searcher, q="billing", limit=1, offset=2)
+    assert last["results"] == [] and last["next_offset"] is None
+    assert client.get("/search", params={"q": "billing", "offset": -1}, headers=searcher).status_code == 400
+
+
+def test_edits_and_deletes_update_the_index(client, searcher):
+    note_id = client.post("/add_note", json={"content": "Quarterly zeppelin review"}, headers=searcher).json()["id"]
+    assert [hit["id"] for hit in _search(client, searcher, q="zeppelin")["results"]] == [note_id]
+    client.put(f"/edit_note/{note_id}", json={"content": "Quarterly airship review"}, headers=searcher)
+    assert _search(client, searcher, q="zeppelin")["results"] == []
+    assert [hit["id"] for hit in _search(client, searcher, q="airship")["results"]] == [note_id]
+    client.delete(f"/delete_note/{note_id}", headers=searcher)
+    assert _search(client, searcher, q="airship")["results"] == []
@@ -0,0 +1,90 @@
+import itertools
+import types
+
+import pytest
+
+import summarizer as summarizer_module
+from context_budget import count_tokens
+from summarizer import MapReduceSummarizer, init_summary_cache
+from upstream import UpstreamOverloaded
+
+
+def _summarizer(**kwargs):
+    return MapReduceSummarizer(None, None, **kwargs)
+
+
+@pytest.mark.parametrize("fanout", [-1, 0, 1])
+def test_fanout_below_two_is_rejected(fanout):
+    with pytest.raises(ValueError):
+        _summarizer(fanout=fanout)
+
+
+@pytest.mark.parametrize("settings", [{"chunk_tokens": 0}, {"boundary_every": 0}])
+def test_non_positive_chunk_settings_are_rejected(settings):
+    with pytest.raises(ValueError):
+        _summarizer(**settings)
+
+
+@pytest.mark.parametrize("fanout", [2, 3, 4, 8])
+@pytest.mark.parametrize("count", [2, 3, 5, 17, 100])
+def test_every_reduce_level_shrinks_until_one_summary_is_left(fanout, count):
+    summarizer = _summarizer(fanout=fanout)
+    level = [f"summary {index}" for index in range(count)]
+    for _ in range(count):
+        groups = summarizer._group(level)
+        assert [summary for group in groups for summary in group] == level
+        assert len(groups) < len(level)
+        level = ["\n\n".join(group) for group in groups]
+        if len(level) == 1:
+            break
+    assert len(level) == 1
+
+
+def test_summary_stream_sends_tokens_then_done(client, tenant_headers):
+    headers = tenant_headers("stream-summary")
+    client.post("/add_note", json={"content": "Quarterly planning moved to Thursday"}, headers=headers)
+
+    response = client.post("/summarize/stream", headers=headers)
+    assert response.status_code == 200
+    assert "event: token" in response.text
+    assert response.text.rstrip().endswith('event: done\ndata: {}')
+
+
+def test_overloaded_summary_stream_is_shed_before_the_response_starts(client, tenant_headers, monkeypatch):
+    headers = tenant_headers("stream-overload")
+    client.post("/add_note", json={"content": "Renew the office lease before May"}, headers=headers)
+
+    async def overloaded(*args, **kwargs):
+        raise UpstreamOverloaded("tokens per minute", 7)
+
+    monkeypatch.setattr(summarizer_module, "call_openai", overloaded)
+    response = client.post("/summarize/stream", headers=headers)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "7"
+    assert "event:" not in response.text
+
+
+@pytest.mark.parametrize("fanout", [2, 4, 8])
+def test_reduce_groups_fit_the_chunk_budget(fanout):
+    summarizer = _summarizer(fanout=fanout, chunk_tokens=200)
+    level = [" ".join(f"point{index}x{word}" for word in range(length))
+             for index, length in enumerate([30, 180, 5, 60, 400, 90, 12, 75, 150, 40] * 3)]
+    while len(level) > 1:
+        groups = summarizer._group(level)
+        assert len(groups) < len(level)
+        level = ["\n\n".join(group) for group in groups]
+        assert all(count_tokens(text) <= 200 for text in level)
+
+
+def test_summary_cache_evicts_the_least_recently_used(get_connection, monkeypatch):
+    clock = itertools.count(1)
+    monkeypatch.setattr(summarizer_module, "time", types.SimpleNamespace(time=lambda: next(clock)))
+    with get_connection() as conn:
+        init_summary_cache(conn)
+    summarizer = MapReduceSummarizer(None, get_connection, max_entries=3)
+    for key, summary in [("a", "first"), ("b", "second"), ("c", "third")]:
+        summarizer._store({key: summary})
+    # Reading "a" makes "b" the least recently used
+    assert summarizer._load_cached(["a"]) == {"a": "first"}
+    summarizer._store({"d": "fourth"})
+    assert summarizer._load_cached(["a", "b", "c", "d"]) == {"a": "first", "c": "third", "d": "fourth"}
@@ -0,0 +1,113 @@
+import asyncio
+import os
+
+import pytest
+
+import app
+from tenants import DEFAULT_TENANT, TENANT_DATA_DIR, TENANT_HEADER, TenantRegistry, bearer_token
+
+ADMIN = {"Authorization": "Bearer test-admin"}
+
+
+def _contents(client, headers):
+    return [row[1] for row in client.get("/get_notes", headers=headers).json()]
+
+
+def test_tenants_only_see_their_own_notes(client, tenant_headers):
+    north, south = tenant_headers("north"), tenant_headers("south")
+    client.post("/add_note", json={"content": "north ledger"}, headers=north)
+    client.post("/add_note", json={"content": "south ledger"}, headers=south)
+
+    assert _contents(client, north) == ["north ledger"]
+    assert _contents(client, south) == ["south ledger"]
+    assert "north ledger" not in _contents(client, {})
+    hits = client.get("/search", params={"q": "ledger"}, headers=north).json()["results"]
+    assert [hit["snippet"] for hit in hits] == ["north <mark>ledger</mark>"]
+
+
+def test_ask_only_reads_the_callers_notes(client, app_transport, tenant_headers):
+    east, west = tenant_headers("east"), tenant_headers("west")
+    client.post("/add_note", json={"content": "The east vault code is 4417"}, headers=east)
+    client.post("/add_note", json={"content": "The west vault code is 9902"}, headers=west)
+
+    del app_transport.requests[:]
+    assert client.post("/ask", json={"query": "What is the vault code?"}, headers=east).status_code == 200
+    prompts = [body["messages"][-1]["content"] for path, body in app_transport.requests
+               if path.endswith("/chat/completions")]
+    assert prompts and all("4417" in prompt and "9902" not in prompt for prompt in prompts)
+
+
+def test_tenant_id_alone_is_not_enough(client, tenant_headers):
+    tenant_headers("guarded")
+    response = client.get("/get_notes", headers={TENANT_HEADER: "guarded"})
+    assert response.status_code == 401
+    assert response.headers["www-authenticate"] == "Bearer"
+
+
+def test_another_tenants_key_is_refused(client, tenant_headers):
+    first, second = tenant_headers("first-co"), tenant_headers("second-co")
+    response = client.get("/get_notes", headers={**first, "Authorization": second["Authorization"]})
+    assert response.status_code == 401
+
+
+def test_unknown_tenants_are_refused_without_creating_a_database(client):
+    response = client.post("/add_note", json={"content": "squatting"},
+                           headers={TENANT_HEADER: "never-registered", "Authorization": "Bearer guess"})
+    assert response.status_code == 401
+    assert not os.path.exists(os.path.join(TENANT_DATA_DIR, "never-registered.db"))
+    assert "never-registered" not in [shard.tenant_id for shard in app.tenants.shards()]
+
+
+def test_rotating_a_key_revokes_the_old_one(client):
+    old = client.post("/tenants", json={"tenant_id": "rotating"}, headers=ADMIN).json()["key"]
+    new = client.post("/tenants", json={"tenant_id": "rotating"}, headers=ADMIN).json()["key"]
+    assert client.get("/get_notes", headers={TENANT_HEADER: "rotating", "Authorization": f"Bearer {old}"}) \
+        .status_code == 401
+    assert client.get("/get_notes", headers={TENANT_HEADER: "rotating", "Authorization": f"Bearer {new}"}) \
+        .status_code == 200
+
+
+@pytest.mark.parametrize("headers", [{}, {"Authorization": "Bearer wrong"}])
+def test_registering_tenants_needs_the_admin_token(client, headers):
+    response = client.post("/tenants", json={"tenant_id": "sneaky"}, headers=headers)
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize("tenant_id", ["../etc", "", DEFAULT_TENANT])
+def test_invalid_tenant_ids_are_rejected(client, tenant_id):
+    assert client.post("/tenants", json={"tenant_id": tenant_id}, headers=ADMIN).status_code == 400
+
+
+def test_bearer_token_parsing():
+    assert bearer_token("Bearer abc") == "abc"
+    assert bearer_token("bearer  abc ") == "abc"
+    assert bearer_token("Basic abc") is None
+    assert bearer_token("Bearer") is None
+    assert bearer_token(None) is None
+
+
+def test_registry_closes_the_least_recently_used_idle_shard():
+    opened, closed = [], []
+
+    class Shard:
+        pool = None
+
+    async def open_shard(tenant_id):
+        opened.append(tenant_id)
+        return Shard()
+
+    async def close_shard(shard):
+        closed.append(shard)
+
+    async def main():
+        registry = TenantRegistry(open_shard, close_shard, capacity=2, pinned=())
+        for tenant_id in ("a", "b", "a", "c"):
+            await registry.acquire(tenant_id)
+            registry.release(tenant_id)
+        return registry
+
+    registry = asyncio.run(main())
+    assert opened == ["a", "b", "c"]
+    assert len(closed) == 1
+    assert registry.stats()["evictions"] == 1
+    assert sorted(registry._shards) == ["a", "c"]
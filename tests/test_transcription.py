@@ -0,0 +1,142 @@
+import asyncio
+import io
+import os
+import shutil
+import wave
+
+import numpy as np
+import pytest
+
+import transcription
+from transcription import FakeBackend, TranscriptionJob, TranscriptionPipeline, WhisperBackend, split_audio
+
+RATE = 16000
+
+
+class Upload:
+    """The parts of an UploadFile the pipeline reads"""
+
+    def __init__(self, filename, data):
+        self.filename = filename
+        self._data = io.BytesIO(data)
+
+    async def read(self, size=-1):
+        return self._data.read(size)
+
+
+class CountingBackend(FakeBackend):
+    def __init__(self):
+        self.calls = []
+
+    async def transcribe(self, path):
+        self.calls.append(os.path.basename(path))
+        return await super().transcribe(path)
+
+
+def _wav_bytes(seconds, channels=1, sample_width=2):
+    # A tone with a quiet gap every second, so cuts can land on silence
+    t = np.arange(int(seconds * RATE)) / RATE
+    samples = (np.sin(2 * np.pi * 440 * t) * 8000 * (t % 1 > 0.1)).astype("<i4") << 8 * (sample_width - 2)
+    # Little-endian: the low sample_width bytes of each 32-bit sample
+    frames = np.repeat(samples, channels).view(np.uint8).reshape(-1, 4)[:, :sample_width]
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(sample_width)
+        wav.setframerate(RATE)
+        wav.writeframes(frames.tobytes())
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("channels, sample_width", [(1, 2), (2, 2), (1, 3)])
+def test_wav_segments_fit_the_upload_limit(tmp_path, monkeypatch, channels, sample_width):
+    # Limit the segments by size rather than duration, like high-rate audio against the real limit;
+    # 24-bit audio is cut without a silence search, so its segments fill the whole window
+    monkeypatch.setattr(transcription, "SEGMENT_MAX_BYTES", 100_000)
+    path = tmp_path / "long.wav"
+    path.write_bytes(_wav_bytes(20, channels, sample_width))
+    segments = split_audio(str(path), str(tmp_path), path.stat().st_size)
+    assert len(segments) > 1
+    assert all(os.path.getsize(segment) <= 100_000 for segment, _, _ in segments)
+    # Segments are contiguous and cover the whole recording
+    assert segments[0][1] == 0
+    assert all(previous[2] == current[1] for previous, current in zip(segments, segments[1:]))
+    assert segments[-1][2] == pytest.approx(20)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is not None, reason="ffmpeg can split any format")
+def test_large_non_wav_audio_without_ffmpeg_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(transcription, "SEGMENT_MAX_BYTES", 1000)
+    path = tmp_path / "long.mp3"
+    path.write_bytes(b"\xff" * 5000)
+    with pytest.raises(ValueError):
+        split_audio(str(path), str(tmp_path), 5000)
+
+
+def test_whisper_rejects_an_oversized_segment_before_uploading(tmp_path):
+    path = tmp_path / "segment.mp3"
+    with open(path, "wb") as out:
+        out.truncate(transcription.WHISPER_MAX_BYTES + 1)
+    # No client: the size check must fail before any request is made
+    with pytest.raises(ValueError):
+        asyncio.run(WhisperBackend(None).transcribe(str(path)))
+
+
+def test_pipeline_stitches_segments_in_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(transcription, "SEGMENT_MAX_BYTES", 100_000)
+    backend = CountingBackend()
+    pipeline = TranscriptionPipeline(backend, workers=2, tmp_dir=str(tmp_path))
+
+    async def main():
+        job = await pipeline.create_job(Upload("memo.wav", _wav_bytes(10)))
+        return job, await pipeline.run(job)
+
+    job, result = asyncio.run(main())
+    assert len(result["segments"]) == len(job.segments) > 1
+    assert [segment["index"] for segment in result["segments"]] == list(range(len(job.segments)))
+    assert result["transcription"].split("] [")[0].startswith("[segment_0000.wav")
+    assert sorted(backend.calls) == [os.path.basename(path) for path, _, _ in job.segments]
+    assert not os.path.exists(job.work_dir)
+
+
+def test_resumed_job_only_transcribes_missing_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(transcription, "SEGMENT_MAX_BYTES", 100_000)
+    pipeline = TranscriptionPipeline(FakeBackend(), tmp_dir=str(tmp_path))
+    job = asyncio.run(pipeline.create_job(Upload("memo.wav", _wav_bytes(10))))
+
+    # Restore from the persisted payload with the first segment already transcribed
+    resumed = TranscriptionJob.from_payload(job.to_payload(), {"0": "first part"})
+    backend = CountingBackend()
+    result = asyncio.run(TranscriptionPipeline(backend, tmp_dir=str(tmp_path)).run(resumed))
+    assert "segment_0000.wav" not in backend.calls
+    assert len(backend.calls) == len(job.segments) - 1
+    assert result["transcription"].startswith("first part ")
+
+
+def test_failed_segment_cancels_the_others(tmp_path, monkeypatch):
+    monkeypatch.setattr(transcription, "SEGMENT_MAX_BYTES", 100_000)
+    started, cancelled = [], []
+
+    class FailingBackend:
+        async def transcribe(self, path):
+            started.append(path)
+            if len(started) == 1:
+                await asyncio.sleep(0)
+                raise RuntimeError("upstream failed")
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(path)
+                raise
+
+    pipeline = TranscriptionPipeline(FailingBackend(), workers=2, tmp_dir=str(tmp_path))
+
+    async def main():
+        job = await pipeline.create_job(Upload("memo.wav", _wav_bytes(20)))
+        with pytest.raises(RuntimeError):
+            await pipeline.run(job)
+        # By the time the error reaches the caller, which discards the job's files, nothing reads them
+        assert started[1:] and sorted(cancelled) == sorted(started[1:])
+        assert len(started) < len(job.segments)
+
+    asyncio.run(main())
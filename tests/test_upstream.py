@@ -0,0 +1,121 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+import upstream
+from upstream import AdaptiveLimiter, TokenBucket, UpstreamOverloaded, call_openai
+
+
+def test_failed_attempt_refunds_its_request_and_tokens(monkeypatch):
+    monkeypatch.setattr(upstream, "request_bucket", TokenBucket(60))
+    monkeypatch.setattr(upstream, "token_bucket", TokenBucket(6000))
+
+    async def failing():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        asyncio.run(call_openai(failing, tokens=1000, kind="test"))
+    assert upstream.request_bucket.available() == pytest.approx(60, abs=0.1)
+    assert upstream.token_bucket.available() == pytest.approx(6000, abs=1)
+
+
+def test_limit_halves_on_overload_and_grows_back_additively():
+    limiter = AdaptiveLimiter(8, minimum=2)
+    limiter.on_overload()
+    assert limiter.limit == 4
+    # A burst of errors from the same round trip counts once
+    limiter.on_overload()
+    assert limiter.limit == 4
+    for _ in range(4):
+        limiter.on_success("chat", 0.1)
+    assert limiter.limit == pytest.approx(5, abs=0.1)
+    limiter._last_decrease = 0.0
+    limiter.on_overload()
+    limiter._last_decrease = 0.0
+    limiter.on_overload()
+    assert limiter.limit == 2
+
+
+def test_latency_spike_cuts_the_limit_gently():
+    limiter = AdaptiveLimiter(10)
+    for _ in range(20):
+        limiter.on_success("chat", 0.1)
+    assert limiter.limit == 10
+    limiter.on_success("chat", 1.0)
+    assert limiter.limit == pytest.approx(9)
+
+
+def test_calls_beyond_the_queue_bound_are_shed():
+    async def main():
+        limiter = AdaptiveLimiter(1, max_queue=1, max_wait=5)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(UpstreamOverloaded) as shed:
+            await limiter.acquire()
+        limiter.release()
+        await waiter
+        return shed.value
+
+    shed = asyncio.run(main())
+    assert shed.reason == "queue full" and shed.retry_after >= 1
+
+
+def test_waiting_too_long_for_a_slot_is_shed():
+    async def main():
+        limiter = AdaptiveLimiter(1, max_wait=0.01)
+        await limiter.acquire()
+        with pytest.raises(UpstreamOverloaded) as shed:
+            await limiter.acquire()
+        # The abandoned waiter does not take the slot once it frees up
+        limiter.release()
+        assert limiter.stats() == {"limit": 1.0, "in_flight": 0, "queued": 0}
+        return shed.value
+
+    assert asyncio.run(main()).reason == "queue timeout"
+
+
+def test_exhausted_token_budget_is_shed_without_a_call(monkeypatch):
+    bucket = TokenBucket(600)
+    bucket.take(600)
+    monkeypatch.setattr(upstream, "token_bucket", bucket)
+    calls = []
+
+    async def request():
+        calls.append(1)
+
+    with pytest.raises(UpstreamOverloaded) as shed:
+        asyncio.run(call_openai(request, tokens=500, kind="test"))
+    assert shed.value.reason == "rate limit" and shed.value.retry_after == 50
+    assert calls == []
+
+
+def test_upstream_rate_limit_becomes_overloaded_with_its_retry_after(monkeypatch):
+    limiter = AdaptiveLimiter(8)
+    monkeypatch.setattr(upstream, "limiter", limiter)
+
+    async def rate_limited():
+        response = httpx.Response(429, headers={"retry-after": "12"},
+                                  request=httpx.Request("POST", "http://fake-openai/v1/chat/completions"))
+        raise openai.RateLimitError("slow down", response=response, body=None)
+
+    with pytest.raises(UpstreamOverloaded) as shed:
+        asyncio.run(call_openai(rate_limited, tokens=10, kind="test"))
+    assert shed.value.retry_after == 12
+    assert limiter.limit == 4 and limiter.in_flight == 0
+
+
+def test_overloaded_ask_is_a_503_with_retry_after(client, tenant_headers, monkeypatch):
+    headers = tenant_headers("shedding")
+    client.post("/add_note", json={"content": "The backup window is 2am"}, headers=headers)
+    # The prompt alone needs most of this budget, so the wait would far exceed OPENAI_MAX_QUEUE_SECONDS
+    bucket = TokenBucket(300)
+    bucket.take(300)
+    monkeypatch.setattr(upstream, "token_bucket", bucket)
+
+    response = client.post("/ask", json={"query": "When is the backup window?"}, headers=headers)
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) > 10
+    assert "capacity exhausted" in response.json()["detail"]
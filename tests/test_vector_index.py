@@ -0,0 +1,136 @@
+import asyncio
+import re
+
+import numpy as np
+import pytest
+
+import vector_index
+from app import ASK_TOP_K
+from vector_index import HashingEmbedder, VectorIndex
+
+TOPICS = ["invoice", "garden", "kernel", "recipe", "marathon", "telescope", "violin", "mortgage",
+          "glacier", "compiler", "orchid", "harbor", "saffron", "quartz", "falcon", "lantern"]
+
+
+@pytest.fixture
+def index(get_connection):
+    return VectorIndex("notes", HashingEmbedder(dim=64), get_connection)
+
+
+def test_search_returns_the_top_k_by_cosine_similarity(index):
+    asyncio.run(index.upsert_many(range(1, len(TOPICS) + 1), [f"notes about {topic}" for topic in TOPICS]))
+    hits = asyncio.run(index.search("telescope", k=3))
+    assert len(hits) == 3
+    assert hits[0][0] == TOPICS.index("telescope") + 1
+    scores = [score for _, score in hits]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_search_matches_a_brute_force_ranking(index):
+    rng = np.random.default_rng(3)
+    vectors = rng.normal(size=(200, 64)).astype(np.float32)
+    index._put(list(range(200)), vectors)
+    query = rng.normal(size=64).astype(np.float32)
+    query /= np.linalg.norm(query)
+    expected = np.argsort(-(vectors / np.linalg.norm(vectors, axis=1, keepdims=True)) @ query)[:10]
+    assert [note_id for note_id, _ in index.search_vector(query, k=10)] == list(expected)
+
+
+def test_updates_are_incremental_and_persisted(index, get_connection):
+    asyncio.run(index.upsert_many([1, 2, 3], ["invoice due", "garden plan", "kernel build"]))
+    asyncio.run(index.upsert(2, "kernel panic"))
+    assert index.remove(3)
+    assert sorted(index.ids()) == [1, 2]
+    assert asyncio.run(index.search("kernel", k=1))[0][0] == 2
+
+    # Another process (or a restart) sees the same vectors without embedding again
+    reopened = VectorIndex("notes", HashingEmbedder(dim=64), get_connection)
+    assert sorted(reopened.ids()) == [1, 2]
+    assert asyncio.run(reopened.search("kernel", k=1))[0][0] == 2
+
+
+def test_sync_embeds_only_the_difference(index, get_connection):
+    with get_connection() as conn:
+        conn.executemany("INSERT INTO notes (body_hash, preview, size) VALUES (NULL, ?, ?)",
+                         [(f"about {topic}", 10) for topic in TOPICS[:4]])
+        conn.commit()
+    asyncio.run(index.upsert_many([99], ["deleted meanwhile"]))
+    assert asyncio.run(index.sync()) == {"added": 4, "removed": 1}
+    assert asyncio.run(index.sync()) == {"added": 0, "removed": 0}
+
+
+def test_ask_sends_only_the_top_k_notes(client, app_transport, tenant_headers):
+    headers = tenant_headers("retrieval")
+    for topic in TOPICS * 2:
+        client.post("/add_note", json={"content": f"Checklist for the {topic} project"}, headers=headers)
+    client.post("/add_note", json={"content": "The telescope mirror needs recoating in May"}, headers=headers)
+
+    del app_transport.requests[:]
+    response = client.post("/ask", json={"query": "When does the telescope mirror need recoating?"}, headers=headers)
+    assert response.status_code == 200
+    (prompt,) = [body["messages"][-1]["content"] for path, body in app_transport.requests
+                 if path.endswith("/chat/completions")]
+    included = re.findall(r"Note #(\d+):", prompt)
+    assert 0 < len(included) <= ASK_TOP_K
+    assert "recoating in May" in prompt
+
+
+class WorkerIndex(VectorIndex):
+    """A VectorIndex acting as the copy held by one worker process"""
+
+    def __init__(self, worker, *args):
+        self.worker = worker
+        super().__init__(*args)
+
+    def _report(self, conn):
+        vector_index.worker_id = lambda: self.worker
+        return super()._report(conn)
+
+    def compact(self):
+        vector_index.worker_id = lambda: self.worker
+        return super().compact()
+
+
+@pytest.fixture
+def open_index(get_connection, monkeypatch):
+    # WorkerIndex swaps vector_index.worker_id; monkeypatch puts the original back afterwards
+    monkeypatch.setattr(vector_index, "worker_id", vector_index.worker_id)
+    embedder = HashingEmbedder(dim=16)
+    return lambda worker: WorkerIndex(worker, "notes", embedder, get_connection)
+
+
+def _markers(get_connection):
+    with get_connection() as conn:
+        return conn.execute("SELECT count(*) FROM vector_rows WHERE vector IS NULL").fetchone()[0]
+
+
+def test_markers_wait_for_every_live_worker(open_index, get_connection):
+    first, second = open_index("first"), open_index("second")
+    asyncio.run(first.upsert_many([1, 2, 3], ["one", "two", "three"]))
+    second.refresh()
+    first.remove(2)
+
+    assert first.compact() == 0
+    assert _markers(get_connection) == 1
+
+    second.refresh()
+    assert first.compact() == 1
+    assert _markers(get_connection) == 0
+    assert sorted(second.ids()) == [1, 3]
+
+
+def test_forgotten_worker_reloads_after_compaction(open_index, get_connection, monkeypatch):
+    first, idle = open_index("first"), open_index("idle")
+    asyncio.run(first.upsert_many([1, 2], ["one", "two"]))
+    idle.refresh()
+    first.remove(2)
+
+    # The idle worker has not been seen for longer than the reader TTL
+    monkeypatch.setattr(vector_index, "VECTOR_READER_TTL_SECONDS", -1)
+    monkeypatch.setattr(vector_index, "VECTOR_READER_TOUCH_SECONDS", -1)
+    assert first.compact() == 1
+    assert sorted(idle.ids()) == [1, 2]
+
+    idle.refresh()
+    assert sorted(idle.ids()) == [1]
+    assert sorted(open_index("new").ids()) == [1]
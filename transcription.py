@@ -0,0 +1,316 @@
+import asyncio
+import csv
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import wave
+from pathlib import Path
+
+import numpy as np
+
+from metrics import UPLOAD_BYTES
+from upstream import call_openai
+
+logger = logging.getLogger(__name__)
+
+# Transcription settings (overridable through environment variables)
+TRANSCRIBE_TMP_DIR = os.getenv("TRANSCRIBE_TMP_DIR", os.path.join(tempfile.gettempdir(), "notes-transcribe"))
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", "4"))
+TRANSCRIBE_MAX_UPLOAD_BYTES = int(os.getenv("TRANSCRIBE_MAX_UPLOAD_BYTES", str(2 * 1024 * 1024 * 1024)))
+SEGMENT_SECONDS = float(os.getenv("TRANSCRIBE_SEGMENT_SECONDS", "600"))
+# Whisper rejects uploads over 25MB; segments are cut to stay under it with some headroom
+WHISPER_MAX_BYTES = 25 * 1024 * 1024
+SEGMENT_MAX_BYTES = 24 * 1024 * 1024
+# Audio that stream copy cannot cut small enough is re-encoded as mono speech-quality MP3 (~3.6MB per 10 minutes)
+TRANSCODE_ARGS = ["-ac", "1", "-ar", "16000", "-c:a", "libmp3lame", "-b:a", "48k"]
+# How far back from a window edge to look for a quiet point to cut at
+SILENCE_SEARCH_SECONDS = 5.0
+# Header of the PCM WAV files split_wav writes, on top of their frames
+WAV_HEADER_BYTES = 44
+SPOOL_CHUNK_BYTES = 1024 * 1024
+
+
+# Transcription backends
+class WhisperBackend:
+    """Transcribes segment files with the OpenAI Whisper API"""
+
+    def __init__(self, client, model="whisper-1"):
+        self.client = client
+        self.model = model
+
+    async def transcribe(self, path):
+        size = os.path.getsize(path)
+        if size > WHISPER_MAX_BYTES:
+            raise ValueError(f"Segment {os.path.basename(path)} is {size} bytes, over the Whisper upload limit")
+        # A Path is re-read by the SDK on every attempt, so retries resend the whole file
+        response = await call_openai(lambda: self.client.audio.transcriptions.create(
+            model=self.model,
+            file=Path(path)
+        ), kind="transcription")
+        return response.text
+
+
+class FakeBackend:
+    """Deterministic local transcriber for tests and benchmarks (no network)"""
+
+    async def transcribe(self, path):
+        return f"[{os.path.basename(path)}: {os.path.getsize(path)} bytes]"
+
+
+def get_transcription_backend(client=None):
+    """Pick the backend from the TRANSCRIBE_BACKEND environment variable"""
+    backend = os.getenv("TRANSCRIBE_BACKEND", "openai").lower()
+    if backend == "fake":
+        return FakeBackend()
+    if backend == "openai":
+        return WhisperBackend(client)
+    raise ValueError(f"Unknown TRANSCRIBE_BACKEND: {backend}")
+
+
+# Spooling and splitting
+class UploadTooLarge(Exception):
+    pass
+
+
+async def spool_upload(upload, directory):
+    """Copy an UploadFile to disk in fixed-size chunks; returns (path, size)"""
+    os.makedirs(directory, exist_ok=True)
+    suffix = os.path.splitext(upload.filename or "")[1] or ".audio"
+    path = os.path.join(directory, f"source{suffix}")
+    size = 0
+    with open(path, "wb") as out:
+        while True:
+            chunk = await upload.read(SPOOL_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > TRANSCRIBE_MAX_UPLOAD_BYTES:
+                raise UploadTooLarge(f"File size must be less than {TRANSCRIBE_MAX_UPLOAD_BYTES // (1024 * 1024)}MB")
+            await asyncio.to_thread(out.write, chunk)
+    UPLOAD_BYTES.observe(size, endpoint="transcribe_audio")
+    return path, size
+
+
+def _quietest_frame(wav, frames):
+    """Return the offset (in frames) of the quietest 20ms window in the next `frames` frames"""
+    if wav.getsampwidth() == 2:
+        data = np.frombuffer(wav.readframes(frames), dtype="<i2").astype(np.float32)
+    else:
+        # 8-bit WAV samples are unsigned and centred on 128
+        data = np.frombuffer(wav.readframes(frames), dtype=np.uint8).astype(np.float32) - 128
+    data = data[:len(data) // wav.getnchannels() * wav.getnchannels()]
+    data = data.reshape(-1, wav.getnchannels()).mean(axis=1)
+    window = max(1, wav.getframerate() // 50)
+    usable = len(data) // window * window
+    if usable == 0:
+        return frames
+    energy = np.sqrt((data[:usable].reshape(-1, window) ** 2).mean(axis=1))
+    return int(np.argmin(energy)) * window
+
+
+def split_wav(path, out_dir, segment_seconds=SEGMENT_SECONDS):
+    """Split a WAV file into segments, cutting at the quietest point near each window edge.
+
+    Frames are streamed from disk, so memory use does not depend on file length.
+    Returns a list of (segment_path, start_seconds, end_seconds).
+    """
+    segments = []
+    with wave.open(path, "rb") as wav:
+        rate = wav.getframerate()
+        frame_bytes = wav.getsampwidth() * wav.getnchannels()
+        total = wav.getnframes()
+        window = int(min(segment_seconds * rate, (SEGMENT_MAX_BYTES - WAV_HEADER_BYTES) // frame_bytes))
+        search = int(min(SILENCE_SEARCH_SECONDS * rate, window // 4))
+        position = 0
+        while position < total:
+            end = min(position + window, total)
+            if end < total and search and wav.getsampwidth() in (1, 2):
+                wav.setpos(end - search)
+                end = end - search + _quietest_frame(wav, search)
+                end = max(end, position + 1)
+            segment_path = os.path.join(out_dir, f"segment_{len(segments):04d}.wav")
+            wav.setpos(position)
+            with wave.open(segment_path, "wb") as out:
+                out.setnchannels(wav.getnchannels())
+                out.setsampwidth(wav.getsampwidth())
+                out.setframerate(rate)
+                remaining = end - position
+                while remaining > 0:
+                    block = min(remaining, rate * 10)
+                    out.writeframes(wav.readframes(block))
+                    remaining -= block
+            segments.append((segment_path, position / rate, end / rate))
+            position = end
+    return segments
+
+
+def probe_duration(path):
+    """Duration in seconds according to ffprobe, or None if it is unavailable or cannot tell"""
+    if not shutil.which("ffprobe"):
+        return None
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+        capture_output=True, text=True,
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+
+def _ffmpeg_segments(path, out_dir, segment_seconds, codec_args, extension):
+    pattern = os.path.join(out_dir, f"segment_%04d{extension}")
+    segment_list = os.path.join(out_dir, "segments.csv")
+    for name in os.listdir(out_dir):
+        if name.startswith("segment"):
+            os.remove(os.path.join(out_dir, name))
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", path, "-vn", *codec_args, "-f", "segment",
+         "-segment_time", str(segment_seconds), "-segment_list", segment_list,
+         "-segment_list_type", "csv", pattern],
+        check=True,
+    )
+    with open(segment_list, newline="") as f:
+        return [
+            (os.path.join(out_dir, name), float(start), float(end))
+            for name, start, end in csv.reader(f)
+        ]
+
+
+def split_with_ffmpeg(path, out_dir, segment_seconds=SEGMENT_SECONDS):
+    """Split compressed audio into windows with ffmpeg.
+
+    Windows are sized from the average bitrate (file size over the probed
+    duration) so stream-copied segments fit SEGMENT_MAX_BYTES. If some still
+    do not (variable bitrate, or no ffprobe), the audio is re-encoded at a
+    low speech bitrate instead of copied.
+    """
+    duration = probe_duration(path)
+    if duration:
+        bytes_per_second = os.path.getsize(path) / duration
+        # 10% headroom for bitrate variation between windows
+        segment_seconds = max(1.0, min(segment_seconds, SEGMENT_MAX_BYTES * 0.9 / bytes_per_second))
+    extension = os.path.splitext(path)[1] or ".mp3"
+    segments = _ffmpeg_segments(path, out_dir, segment_seconds, ["-c", "copy"], extension)
+    if all(os.path.getsize(segment) <= SEGMENT_MAX_BYTES for segment, _, _ in segments):
+        return segments
+    logger.info("Stream-copied segments of %s exceed %d bytes, re-encoding", path, SEGMENT_MAX_BYTES)
+    return _ffmpeg_segments(path, out_dir, SEGMENT_SECONDS, TRANSCODE_ARGS, ".mp3")
+
+
+def split_audio(path, out_dir, size):
+    """Split an audio file into Whisper-sized segments"""
+    try:
+        segments = split_wav(path, out_dir)
+    except (wave.Error, EOFError):
+        if shutil.which("ffmpeg"):
+            segments = split_with_ffmpeg(path, out_dir)
+        elif size <= SEGMENT_MAX_BYTES:
+            segments = [(path, 0.0, None)]
+        else:
+            raise ValueError("Splitting non-WAV audio over 24MB requires ffmpeg to be installed") from None
+    for segment, _, _ in segments:
+        if os.path.getsize(segment) > SEGMENT_MAX_BYTES:
+            raise ValueError(f"Could not split the audio into segments under {SEGMENT_MAX_BYTES // (1024 * 1024)}MB")
+    return segments
+
+
+# Pipeline
+class TranscriptionJob:
+    """State of one transcription: its segments, their transcripts and progress"""
+
+    def __init__(self, filename, work_dir, segments=(), texts=None):
+        self.filename = filename
+        self.work_dir = work_dir
+        self.segments = [tuple(segment) for segment in segments]
+        self.texts = dict(texts or {})
+
+    def to_payload(self):
+        """JSON-serializable description used to persist the job in the job queue"""
+        return {"filename": self.filename, "work_dir": self.work_dir, "segments": self.segments}
+
+    @classmethod
+    def from_payload(cls, payload, checkpoint=None):
+        # JSON object keys are strings; segment indexes are ints
+        texts = {int(index): text for index, text in (checkpoint or {}).items()}
+        return cls(payload["filename"], payload["work_dir"], payload["segments"], texts)
+
+    def progress(self):
+        return {"done": len(self.texts), "total": len(self.segments)}
+
+    def result(self):
+        stitched = []
+        for index, (_, start, end) in enumerate(self.segments):
+            stitched.append({
+                "index": index,
+                "start": round(start, 3),
+                "end": round(end, 3) if end is not None else None,
+                "text": self.texts.get(index),
+            })
+        return {
+            "filename": self.filename,
+            "transcription": " ".join(self.texts[i].strip() for i in sorted(self.texts)),
+            "segments": stitched,
+        }
+
+
+class TranscriptionPipeline:
+    """Spool -> split -> transcribe segments in parallel -> stitch in order.
+
+    Segment transcripts are reported through `on_segment` as they arrive, so
+    a failed or interrupted job can be resumed and only the segments that
+    have no transcript yet are sent again.
+    """
+
+    def __init__(self, backend, workers=TRANSCRIBE_WORKERS, tmp_dir=TRANSCRIBE_TMP_DIR):
+        self.backend = backend
+        self.workers = workers
+        self.tmp_dir = tmp_dir
+
+    async def create_job(self, upload):
+        """Spool the upload to disk and split it; nothing is transcribed yet"""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        job = TranscriptionJob(upload.filename, tempfile.mkdtemp(prefix="job-", dir=self.tmp_dir))
+        try:
+            path, size = await spool_upload(upload, job.work_dir)
+            job.segments = await asyncio.to_thread(split_audio, path, job.work_dir, size)
+        except Exception:
+            self.discard(job.to_payload())
+            raise
+        return job
+
+    async def run(self, job, on_segment=None):
+        """Transcribe the job's missing segments with a bounded number of workers.
+
+        `on_segment(job)` is awaited after each segment transcript is added.
+        """
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def transcribe_segment(index, path):
+            async with semaphore:
+                job.texts[index] = await self.backend.transcribe(path)
+            if on_segment is not None:
+                await on_segment(job)
+
+        tasks = [
+            asyncio.create_task(transcribe_segment(index, path))
+            for index, (path, _, _) in enumerate(job.segments)
+            if index not in job.texts
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the other segments before the caller discards the files they read
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        # Segment audio is no longer needed once every transcript is in
+        self.discard(job.to_payload())
+        return job.result()
+
+    def discard(self, payload):
+        """Delete a job's working files"""
+        shutil.rmtree(payload["work_dir"], ignore_errors=True)
@@ -0,0 +1,387 @@
+import asyncio
+import collections
+import math
+import os
+import random
+import time
+
+import openai
+
+from metrics import (LLM_PROMPT_TOKENS, LLM_TOKENS, UPSTREAM_QUEUE_SECONDS, UPSTREAM_RETRIES, UPSTREAM_SECONDS,
+                     UPSTREAM_SHED, Gauge)
+
+# Upstream (OpenAI) call policy, overridable through environment variables
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_MIN_CONCURRENCY = int(os.getenv("OPENAI_MIN_CONCURRENCY", "1"))
+RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "8"))
+# Account limits; 0 disables the corresponding bucket
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "0"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "0"))
+# Worker processes sharing the account (set by serve.py; uvicorn and gunicorn read it too); each gets an equal share
+WORKER_PROCESSES = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+# Load shedding: calls are rejected instead of queueing beyond these bounds
+OPENAI_MAX_QUEUE = int(os.getenv("OPENAI_MAX_QUEUE", "64"))
+OPENAI_MAX_QUEUE_SECONDS = float(os.getenv("OPENAI_MAX_QUEUE_SECONDS", "10"))
+# A call this many times slower than usual for its kind counts as congestion
+OPENAI_LATENCY_BACKOFF = float(os.getenv("OPENAI_LATENCY_BACKOFF", "2.5"))
+# Readiness probes reuse an upstream check for this long
+UPSTREAM_CHECK_SECONDS = float(os.getenv("UPSTREAM_CHECK_SECONDS", "30"))
+UPSTREAM_CHECK_TIMEOUT = 5.0
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+# Errors that mean the upstream is saturated, as opposed to a bad request
+OVERLOAD_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.InternalServerError, asyncio.TimeoutError)
+# Errors that mean the request itself was rejected (e.g. an input over the model's limit)
+INPUT_ERRORS = (openai.BadRequestError, openai.UnprocessableEntityError)
+
+
+class UpstreamOverloaded(Exception):
+    """Raised instead of sending a call the upstream cannot take now; retry after `retry_after` seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"OpenAI capacity exhausted ({reason}), retry in {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    """Refills `per_minute` units per minute, up to one minute's worth"""
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        self._refill()
+        return self.level
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units (capped at the capacity) are available"""
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        """Debit `amount` units now; the level may go negative and later callers wait for it to recover"""
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        """Return (or with a negative amount, charge) units once the real cost is known"""
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class AdaptiveLimiter:
+    """Concurrency limit tuned by AIMD: +1/limit per success, cut on 429s, timeouts and latency spikes.
+
+    Callers beyond the limit wait in FIFO order; when max_queue callers are
+    already waiting, or a slot does not free up within max_wait seconds, the
+    call is shed with UpstreamOverloaded.
+    """
+
+    def __init__(self, maximum, minimum=1, max_queue=64, max_wait=10.0, latency_backoff=2.5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.latency_backoff = latency_backoff
+        self.in_flight = 0
+        self._waiters = collections.deque()
+        self._latency = {}
+        self._last_decrease = 0.0
+
+    def _retry_after(self):
+        latency = max((average for average, _ in self._latency.values()), default=1.0)
+        return latency * (len(self._waiters) + 1) / max(self.limit, 1)
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            UPSTREAM_SHED.inc(reason="queue_full")
+            raise UpstreamOverloaded("queue full", self._retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as the wait ended; hand it on
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                UPSTREAM_SHED.inc(reason="queue_timeout")
+                raise UpstreamOverloaded("queue timeout", self._retry_after()) from None
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            self._waiters.popleft().set_result(None)
+
+    def _decrease(self, factor):
+        # One cut per round trip: a burst of 429s from the same window counts once
+        now = time.monotonic()
+        cooldown = max((average for average, _ in self._latency.values()), default=1.0)
+        if now - self._last_decrease < cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.minimum), self.limit * factor)
+
+    def on_success(self, kind, latency):
+        average, count = self._latency.get(kind, (latency, 0))
+        if count >= 20 and latency > self.latency_backoff * average:
+            self._decrease(0.9)
+        else:
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._wake()
+        # Slow-moving average so a congested period does not immediately become the new normal
+        self._latency[kind] = (average + (latency - average) * 0.05, count + 1)
+
+    def on_overload(self):
+        self._decrease(0.5)
+
+    def stats(self):
+        return {"limit": round(self.limit, 2), "in_flight": self.in_flight, "queued": len(self._waiters)}
+
+
+# Shared by every upstream call in this process
+limiter = AdaptiveLimiter(
+    OPENAI_MAX_CONCURRENCY,
+    minimum=OPENAI_MIN_CONCURRENCY,
+    max_queue=OPENAI_MAX_QUEUE,
+    max_wait=OPENAI_MAX_QUEUE_SECONDS,
+    latency_backoff=OPENAI_LATENCY_BACKOFF,
+)
+request_bucket = TokenBucket(OPENAI_RPM_LIMIT / WORKER_PROCESSES) if OPENAI_RPM_LIMIT > 0 else None
+token_bucket = TokenBucket(OPENAI_TPM_LIMIT / WORKER_PROCESSES) if OPENAI_TPM_LIMIT > 0 else None
+
+Gauge("upstream_concurrency_limit", "Current adaptive limit on in-flight OpenAI requests",
+      collect=lambda: {(): round(limiter.limit, 2)})
+Gauge("upstream_in_flight", "OpenAI requests in flight", collect=lambda: {(): limiter.in_flight})
+Gauge("upstream_waiting", "Calls waiting for an OpenAI concurrency slot",
+      collect=lambda: {(): len(limiter._waiters)})
+
+def upstream_stats():
+    stats = limiter.stats()
+    if request_bucket:
+        stats["requests_available"] = max(0, int(request_bucket.available()))
+    if token_bucket:
+        stats["tokens_available"] = max(0, int(token_bucket.available()))
+    return stats
+
+class LazyClient:
+    """Stands in for the AsyncOpenAI client and creates it on first use.
+
+    Importing the app (or serving notes with local backends) needs no API
+    key; a missing key fails the first upstream call instead of startup.
+    """
+
+    def __init__(self, api_key=None):
+        self._api_key = api_key
+        self._client = None
+
+    @property
+    def configured(self):
+        return bool(self._api_key or os.getenv("OPENAI_API_KEY"))
+
+    def get(self):
+        if self._client is None:
+            api_key = self._api_key or os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise ValueError("OPENAI_API_KEY environment variable is not set")
+            # Retries are handled by call_openai instead of the SDK
+            self._client = openai.AsyncOpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT, max_retries=0)
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+def create_client(api_key=None):
+    """OpenAI client, created lazily; without api_key OPENAI_API_KEY is read on first use"""
+    return LazyClient(api_key)
+
+_upstream_check = {"at": None, "result": None}
+
+async def check_upstream(client):
+    """Whether the API answers (a model listing, which costs no tokens); cached for UPSTREAM_CHECK_SECONDS"""
+    if not client.configured:
+        return {"ok": False, "error": "OPENAI_API_KEY is not set"}
+    now = time.monotonic()
+    if _upstream_check["at"] is not None and now - _upstream_check["at"] < UPSTREAM_CHECK_SECONDS:
+        return _upstream_check["result"]
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(client.models.list(), UPSTREAM_CHECK_TIMEOUT)
+        result = {"ok": True, "latency_ms": round((time.perf_counter() - start) * 1000, 1)}
+    except Exception as e:
+        result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    _upstream_check.update(at=now, result=result)
+    return result
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def _record_usage(response):
+    """Record reported token usage; returns the total tokens or None if the response has no usage"""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    # Embedding responses have no completion tokens and transcriptions may report seconds instead
+    model = getattr(response, "model", None) or "unknown"
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+    LLM_TOKENS.inc(prompt_tokens, model=model, type="prompt")
+    LLM_TOKENS.inc(completion_tokens, model=model, type="completion")
+    LLM_PROMPT_TOKENS.observe(prompt_tokens, model=model)
+    return prompt_tokens + completion_tokens
+
+async def _attempt(make_request, kind, stream):
+    """One request under a concurrency slot; a stream keeps the slot (see HeldStream)"""
+    queued = time.perf_counter()
+    await limiter.acquire()
+    held = False
+    try:
+        UPSTREAM_QUEUE_SECONDS.observe(time.perf_counter() - queued)
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(make_request(), OPENAI_TIMEOUT)
+        except Exception as e:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - start, outcome=type(e).__name__)
+            if isinstance(e, OVERLOAD_ERRORS):
+                limiter.on_overload()
+            raise
+        latency = time.perf_counter() - start
+        UPSTREAM_SECONDS.observe(latency, outcome="ok")
+        limiter.on_success(kind, latency)
+        if stream:
+            response, held = HeldStream(response), True
+        return response
+    finally:
+        if not held:
+            limiter.release()
+
+def backoff_delay(attempt, error=None):
+    """Exponential backoff with full jitter, honouring Retry-After when the server sends one"""
+    retry_after = _retry_after(error) if error is not None else None
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY) + random.uniform(0, RETRY_BASE_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+async def _wait_for_rate_limits(tokens):
+    """Reserve one request and `tokens` tokens, waiting for the buckets to refill if needed"""
+    delay = max(
+        request_bucket.wait_time(1) if request_bucket else 0.0,
+        token_bucket.wait_time(tokens) if token_bucket else 0.0,
+    )
+    if delay > OPENAI_MAX_QUEUE_SECONDS:
+        UPSTREAM_SHED.inc(reason="rate_limit")
+        raise UpstreamOverloaded("rate limit", delay)
+    if request_bucket:
+        request_bucket.take(1)
+    if token_bucket:
+        token_bucket.take(tokens)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+class HeldStream:
+    """A streamed response that keeps its concurrency slot until it is read to the end or closed.
+
+    Iterate it once, or close() it when giving up early; a stream dropped
+    without either releases its slot when it is garbage collected.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._held = True
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except OVERLOAD_ERRORS:
+            limiter.on_overload()
+            raise
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self._held:
+            self._held = False
+            limiter.release()
+            await self._stream.close()
+
+    def __del__(self):
+        if self._held:
+            self._held = False
+            limiter.release()
+
+async def call_openai(make_request, tokens=0, kind="chat", stream=False):
+    """Run an upstream request under the rate limits, the adaptive concurrency limit, a timeout and retries.
+
+    make_request is a zero-argument callable returning a fresh awaitable, so it
+    can be re-issued on retry. tokens is an estimate of the prompt plus
+    completion tokens (from context_budget.count_tokens), corrected from the
+    reported usage afterwards; a failed attempt refunds its request and
+    tokens. kind groups calls with similar latency. The concurrency slot is
+    released while backing off. With stream=True the request returns a stream, which comes
+    back as a HeldStream holding the slot until it has been consumed; its
+    latency is the time to the first byte. Raises UpstreamOverloaded when the
+    call would have to wait too long, or when the upstream is still rate
+    limiting after the retries.
+    """
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        try:
+            await _wait_for_rate_limits(tokens)
+            try:
+                response = await _attempt(make_request, kind, stream)
+            except BaseException:
+                # Nothing was reported used; failed attempts must not drain the budget of later ones
+                if request_bucket:
+                    request_bucket.refund(1)
+                if token_bucket:
+                    token_bucket.refund(tokens)
+                raise
+            if stream:
+                return response
+            used = _record_usage(response)
+            if token_bucket and used is not None:
+                token_bucket.refund(tokens - used)
+            return response
+        except RETRYABLE_ERRORS as e:
+            if attempt == OPENAI_MAX_RETRIES:
+                if isinstance(e, openai.RateLimitError):
+                    raise UpstreamOverloaded("rate limited upstream", _retry_after(e) or RETRY_MAX_DELAY) from e
+                raise
+            UPSTREAM_RETRIES.inc()
+            await asyncio.sleep(backoff_delay(attempt, e))
@@ -0,0 +1,468 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from coalesce import MicroBatcher
+from context_budget import count_tokens
+from coordination import worker_id
+from upstream import INPUT_ERRORS, call_openai
+
+logger = logging.getLogger(__name__)
+
+# A worker records the last seq its copy of an index applied at most this often while idle
+VECTOR_READER_TOUCH_SECONDS = float(os.getenv("VECTOR_READER_TOUCH_SECONDS", "60"))
+# Delete markers are kept until every worker seen within this many seconds has applied them;
+# a worker silent for longer reloads its copy in full if the markers it missed are gone
+VECTOR_READER_TTL_SECONDS = float(os.getenv("VECTOR_READER_TTL_SECONDS", "600"))
+
+# Embedding backends
+class HashingEmbedder:
+    """Deterministic local embedder (feature hashing), no network required"""
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    async def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in re.findall(r"\w+", text.lower()):
+                digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                sign = 1.0 if digest[4] & 1 else -1.0
+                vectors[row, bucket] += sign
+        return vectors
+
+
+class OpenAIEmbedder:
+    """Embedder backed by the (async) OpenAI embeddings API.
+
+    Texts from concurrent callers (queries, single-note writes) are collected
+    for up to batch_wait seconds and sent as one request of at most
+    batch_size inputs; identical texts waiting or in flight are embedded once.
+    """
+
+    def __init__(self, client, model="text-embedding-3-small", dim=1536, batch_size=256, batch_wait=0.005):
+        self.client = client
+        self.model = model
+        self.dim = dim
+        self.name = model
+        # One caller's rejected text fails only that caller, not everyone batched with it
+        self._batcher = MicroBatcher(self._embed_batch, "embedding", max_batch=batch_size, max_wait=batch_wait,
+                                     is_item_error=lambda error: isinstance(error, INPUT_ERRORS))
+
+    async def _embed_batch(self, texts):
+        response = await call_openai(lambda: self.client.embeddings.create(model=self.model, input=texts),
+                                     tokens=sum(count_tokens(text, self.model) for text in texts), kind="embedding")
+        return [item.embedding for item in response.data]
+
+    async def embed(self, texts):
+        vectors = await self._batcher.submit_many(texts)
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.dim)
+
+
+def get_embedder(client=None):
+    """Pick the embedding backend from the EMBEDDING_BACKEND environment variable"""
+    backend = os.getenv("EMBEDDING_BACKEND", "openai").lower()
+    if backend == "hashing":
+        return HashingEmbedder(dim=int(os.getenv("EMBEDDING_DIM", "256")))
+    if backend == "openai":
+        if client is None:
+            raise ValueError("OpenAI embedding backend requires an OpenAI client")
+        return OpenAIEmbedder(
+            client,
+            model=os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"),
+            batch_wait=float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5")) / 1000,
+        )
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend}")
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+# Vector index
+def init_vector_store(conn):
+    """Create the tables holding every vector index of a database.
+
+    vector_rows has one row per indexed ID; a removed ID keeps its row with a
+    NULL vector so other processes learn about the delete. Every write takes
+    the next value of its index's seq counter, so a process holding a copy in
+    memory catches up by reading the rows written after the last seq it saw.
+
+    vector_readers records the seq each process has applied, so compaction
+    can delete the NULL rows every live process has seen; compacted_seq is
+    the newest seq compaction removed, and a copy older than that reloads.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS vector_indexes (
+            name TEXT PRIMARY KEY,
+            embedder TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            compacted_seq INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(vector_indexes)")}
+    if "compacted_seq" not in columns:
+        conn.execute("ALTER TABLE vector_indexes ADD COLUMN compacted_seq INTEGER NOT NULL DEFAULT 0")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS vector_rows (
+            index_name TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            vector BLOB,
+            PRIMARY KEY (index_name, id)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS vector_rows_seq ON vector_rows (index_name, seq)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS vector_readers (
+            index_name TEXT NOT NULL,
+            worker TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            seen_at REAL NOT NULL,
+            PRIMARY KEY (index_name, worker)
+        )
+    ''')
+    conn.commit()
+
+
+class VectorIndex:
+    """In-memory float32 matrix of note embeddings with top-k cosine search.
+
+    Rows are L2-normalized so cosine similarity is a single matrix-vector
+    product. The matrix grows geometrically and deletes swap the last row
+    into the freed slot, so add/edit/delete never rebuild the index.
+
+    The vectors are stored in the database (vector_rows) and the matrix is
+    this process's cache of them: writes go to both, and before every search
+    the index applies rows other worker processes wrote since it last looked,
+    found through the index's seq counter. Delete markers are compacted
+    away once every worker has applied them (see compact()).
+    """
+
+    def __init__(self, name, embedder, get_connection, legacy_path=None):
+        self.name = name
+        self.embedder = embedder
+        self.get_connection = get_connection
+        self._lock = threading.RLock()
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._vectors = np.zeros((0, embedder.dim), dtype=np.float32)
+        self._size = 0
+        self._positions = {}
+        self._seq = 0
+        self._reported = (None, 0.0)
+        self._load(legacy_path)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, note_id):
+        return note_id in self._positions
+
+    def ids(self):
+        """IDs currently in the index"""
+        with self._lock:
+            return list(self._positions)
+
+    def _load(self, legacy_path):
+        with self.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT embedder FROM vector_indexes WHERE name = ?", (self.name,)).fetchone()
+                if row is None or row[0] != self.embedder.name:
+                    if row is not None:
+                        logger.warning("Embedding backend changed, discarding vector index %s", self.name)
+                    conn.execute("DELETE FROM vector_rows WHERE index_name = ?", (self.name,))
+                    conn.execute("DELETE FROM vector_readers WHERE index_name = ?", (self.name,))
+                    conn.execute("INSERT OR REPLACE INTO vector_indexes (name, embedder, seq) VALUES (?, ?, 0)",
+                                 (self.name, self.embedder.name))
+                    if row is None and legacy_path:
+                        self._import_legacy(conn, legacy_path)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        self.refresh()
+
+    def _import_legacy(self, conn, path):
+        """Take over the vectors of an index file written by earlier versions, so they are not embedded again"""
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data["embedder"]) != self.embedder.name:
+                    return
+                ids = data["ids"].astype(np.int64)
+                vectors = data["vectors"].astype(np.float32)
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning("Could not load vector index %s: %s", path, e)
+            return
+        self._write(conn, [int(note_id) for note_id in ids], vectors)
+        logger.info("Imported %d vectors from %s", len(ids), path)
+
+    def _write(self, conn, note_ids, vectors):
+        """Store rows (None vectors for removals) under the next seq values; call inside a write transaction.
+
+        Returns the first and last seq used.
+        """
+        conn.execute("UPDATE vector_indexes SET seq = seq + ? WHERE name = ?", (len(note_ids), self.name))
+        last = conn.execute("SELECT seq FROM vector_indexes WHERE name = ?", (self.name,)).fetchone()[0]
+        first = last - len(note_ids) + 1
+        conn.executemany(
+            "INSERT OR REPLACE INTO vector_rows (index_name, id, seq, vector) VALUES (?, ?, ?, ?)",
+            ((self.name, note_id, first + offset, vector.tobytes() if vector is not None else None)
+             for offset, (note_id, vector) in enumerate(zip(note_ids, vectors))),
+        )
+        return first, last
+
+    def _store(self, note_ids, vectors):
+        with self.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                first, last = self._write(conn, note_ids, vectors)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return first, last
+
+    def refresh(self):
+        """Apply rows written since the last refresh (by any process); returns how many were applied"""
+        with self.get_connection() as conn:
+            seq, compacted_seq = conn.execute(
+                "SELECT seq, compacted_seq FROM vector_indexes WHERE name = ?", (self.name,)
+            ).fetchone()
+            if self._seq < compacted_seq:
+                # Delete markers this copy has not applied were compacted away
+                return self._reload(conn)
+            if seq <= self._seq:
+                self._report(conn)
+                return 0
+            rows = conn.execute(
+                "SELECT id, vector, seq FROM vector_rows WHERE index_name = ? AND seq > ? ORDER BY seq",
+                (self.name, self._seq),
+            ).fetchall()
+        with self._lock:
+            added = [(note_id, np.frombuffer(vector, dtype=np.float32)) for note_id, vector, _ in rows if vector]
+            for note_id, vector, _ in rows:
+                if vector is None:
+                    self._drop(note_id)
+            if added:
+                self._apply([note_id for note_id, _ in added], np.stack([vector for _, vector in added]))
+            self._seq = max(self._seq, seq)
+        with self.get_connection() as conn:
+            self._report(conn)
+        return len(rows)
+
+    def _reload(self, conn):
+        """Replace the matrix with every stored vector"""
+        with self._lock:
+            seq = conn.execute("SELECT seq FROM vector_indexes WHERE name = ?", (self.name,)).fetchone()[0]
+            rows = conn.execute(
+                "SELECT id, vector FROM vector_rows WHERE index_name = ? AND vector IS NOT NULL", (self.name,)
+            ).fetchall()
+            self._size = 0
+            self._positions = {}
+            if rows:
+                self._apply([note_id for note_id, _ in rows],
+                            np.stack([np.frombuffer(vector, dtype=np.float32) for _, vector in rows]))
+            self._seq = seq
+        self._report(conn)
+        return len(rows)
+
+    def _report(self, conn):
+        """Record the seq this copy has applied, when it moved or the last record is getting old"""
+        seq, reported_at = self._reported
+        now = time.time()
+        if seq == self._seq and now - reported_at < VECTOR_READER_TOUCH_SECONDS:
+            return
+        conn.execute(
+            "INSERT OR REPLACE INTO vector_readers (index_name, worker, seq, seen_at) VALUES (?, ?, ?, ?)",
+            (self.name, worker_id(), self._seq, now),
+        )
+        conn.commit()
+        self._reported = (self._seq, now)
+
+    def compact(self):
+        """Delete the removal markers every live worker has applied; returns how many were deleted.
+
+        Live rows need no rewriting: an ID has a single row, replaced in
+        place by every write. Workers not seen for VECTOR_READER_TTL_SECONDS
+        are forgotten and reload their copy if they come back.
+        """
+        self.refresh()
+        with self.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM vector_readers WHERE index_name = ? AND seen_at < ?",
+                             (self.name, time.time() - VECTOR_READER_TTL_SECONDS))
+                horizon = conn.execute(
+                    '''
+                    SELECT COALESCE(min(r.seq), i.seq) FROM vector_indexes i
+                    LEFT JOIN vector_readers r ON r.index_name = i.name
+                    WHERE i.name = ?
+                    ''',
+                    (self.name,),
+                ).fetchone()[0]
+                newest = conn.execute(
+                    "SELECT max(seq) FROM vector_rows WHERE index_name = ? AND vector IS NULL AND seq <= ?",
+                    (self.name, horizon),
+                ).fetchone()[0]
+                deleted = 0
+                if newest is not None:
+                    deleted = conn.execute(
+                        "DELETE FROM vector_rows WHERE index_name = ? AND vector IS NULL AND seq <= ?",
+                        (self.name, newest),
+                    ).rowcount
+                    conn.execute("UPDATE vector_indexes SET compacted_seq = max(compacted_seq, ?) WHERE name = ?",
+                                 (newest, self.name))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        if deleted:
+            logger.info("Compacted %d removed rows from vector index %s", deleted, self.name)
+        return deleted
+
+    def _reserve(self, extra):
+        needed = self._size + extra
+        capacity = len(self._ids)
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2, 64)
+        ids = np.zeros(new_capacity, dtype=np.int64)
+        vectors = np.zeros((new_capacity, self.embedder.dim), dtype=np.float32)
+        ids[:self._size] = self._ids[:self._size]
+        vectors[:self._size] = self._vectors[:self._size]
+        self._ids, self._vectors = ids, vectors
+
+    def _apply(self, note_ids, vectors):
+        with self._lock:
+            self._reserve(len(note_ids))
+            for note_id, vector in zip(note_ids, vectors):
+                row = self._positions.get(note_id)
+                if row is None:
+                    row = self._size
+                    self._size += 1
+                    self._ids[row] = note_id
+                    self._positions[note_id] = row
+                self._vectors[row] = vector
+
+    def _drop(self, note_id):
+        """Drop a row from the matrix by moving the last row into its slot"""
+        row = self._positions.pop(note_id, None)
+        if row is None:
+            return False
+        last = self._size - 1
+        if row != last:
+            moved_id = int(self._ids[last])
+            self._ids[row] = moved_id
+            self._vectors[row] = self._vectors[last]
+            self._positions[moved_id] = row
+        self._size = last
+        return True
+
+    def _put(self, note_ids, vectors):
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        first, last = self._store(note_ids, vectors)
+        with self._lock:
+            self._apply(note_ids, vectors)
+            self._advance(first, last)
+
+    def _advance(self, first, last):
+        # Skip re-reading our own write on the next refresh unless another process wrote in between
+        if first == self._seq + 1:
+            self._seq = last
+
+    async def upsert(self, note_id, text):
+        """Embed one note and insert or replace its row"""
+        await self.upsert_many([note_id], [text])
+
+    async def upsert_many(self, note_ids, texts):
+        """Embed several notes in one backend call and insert or replace their rows"""
+        if not note_ids:
+            return
+        vectors = await self.embedder.embed(list(texts))
+        await asyncio.to_thread(self._put, [int(note_id) for note_id in note_ids], vectors)
+
+    def remove_many(self, note_ids):
+        """Drop rows; returns how many were in the index"""
+        note_ids = [int(note_id) for note_id in note_ids]
+        if not note_ids:
+            return 0
+        first, last = self._store(note_ids, [None] * len(note_ids))
+        with self._lock:
+            removed = sum(self._drop(note_id) for note_id in note_ids)
+            self._advance(first, last)
+        return removed
+
+    def remove(self, note_id):
+        """Drop a note's row"""
+        return self.remove_many([note_id]) > 0
+
+    async def embed_query(self, query):
+        """Embed and normalize a query so it can be reused for several lookups"""
+        return _normalize(await self.embedder.embed([query]))[0]
+
+    async def search(self, query, k=5, query_vector=None):
+        """Return up to k (note_id, score) pairs ordered by cosine similarity"""
+        if query_vector is None:
+            query_vector = await self.embed_query(query)
+
+        def refresh_and_search():
+            self.refresh()
+            return self.search_vector(query_vector, k)
+
+        # The matrix-vector product releases the GIL, so run it off the event loop
+        return await asyncio.to_thread(refresh_and_search)
+
+    def search_vector(self, query_vector, k=5):
+        """Top-k search for an already embedded, normalized query vector"""
+        with self._lock:
+            if self._size == 0:
+                return []
+            scores = self._vectors[:self._size] @ query_vector
+            k = min(k, self._size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(int(self._ids[row]), float(scores[row])) for row in top]
+
+    async def sync(self, batch_size=256, ids_sql="SELECT id FROM notes",
+                   texts_sql="SELECT id, content FROM note_contents WHERE id IN ({placeholders})", prepare=None):
+        """Embed notes missing from the index and drop rows for deleted notes.
+
+        Only the difference is embedded, so this is cheap on every startup and
+        repairs the index if an incremental update was missed. ids_sql and
+        texts_sql select what is indexed (texts_sql gets a {placeholders}
+        list of IDs to load); prepare, if given, maps each loaded text to
+        the text embedded.
+        """
+        def load_ids():
+            with self.get_connection() as conn:
+                return {row[0] for row in conn.execute(ids_sql)}
+
+        def load_notes(batch):
+            with self.get_connection() as conn:
+                placeholders = ",".join("?" * len(batch))
+                return conn.execute(texts_sql.format(placeholders=placeholders), batch).fetchall()
+
+        await asyncio.to_thread(self.refresh)
+        db_ids = await asyncio.to_thread(load_ids)
+        with self._lock:
+            stale = [note_id for note_id in self._positions if note_id not in db_ids]
+            missing = sorted(db_ids - self._positions.keys())
+        await asyncio.to_thread(self.remove_many, stale)
+        for start in range(0, len(missing), batch_size):
+            rows = await asyncio.to_thread(load_notes, missing[start:start + batch_size])
+            vectors = await self.embedder.embed([prepare(row[1]) if prepare else row[1] for row in rows])
+            await asyncio.to_thread(self._put, [row[0] for row in rows], vectors)
+        return {"added": len(missing), "removed": len(stale)}